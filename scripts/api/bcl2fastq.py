@@ -3,14 +3,25 @@
 This script reads a directory of raw files from the sequencer and executes
 the bcl2fastq converter on each file
 
+Each sample is recorded as soon as all of its fastq files have been validated
+so that send_data_to_galaxy.py can send its data while the remaining files are
+validated when the steps are run as a pipeline (see run_pipeline.py).
+
 Example of use: python bcl2fastq.py
 """
 import sys
 sys.path.insert(0, '../../util')
 import api_util
 import argparse
+import bcl2fastq_util
+import config_util
+import executor_util
+import fastq_util
 import glob
 import os
+import pipeline_util
+import shutil
+import time
 
 SCRIPT_NAME = 'bcl2fastq.py'
 
@@ -18,8 +29,8 @@ parser = argparse.ArgumentParser(description='Execute the bcl2fastq converter')
 parser.add_argument("-b", "--bcl2fastq_binary", dest="bcl2fastq_binary", default=None, help="Path to bcl2fastq binary")
 parser.add_argument("-c", "--cegr_run_info_file", dest="cegr_run_info_file", default=None, help="File contain run information")
 parser.add_argument("-d", "--bcl2fastq_report_dir", dest="bcl2fastq_report_dir", default=None, help="Path to bcl2fastq reports root directory")
-parser.add_argument("-f", "--fastq_validator_binary", dest="fastq_validator_binary", default=None, help="Path to fastQValidator binary")
 parser.add_argument("-l", "--log_file", dest="log_file", default=None, help="File for storing logging output")
+parser.add_argument("-n", "--lane_workers", dest="lane_workers", type=int, default=None, help="Number of lanes demultiplexed concurrently by separate bcl2fastq processes, 1 or less to process all lanes with one")
 parser.add_argument("-p", "--prep_directory", dest="prep_directory", default=None, help="Directory containing datasets produced by cegr_bcl2fastq.py")
 parser.add_argument("-r", "--raw_data_directory", dest="raw_data_directory", default=None, help="Directory containing datasets produced by the sequencer")
 parser.add_argument("-s", "--sample_sheet", dest="sample_sheet", default=None, help="The csv version of cegr_run_info.txt required by bcl2fastq")
@@ -32,21 +43,36 @@ bcl2fastq_report_dir = api_util.get_value_or_default(args.bcl2fastq_report_dir,
 cegr_run_info_file = api_util.get_value_or_default(args.cegr_run_info_file, 'RUN_INFO_FILE', is_path=True)
 current_run_dir = api_util.get_current_run_directory(cegr_run_info_file)
 current_run_folder = os.path.basename(current_run_dir)
-fastq_validator_binary = api_util.get_value_or_default(args.fastq_validator_binary, 'FASTQ_VALIDATOR_BINARY')
+config = config_util.get_config(api_util.CONFIG_FILE)
+copy_resources = config.get('COPY_RESOURCE_LIST', default=None) or None
+fastq_validation_max_workers = config.get_int('FASTQ_VALIDATION_MAX_WORKERS', default=None)
+fastq_validation_resources = config.get('FASTQ_VALIDATION_RESOURCE_LIST', default=None) or None
 log_dir = api_util.get_value_or_default(None, 'ANALYSIS_PREP_LOG_FILE_DIR', is_path=True, create_dir=True)
 log_file = api_util.get_value_or_default(args.log_file, 'ANALYSIS_PREP_LOG_FILE', is_path=True)
 lh = api_util.open_log_file(log_file, SCRIPT_NAME)
 prep_directory = os.path.join(api_util.get_value_or_default(args.prep_directory, 'LIBRARY_PREP_DIR', is_path=True), current_run_folder)
 raw_data_directory = os.path.join(api_util.get_value_or_default(args.raw_data_directory, 'RAW_DATA_DIR', is_path=True), current_run_folder)
+lane_workers = args.lane_workers
+if lane_workers is None:
+    lane_workers = config.get_int('BCL2FASTQ_LANE_WORKERS', default=0)
 sample_sheet = api_util.get_value_or_default(args.sample_sheet, 'SAMPLE_SHEET', is_path=True)
+# bcl2fastq, fastq validation and copies are run on this host
+# or submitted to a cluster by the executor.
+bcl2fastq_resources = config.get('BCL2FASTQ_RESOURCE_LIST', default=None) or None
+executor_job_dir = api_util.get_value_or_default(None, 'EXECUTOR_JOB_DIR', is_path=True) or os.path.join(log_dir, 'jobs')
+executor = executor_util.get_executor(config, executor_job_dir)
+# Record the state of this step and of each sample.
+pipeline_state = pipeline_util.get_pipeline_state(config, log_dir, current_run_folder)
+# Forget the samples finished by a previous execution.
+pipeline_state.reset_stage(SCRIPT_NAME)
+pipeline_state.start_stage(SCRIPT_NAME)
 
-# If we are processing run 209 or earlier, we'll need to copy the raw data directory
-# from the old location to the new location.
-rc = api_util.copy_raw_data_if_necessary(current_run_dir, raw_data_directory, lh)
-if rc == 0:
-    # Generate the sample sheet required by the Illumina bec2fastq binary.
-    api_util.generate_sample_sheet(cegr_run_info_file, sample_sheet, lh)
-    # Build the command.
+
+def get_bcl2fastq_cmd(output_dir, interop_dir, stats_dir, reports_dir, thread_counts, lane=None):
+    """
+    Return the bcl2fastq command for the whole run, or for
+    only the tiles in lane if it is not None.
+    """
     cmd = '%s ' % bcl2fastq_binary
     # Minimum log level, recognized values: NONE, FATAL, ERROR, WARNING, INFO, DEBUG, TRACE.
     cmd += '-l ERROR '
@@ -55,60 +81,224 @@ if rc == 0:
     # Path to runfolder directory, default (=./).
     cmd += '-R %s ' % raw_data_directory
     # Path to demultiplexed output, default (=<input-dir>)
-    cmd += '-o %s ' % prep_directory
+    cmd += '-o %s ' % output_dir
     # Path to demultiplexing statistics directory, default (=<runfolder-dir>/InterOp/).
-    cmd += '--interop-dir %s/InterOp ' % raw_data_directory
+    cmd += '--interop-dir %s ' % interop_dir
     # Path to human-readable demultiplexing statistics directory, default (=<output-dir>/Stats/).
-    cmd += '--stats-dir %s/Stats ' % prep_directory
+    cmd += '--stats-dir %s ' % stats_dir
     # Path to reporting directory, default (=<output-dir>/Reports/).
-    cmd += '--reports-dir %s/Reports ' % prep_directory
+    cmd += '--reports-dir %s ' % reports_dir
     # Do not split fastq files by lane.
     cmd += '--no-lane-splitting '
     # Path to the sample sheet.
     cmd += '--sample-sheet %s ' % sample_sheet
+    if lane is not None:
+        # Regular expression selecting the tiles to process.
+        cmd += '--tiles s_%d ' % lane
     # Tiles aggregation flag  determining structure of input files, recognized values: AUTO, YES, NO.
     # cmd += '--aggregated-tiles AUTO '
     # Number of threads used for loading BCL data.
-    cmd += '-r 4 '
+    cmd += '-r %d ' % thread_counts['loading_threads']
     # Number of threads used for demultiplexing.
-    cmd += '-d 4 '
+    cmd += '-d %d ' % thread_counts['demultiplexing_threads']
     # Number of threads used for processing demultiplexed data.
-    cmd += '-p 4 '
+    cmd += '-p %d ' % thread_counts['processing_threads']
     # number of threads used for writing FASTQ data this must not be higher than number of samples.
-    cmd += '-w 4 '
+    cmd += '-w %d ' % thread_counts['writing_threads']
     # Additional options not used here...
     # Number of allowed mismatches per index multiple entries, default (=1).
     cmd += '--barcode-mismatches 1'
-    # Errors will be logged by execute_cmd.
-    rc = api_util.execute_cmd(cmd, lh)
+    return cmd
+
+
+def run_bcl2fastq(cmds, name, max_running=None):
+    """
+    Run the bcl2fastq commands using the configured executor, at most
+    max_running at once, and log the output of each.  Returns their exit
+    codes and a dictionary containing their total CPU time and largest peak
+    resident set size, which are None if they were not run on this host.
+    """
+    usage = dict(cpu_time=None, peak_rss=None)
+    job = api_util.execute_job(executor, cmds, name, lh, resources=bcl2fastq_resources, max_running=max_running)
+    if job is None:
+        return [1], usage
+    executor.cleanup(job)
+    if all(task.usage is not None and task.usage['cpu_time'] is not None for task in job.tasks):
+        usage['cpu_time'] = sum(task.usage['cpu_time'] for task in job.tasks)
+        usage['peak_rss'] = max(task.usage['peak_rss'] for task in job.tasks)
+    return [task.rc for task in job.tasks], usage
+
+
+# If we are processing run 209 or earlier, we'll need to copy the raw data directory
+# from the old location to the new location.
+rc = api_util.copy_raw_data_if_necessary(current_run_dir, raw_data_directory, lh, executor=executor, resources=copy_resources)
+if rc == 0:
+    # Generate the sample sheet required by the Illumina bec2fastq binary.
+    api_util.generate_sample_sheet(cegr_run_info_file, sample_sheet, lh)
+    # Choose the numbers of threads from the resources
+    # available and the number of samples in the run.
+    if isinstance(executor, executor_util.PBSExecutor):
+        # Each bcl2fastq process runs on a compute node with the requested resources.
+        requested_resources = executor_util.parse_resource_list(bcl2fastq_resources)
+        num_cores = requested_resources.get('ncpus', 1)
+        memory_size = requested_resources.get('mem', None)
+    else:
+        num_cores = bcl2fastq_util.get_number_of_cores()
+        memory_size = bcl2fastq_util.get_memory_size()
+    num_samples = bcl2fastq_util.get_number_of_samples(sample_sheet)
+    thread_counts = bcl2fastq_util.get_thread_counts(num_cores, memory_size, num_samples, config)
+    lh.write('Found %d cores, %s bytes of memory and %d samples.\n' % (num_cores, str(memory_size), num_samples))
+    if lane_workers > 1:
+        try:
+            lanes = bcl2fastq_util.get_lanes(raw_data_directory)
+        except Exception, e:
+            lh.write('Processing all lanes with one bcl2fastq process since the lanes could not be determined: %s\n' % str(e))
+            lane_workers = 0
+    if lane_workers > 1:
+        # Demultiplex each lane with a separate bcl2fastq process, several
+        # at once, and then concatenate the files produced for each lane.
+        lane_workers = min(lane_workers, len(lanes))
+        if not isinstance(executor, executor_util.PBSExecutor):
+            # Divide the resources between the concurrent processes.
+            thread_counts = bcl2fastq_util.get_thread_counts(max(1, num_cores // lane_workers),
+                                                             memory_size // lane_workers if memory_size is not None else None,
+                                                             num_samples,
+                                                             config)
+        lh.write('Demultiplexing %d lanes, %d at a time.\n' % (len(lanes), lane_workers))
+        cmds = []
+        for lane in lanes:
+            lane_dir = bcl2fastq_util.get_lane_directory(prep_directory, lane)
+            if os.path.isdir(lane_dir):
+                # Remove files left by a previous execution.
+                shutil.rmtree(lane_dir)
+            os.makedirs(lane_dir)
+            cmds.append(get_bcl2fastq_cmd(lane_dir,
+                                          os.path.join(lane_dir, 'InterOp'),
+                                          os.path.join(prep_directory, 'Stats', 'L%03d' % lane),
+                                          os.path.join(prep_directory, 'Reports', 'L%03d' % lane),
+                                          thread_counts,
+                                          lane=lane))
+        start = time.time()
+        lane_rcs, usage = run_bcl2fastq(cmds, 'bcl2fastq_lanes', max_running=lane_workers)
+        failed_lanes = [lane for lane, lane_rc in zip(lanes, lane_rcs) if lane_rc != 0]
+        if failed_lanes:
+            lh.write('bcl2fastq failed for lanes %s.\n' % ', '.join(str(lane) for lane in failed_lanes))
+            rc = 1
+        else:
+            merged_files = bcl2fastq_util.merge_lane_fastq_files([bcl2fastq_util.get_lane_directory(prep_directory, lane) for lane in lanes], prep_directory)
+            lh.write('Concatenated the files for %d lanes into %d fastq files.\n' % (len(lanes), len(merged_files)))
+            rc = 0
+        wall_time = time.time() - start
+    else:
+        lane_workers = 0
+        cmd = get_bcl2fastq_cmd(prep_directory,
+                                os.path.join(raw_data_directory, 'InterOp'),
+                                os.path.join(prep_directory, 'Stats'),
+                                os.path.join(prep_directory, 'Reports'),
+                                thread_counts)
+        # Errors will be logged by run_bcl2fastq.
+        start = time.time()
+        rcs, usage = run_bcl2fastq([cmd], 'bcl2fastq')
+        rc = rcs[0]
+        wall_time = time.time() - start
     # Get the run from the sample sheet.
     run = api_util.get_run_from_sample_sheet(sample_sheet)
+    # Record the resources used so that the thread counts can be compared.
+    resource_usage = dict(run=run,
+                          cores=num_cores,
+                          memory_size=memory_size,
+                          samples=num_samples,
+                          lane_workers=lane_workers,
+                          return_code=rc,
+                          wall_time='%.1f' % wall_time,
+                          # The usage of processes run on compute nodes is not known here.
+                          cpu_time='%.1f' % usage['cpu_time'] if usage['cpu_time'] is not None else '',
+                          peak_rss=usage['peak_rss'] if usage['peak_rss'] is not None else '')
+    resource_usage.update(thread_counts)
+    bcl2fastq_util.record_resource_usage(log_dir, resource_usage)
+    if usage['peak_rss'] is None:
+        lh.write('bcl2fastq took %.1f seconds.\n' % wall_time)
+    else:
+        lh.write('bcl2fastq took %.1f seconds and %.1f seconds of CPU time with a peak resident set size of %d bytes.\n' %
+                 (wall_time, usage['cpu_time'], usage['peak_rss']))
     if rc == 0:
         # Check the files produced by bcl2fastq to make sure they are valid fastq.
         match_str = '%s*.fastq.gz' % str(run)
-        fastq_files = os.path.join(prep_directory, match_str)
-        for fastq_file in glob.glob(fastq_files):
+        fastq_files = []
+        # The files of each sample that have not been validated.
+        unvalidated_fastq_files = {}
+        # Sorting keeps the files of each sample together so that
+        # the samples are ready one after another.
+        for fastq_file in sorted(glob.glob(os.path.join(prep_directory, match_str))):
             # bcl2fastq regularly generates empty files.
-            file_size = os.path.getsize(fastq_file)
-            if file_size > 0 and file_size < 8000000000:
-                rc = api_util.is_valid_fastq(fastq_validator_binary, fastq_file, lh)
-                lh.write('Validation exit code: %s\n' % str(rc))
-                if rc != 0:
-                    msg = 'Exiting bclfastq.py because the following file is an invalid fastq file.\n%s\n' % f
-                    lh.write('%s\n' % msg)
-                    api_util.close_log_file(lh, SCRIPT_NAME)
-                    api_util.stop_err(msg)
+            if os.path.getsize(fastq_file) > 0:
+                fastq_files.append(fastq_file)
+                sample = bcl2fastq_util.get_sample_from_fastq_file(run, fastq_file)
+                unvalidated_fastq_files.setdefault(sample, set()).add(fastq_file)
+        invalid_samples = set()
+        for sample in unvalidated_fastq_files:
+            if sample is not None:
+                pipeline_state.start_sample(SCRIPT_NAME, sample)
+
+        def record_validation_result(fastq_file, result):
+            # Record the checksums and read statistics computed while validating
+            # so that later steps can use them instead of reading the files again.
+            fastq_util.write_manifest(prep_directory, {fastq_file: result})
+            sample = bcl2fastq_util.get_sample_from_fastq_file(run, fastq_file)
+            unvalidated_fastq_files[sample].discard(fastq_file)
+            if not result['valid'] and sample not in invalid_samples:
+                invalid_samples.add(sample)
+                if sample is not None:
+                    pipeline_state.mark_sample(SCRIPT_NAME, sample, failed=True, error=result['error'])
+            elif not unvalidated_fastq_files[sample] and sample not in invalid_samples and sample is not None:
+                pipeline_state.mark_sample(SCRIPT_NAME, sample)
+
+        # Each file is validated by a separate task.  Validation is I/O
+        # bound, so the number of files read at once can be limited.
+        validation_results = api_util.validate_fastq_files(executor,
+                                                           fastq_files,
+                                                           lh,
+                                                           resources=fastq_validation_resources,
+                                                           max_running=fastq_validation_max_workers,
+                                                           on_result=record_validation_result)
+        invalid_fastq_files = sorted(f for f, result in validation_results.items() if not result['valid'])
+        if invalid_fastq_files:
+            msg = 'Exiting bclfastq.py because the following files are invalid fastq files.\n%s\n' % '\n'.join(invalid_fastq_files)
+            lh.write('%s\n' % msg)
+            api_util.close_log_file(lh, SCRIPT_NAME)
+            pipeline_state.mark_stage(SCRIPT_NAME, failed=True, error='Invalid fastq files')
+            api_util.stop_err(msg)
         # Move the bcl2fastq-generated "Reports" directory and its contents to long-term storage.
-        src_path = os.path.join(prep_directory, 'Reports', 'html')
         dest_path = os.path.join(bcl2fastq_report_dir, run)
-        rc = api_util.copy_local_directory_of_files(src_path, dest_path, lh)
+        if lane_workers > 0:
+            # Each lane has its own reports.
+            if not os.path.isdir(dest_path):
+                os.makedirs(dest_path)
+            for lane in lanes:
+                lane_name = 'L%03d' % lane
+                src_path = os.path.join(prep_directory, 'Reports', lane_name, 'html')
+                rc = api_util.copy_local_directory_of_files(src_path, os.path.join(dest_path, lane_name), lh, executor=executor, resources=copy_resources)
+                if rc != 0:
+                    break
+            # The files for each lane were concatenated.
+            shutil.rmtree(bcl2fastq_util.get_lanes_directory(prep_directory))
+        else:
+            src_path = os.path.join(prep_directory, 'Reports', 'html')
+            rc = api_util.copy_local_directory_of_files(src_path, dest_path, lh, executor=executor, resources=copy_resources)
+        if rc != 0:
+            pipeline_state.mark_stage(SCRIPT_NAME, failed=True, error='Copying the reports failed')
+    else:
+        pipeline_state.mark_stage(SCRIPT_NAME, failed=True, error='bcl2fastq failed')
     api_util.close_log_file(lh, SCRIPT_NAME)
     # Archive the sample sheet.
     api_util.archive_file(sample_sheet, run)
     if rc == 0:
+        # The samples that were not finished have only empty files.
+        pipeline_state.mark_stage(SCRIPT_NAME)
         # Let everyone know we've finished.
         api_util.create_script_complete_file(log_dir, SCRIPT_NAME)
 else:
     lh.write('\nError copying directory\n%s\nto\n%s\n.\nResponse code: %s' % (current_run_dir, raw_data_directory, str(rc)))
     api_util.close_log_file(lh, SCRIPT_NAME)
+    pipeline_state.mark_stage(SCRIPT_NAME, failed=True, error='Copying the raw data failed')
     sys.exit(1)
@@ -10,6 +10,8 @@ import sys
 sys.path.insert(0, '../../util')
 import api_util
 import argparse
+import config_util
+import executor_util
 import os
 import time
 
@@ -24,6 +26,8 @@ parser.add_argument("-s", "--raw_data_login", dest="raw_data_login", default=Non
 args = parser.parse_args()
 
 cegr_run_info_path = api_util.get_value_or_default(args.cegr_run_info_file, 'RUN_INFO_FILE', is_path=True)
+config = config_util.get_config(api_util.CONFIG_FILE)
+copy_resources = config.get('COPY_RESOURCE_LIST', default=None) or None
 log_dir = api_util.get_value_or_default(None, 'ANALYSIS_PREP_LOG_FILE_DIR', is_path=True, create_dir=True)
 log_file = api_util.get_value_or_default(args.log_file, 'ANALYSIS_PREP_LOG_FILE', is_path=True)
 lh = api_util.open_log_file(log_file, SCRIPT_NAME)
@@ -31,6 +35,9 @@ raw_data_directory = api_util.get_value_or_default(args.raw_data_directory, 'RAW
 raw_data_login = api_util.get_value_or_default(args.raw_data_login, 'RAW_DATA_LOGIN')
 remote_run_info_file = api_util.get_value_or_default(None, 'REMOTE_RUN_INFO_FILE')
 run_complete_file_name = api_util.get_value_or_default(args.run_complete_file, 'REMOTE_RUN_COMPLETE_FILE')
+# The raw data is copied on this host or by a job submitted to a cluster by the executor.
+executor_job_dir = api_util.get_value_or_default(None, 'EXECUTOR_JOB_DIR', is_path=True) or os.path.join(log_dir, 'jobs')
+executor = executor_util.get_executor(config, executor_job_dir)
 
 while True:
     if api_util.exists_remote(raw_data_login, remote_run_info_file, lh):
@@ -48,7 +55,7 @@ while True:
         run_complete_file_path = os.path.join(current_run_dir, run_complete_file_name)
         lh.write('Current run directory on remote server: %s\n' % current_run_dir)
         if api_util.exists_remote(raw_data_login, run_complete_file_path, lh):
-            rc = api_util.copy_remote_directory_of_files(raw_data_login, current_run_dir, raw_data_directory, lh)
+            rc = api_util.copy_remote_directory_of_files(raw_data_login, current_run_dir, raw_data_directory, lh, executor=executor, resources=copy_resources)
             if rc == 0:
                 # All files were successfully copied, so remove the remote cegr_run_info.txt file.
                 rc = api_util.remove_remote_file(raw_data_login, remote_run_info_file, lh)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+This script displays the state of the runs recorded in the pipeline state
+database by run_pipeline.py and the processing scripts.  Without arguments,
+each run is listed with its state and the state of each of its steps.  With
+the "-r" command line parameter, the state of each step of the run and of
+each sample in each step is displayed along with the errors of those that
+failed.  This replaces keeping a list of the runs that were only partially
+processed by hand.
+
+Example of use: python pipeline_status.py -r 161212_NS500168_0148_AHL2T3BGXY
+"""
+import sys
+sys.path.insert(0, '../../util')
+import api_util
+import argparse
+import config_util
+import pipeline_util
+
+COLUMNS = ['state', 'attempts', 'started', 'finished', 'error']
+
+parser = argparse.ArgumentParser(description='Display the processing state of runs')
+parser.add_argument("-d", "--db_file", dest="db_file", default=None, help="Pipeline state database")
+parser.add_argument("-r", "--run", dest="run", default=None, help="Name of the run directory of the run to display")
+args = parser.parse_args()
+
+config = config_util.get_config(api_util.CONFIG_FILE)
+log_dir = api_util.get_value_or_default(None, 'ANALYSIS_PREP_LOG_FILE_DIR', is_path=True, create_dir=True)
+db_file = args.db_file or pipeline_util.get_db_file(config, log_dir)
+
+
+def format_row(row, key_columns):
+    values = [row[column] for column in key_columns + COLUMNS]
+    return '\t'.join('' if value is None else str(value) for value in values)
+
+
+run_rows = pipeline_util.get_runs(db_file)
+if args.run is None:
+    print '\t'.join(['run'] + COLUMNS + ['steps'])
+    for run_row in run_rows:
+        pipeline_state = pipeline_util.PipelineState(db_file, run_row['run'])
+        stages = ', '.join('%s %s' % (stage_row['stage'], stage_row['state']) for stage_row in pipeline_state.get_stages())
+        print '%s\t%s' % (format_row(run_row, ['run']), stages)
+else:
+    if args.run not in [run_row['run'] for run_row in run_rows]:
+        api_util.stop_err('Run %s is not in the pipeline state database %s.\n' % (args.run, db_file))
+    pipeline_state = pipeline_util.PipelineState(db_file, args.run)
+    for run_row in run_rows:
+        if run_row['run'] == args.run:
+            print '\t'.join(['run'] + COLUMNS)
+            print format_row(run_row, ['run'])
+    print
+    print '\t'.join(['step'] + COLUMNS)
+    for stage_row in pipeline_state.get_stages():
+        print format_row(stage_row, ['stage'])
+    print
+    print '\t'.join(['step', 'sample'] + COLUMNS)
+    for sample_row in pipeline_state.get_samples():
+        print format_row(sample_row, ['stage', 'sample'])
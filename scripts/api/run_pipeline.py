@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+This script processes a run by running copy_raw_data.py and then the
+bcl2fastq.py, send_data_to_galaxy.py and start_workflows.py steps at the same
+time so that each sample moves on to the next step as soon as it has finished
+the previous one instead of waiting for every sample in the run.  The data of
+a sample is sent to Galaxy as soon as its fastq files have been validated, and
+its workflows are started as soon as its library datasets are ok.  bcl2fastq
+still demultiplexes the whole run before any sample is ready.
+
+The state of the run, of each step and of each sample in each step is kept in
+the pipeline state database (see pipeline_util.py), which pipeline_status.py
+displays.  If this script is executed again for a run that did not finish
+(e.g., after a crash), anything left running is marked as failed and the run
+resumes where it left off: steps that are done are skipped and workflows are
+only started for the samples for which they were not started.  Steps whose
+script complete files exist are also skipped, as in start_processing.sh,
+which calls this script when it receives the "pipeline" argument.
+
+Each step writes to its own log file, named for the step and placed next to
+the usual log file, so that the output of the steps is not interleaved.  Exits
+with a non-zero status if any step fails.
+
+Example of use: python run_pipeline.py
+"""
+import sys
+sys.path.insert(0, '../../util')
+import api_util
+import argparse
+import config_util
+import fcntl
+import os
+import pipeline_util
+import subprocess
+import time
+
+SCRIPT_NAME = 'run_pipeline.py'
+COPY_RAW_DATA_SCRIPT_NAME = 'copy_raw_data.py'
+# The arguments added to each step so that it processes samples as they become ready.
+STREAM_ARGS = {'bcl2fastq.py': [],
+               'send_data_to_galaxy.py': ['--stream'],
+               'start_workflows.py': ['--stream']}
+
+parser = argparse.ArgumentParser(description='Run the processing steps for a run concurrently')
+parser.add_argument("-c", "--cegr_run_info_file", dest="cegr_run_info_file", default=None, help="File contain run information")
+parser.add_argument("-l", "--log_file", dest="log_file", default=None, help="File for storing logging output")
+args = parser.parse_args()
+
+cegr_run_info_file = api_util.get_value_or_default(args.cegr_run_info_file, 'RUN_INFO_FILE', is_path=True)
+config = config_util.get_config(api_util.CONFIG_FILE)
+log_dir = api_util.get_value_or_default(None, 'ANALYSIS_PREP_LOG_FILE_DIR', is_path=True, create_dir=True)
+log_file = api_util.get_value_or_default(args.log_file, 'ANALYSIS_PREP_LOG_FILE', is_path=True)
+lh = api_util.open_log_file(log_file, SCRIPT_NAME)
+db_file = pipeline_util.get_db_file(config, log_dir)
+
+
+def get_stage_cmd(stage):
+    log_file_base, log_file_ext = os.path.splitext(log_file)
+    stage_log_file = '%s_%s%s' % (log_file_base, os.path.splitext(stage)[0], log_file_ext)
+    return [sys.executable, stage, '--log_file', stage_log_file] + STREAM_ARGS.get(stage, [])
+
+
+def is_stage_complete(stage):
+    return os.path.exists(os.path.join(log_dir, '%s.complete' % stage))
+
+
+# Keep the file locked while running so that a run is never processed by two
+# executions at once (e.g., by cron while a previous execution is running).
+lock_fh = open('%s.lock' % db_file, 'w')
+try:
+    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+except IOError:
+    msg = 'Exiting since another execution of %s holds the lock %s.\n' % (SCRIPT_NAME, lock_fh.name)
+    lh.write(msg)
+    api_util.close_log_file(lh, SCRIPT_NAME)
+    api_util.stop_err(msg)
+
+# The run is not known until the cegr_run_info file has been copied.
+copy_raw_data_started = None
+if not is_stage_complete(COPY_RAW_DATA_SCRIPT_NAME):
+    copy_raw_data_started = pipeline_util.get_current_time()
+    cmd = get_stage_cmd(COPY_RAW_DATA_SCRIPT_NAME)
+    lh.write('Starting step %s.\n' % ' '.join(cmd))
+    lh.flush()
+    rc = subprocess.call(cmd)
+    if rc != 0 or not is_stage_complete(COPY_RAW_DATA_SCRIPT_NAME):
+        msg = 'Step %s failed with exit code %d.\n' % (COPY_RAW_DATA_SCRIPT_NAME, rc)
+        lh.write(msg)
+        api_util.close_log_file(lh, SCRIPT_NAME)
+        api_util.stop_err(msg)
+current_run_folder = os.path.basename(api_util.get_current_run_directory(cegr_run_info_file))
+pipeline_state = pipeline_util.get_pipeline_state(config, log_dir, current_run_folder)
+# Anything still running was interrupted by a crash.
+num_recovered = pipeline_state.recover()
+if num_recovered:
+    lh.write('Marked %d steps and samples of run %s that were interrupted as failed.\n' % (num_recovered, current_run_folder))
+pipeline_state.start_run()
+lh.write('Processing run %s, recording its state in %s.\n' % (current_run_folder, db_file))
+if copy_raw_data_started is not None:
+    pipeline_state.start_stage(COPY_RAW_DATA_SCRIPT_NAME, started=copy_raw_data_started)
+    pipeline_state.mark_stage(COPY_RAW_DATA_SCRIPT_NAME)
+elif pipeline_state.get_stage_state(COPY_RAW_DATA_SCRIPT_NAME) is None:
+    # The raw data was copied by start_processing.sh.
+    pipeline_state.mark_stage(COPY_RAW_DATA_SCRIPT_NAME)
+
+# The process running each step keyed by step.
+procs = {}
+for stage in pipeline_util.STAGES:
+    if pipeline_state.get_stage_state(stage) == pipeline_util.DONE or is_stage_complete(stage):
+        lh.write('Skipping step %s since it has already completed.\n' % stage)
+        if pipeline_state.get_stage_state(stage) != pipeline_util.DONE:
+            # The step was completed outside of the pipeline (e.g., by
+            # start_processing.sh), so keep the later steps from waiting
+            # for its samples.
+            pipeline_state.mark_stage(stage)
+        continue
+    if stage != pipeline_util.STAGES[-1]:
+        # Forget the samples finished by a previous execution before any
+        # later step can mistake them for samples that are ready.  The
+        # samples whose workflows were started are kept so that their
+        # workflows are not started again.
+        pipeline_state.reset_stage(stage)
+    cmd = get_stage_cmd(stage)
+    lh.write('Starting step %s.\n' % ' '.join(cmd))
+    procs[stage] = subprocess.Popen(cmd)
+lh.flush()
+failed_stages = []
+while procs:
+    for stage, proc in list(procs.items()):
+        rc = proc.poll()
+        if rc is None:
+            continue
+        del procs[stage]
+        # Some steps exit normally without creating their
+        # script complete file when they fail.
+        if rc == 0 and is_stage_complete(stage):
+            lh.write('Step %s completed.\n' % stage)
+            continue
+        lh.write('Step %s failed with exit code %d.\n' % (stage, rc))
+        failed_stages.append(stage)
+        if pipeline_state.get_stage_state(stage) != pipeline_util.FAILED:
+            # Keep the later steps from waiting for samples that
+            # the step will not finish.
+            pipeline_state.mark_stage(stage, failed=True, error='Exited with code %d' % rc)
+    lh.flush()
+    if procs:
+        time.sleep(1)
+if failed_stages:
+    pipeline_state.finish_run(failed=True, error='The following steps failed: %s' % ', '.join(failed_stages))
+else:
+    pipeline_state.finish_run()
+api_util.close_log_file(lh, SCRIPT_NAME)
+if failed_stages:
+    api_util.stop_err('The following steps failed: %s\n' % ', '.join(failed_stages))
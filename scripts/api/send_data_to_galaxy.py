@@ -9,6 +9,11 @@ files produced by sequencing runs.  In some cases, the file may have to be
 edited manually.  When this is necessary, the file should be checked for
 errors prior to running this script using the cegr_validate_run_info.py script.
 
+With --stream, this script runs at the same time as bcl2fastq.py (see
+run_pipeline.py), sending the data of each sample as soon as bcl2fastq.py has
+validated it and recording each sample whose datasets are ok so that
+start_workflows.py can start its workflows without waiting for the others.
+
 Example of use: send_data_to_galaxy.py
 """
 
@@ -16,7 +21,11 @@ import sys
 sys.path.insert(0, '../../util')
 import api_util
 import argparse
+import config_util
+import data_library_util
+import fastq_util
 import os
+import pipeline_util
 import time
 # If this Galaxy instance uses a virtual environment,
 # activate it so we can import Galaxy from bioblend.
@@ -28,8 +37,10 @@ SCRIPT_NAME = 'send_data_to_galaxy.py'
 parser = argparse.ArgumentParser(description='Send sequenced data to Galaxy')
 parser.add_argument("-a", "--api_key", dest="api_key", default=None, help="Galaxy API Key")
 parser.add_argument("-c", "--cegr_run_info_file", dest="cegr_run_info_file", default=None, help="File contain run information")
+parser.add_argument("-k", "--link_data_only", dest="link_data_only", action="store_true", default=None, help="Link the datasets into the data library instead of copying them")
 parser.add_argument("-l", "--log_file", dest="log_file", default=None, help="File for storing logging output")
 parser.add_argument("-p", "--prep_directory", dest="prep_directory", default=None, help="Directory containing datasets produced by cegr_fastq_merge.py")
+parser.add_argument("-s", "--stream", dest="stream", action="store_true", default=False, help="Send the data of each sample as soon as the bcl2fastq step has validated it")
 parser.add_argument("-u", "--galaxy_base_url", dest="galaxy_base_url", default=None, help="Galaxy base URL")
 args = parser.parse_args()
 
@@ -43,11 +54,135 @@ prep_directory = os.path.join(api_util.get_value_or_default(args.prep_directory,
 log_dir = api_util.get_value_or_default(None, 'ANALYSIS_PREP_LOG_FILE_DIR', is_path=True, create_dir=True)
 log_file = api_util.get_value_or_default(args.log_file, 'ANALYSIS_PREP_LOG_FILE', is_path=True)
 lh = api_util.open_log_file(log_file, SCRIPT_NAME)
+config = config_util.get_config(api_util.CONFIG_FILE)
+upload_max_wait = config.get_int('UPLOAD_MAX_WAIT', default=3600)
+upload_poll_min_interval = config.get_int('UPLOAD_POLL_MIN_INTERVAL', default=2)
+upload_poll_max_interval = config.get_int('UPLOAD_POLL_MAX_INTERVAL', default=60)
+link_data_only = args.link_data_only or config.get_bool('LINK_DATA_ONLY')
+verify_checksums = config.get_bool('VERIFY_CHECKSUMS')
+pipeline_max_wait = config.get_int('PIPELINE_MAX_WAIT', default=86400)
+pipeline_poll_min_interval = config.get_int('PIPELINE_POLL_MIN_INTERVAL', default=2)
+pipeline_poll_max_interval = config.get_int('PIPELINE_POLL_MAX_INTERVAL', default=60)
+library_id = None
+# The data library's folders and datasets keyed by name, which include
+# any created by a previous execution of this script for the run.
+folder_ids = {}
+library_dataset_ids = {}
+
 
-created_library_names = []
-created_folder_names = []
+def send_sample_data(i, line, run, sample, data_lib_desc, data_lib_syn):
+    """
+    Import the datasets of the sample into a folder for it in the run's data
+    library, creating the library and folder if necessary.  Returns the list
+    of ids of the library datasets that are not yet ok, or None if an error
+    occurred.
+    """
+    global folder_ids
+    global library_dataset_ids
+    global library_id
+    uploaded_dataset_ids = []
+    try:
+        if library_id is None:
+            library_id = data_library_util.get_data_library(gi, run, lh)
+            if library_id is not None:
+                # A previous execution of this script must have been
+                # interrupted, so get what it already did.
+                folder_ids, library_dataset_ids = data_library_util.get_library_index(gi, library_id)
+                lh.write('Reusing existing data library named "%s" containing %d folders and %d datasets.\n' % (run, len(folder_ids), len(library_dataset_ids)))
+            else:
+                # Create a data library.
+                if data_lib_desc == '':
+                    data_lib_desc = None
+                if data_lib_syn == '':
+                    data_lib_syn = None
+                new_lib_dict = gi.libraries.create_library(run, data_lib_desc, data_lib_syn)
+                library_id = new_lib_dict['id']
+                lh.write('Created new data library named "%s".\n' % run)
+    except Exception as e:
+        lh.write("\nError creating a data library for line %d, exception:\n%s\n" % (i, str(e)))
+        lh.write("Here is the line:\n")
+        lh.write("%s\n" % line)
+        return None
+    try:
+        # Create a folder for the current sample.
+        if sample not in folder_ids:
+            new_folder_dict = gi.libraries.create_folder(library_id, sample)[0]
+            folder_ids[sample] = new_folder_dict['id']
+            lh.write('Created new data library folder named "%s".\n' % sample)
+        folder_id = folder_ids[sample]
+    except Exception as e:
+        lh.write("\nError creating a folder for line %d, exception:\n%s\n" % (i, str(e)))
+        lh.write("Here is the line:\n")
+        lh.write("%s\n" % line)
+        return None
+    try:
+        # Import all datasets contained within prep_directory for the current sample
+        # into the sample folder within the data library.
+        # The trailing underscore keeps e.g. sample 1 from matching sample 10.
+        fpaths = []
+        for f in prep_fastq_files:
+            if not f.startswith('%s-%s_' % (run, sample)):
+                continue
+            fpath = os.path.join(prep_directory, f)
+            dataset_id = library_dataset_ids.get((sample, f), None)
+            if dataset_id is not None:
+                # Skip datasets that are already in the folder unless
+                # they differ from the file (in which case they are
+                # deleted).
+                manifest_entry = fastq_util.get_manifest_entry(fastq_manifest, fpath)
+                state = data_library_util.reconcile_library_dataset(gi,
+                                                                    library_id,
+                                                                    dataset_id,
+                                                                    fpath,
+                                                                    lh,
+                                                                    verify_checksum=verify_checksums,
+                                                                    manifest_entry=manifest_entry)
+                if state is not None:
+                    if state != 'ok':
+                        uploaded_dataset_ids.append(dataset_id)
+                    continue
+            fpaths.append(fpath)
+        if link_data_only and fpaths:
+            # Register all of the sample's datasets in place with a single
+            # request so that Galaxy does not copy them.  This requires the
+            # Galaxy setting allow_library_path_paste and the prep_directory
+            # to be readable by Galaxy using the same path.
+            lh.write('Linking %d datasets to folder %s of library %s using paths\n%s\n' % (len(fpaths), sample, run, '\n'.join(fpaths)))
+            populate_folder_dict = gi.libraries.upload_from_galaxy_filesystem(library_id,
+                                                                              '\n'.join(fpaths),
+                                                                              folder_id=folder_id,
+                                                                              file_type='fastqsanger',
+                                                                              dbkey='?',
+                                                                              link_data_only='link_to_files')
+            lh.write("\nResponse from linking datasets:\n%s\n\n" % str(populate_folder_dict))
+            for uploaded_dataset_dict in populate_folder_dict:
+                uploaded_dataset_ids.append(uploaded_dataset_dict['id'])
+        elif fpaths:
+            for fpath in fpaths:
+                # Import the dataset into the folder using fpath - don't set dbkey
+                # since samples are not associated with a genome until mapping.
+                lh.write('Uploading dataset to folder %s of library %s using path\n%s.\n' % (sample, run, fpath))
+                populate_folder_dict = gi.libraries.upload_file_from_local_path(library_id,
+                                                                                fpath,
+                                                                                folder_id=folder_id,
+                                                                                file_type='fastqsanger',
+                                                                                dbkey='?')
+                lh.write("\nResponse from uploading dataset:\n%s\n\n" % str(populate_folder_dict))
+                # The response contains the library datasets whose
+                # states reflect the states of their upload jobs.
+                for uploaded_dataset_dict in populate_folder_dict:
+                    uploaded_dataset_ids.append(uploaded_dataset_dict['id'])
+    except Exception as e:
+        lh.write("\nError importing datasets into folder for line %d, exception:\n%s\n" % (i, str(e)))
+        lh.write("Here is the line:\n")
+        lh.write("%s\n" % line)
+        return None
+    return uploaded_dataset_ids
+
+
+# The parsed lines of the cegr_run_info file.
+sample_lines = []
 current_run_dir = None
-uploading_datasets = False
 
 with open(cegr_run_info_file, 'r') as fh:
     for i, line in enumerate(fh):
@@ -80,60 +215,142 @@ with open(cegr_run_info_file, 'r') as fh:
             lh.write("Here is the line:\n")
             lh.write("%s\n" % line)
             continue
-        try:
-            if len(created_library_names) == 0:
-                # Create a data library.
-                if data_lib_desc == '':
-                    data_lib_desc = None
-                if data_lib_syn == '':
-                    data_lib_syn = None
-                new_lib_dict = gi.libraries.create_library(run, data_lib_desc, data_lib_syn)
-                # Create a folder for the current sample.
-                library_id = new_lib_dict['id']
-                lh.write('Created new data library named "%s".\n' % run)
-                created_library_names.append(run)
-        except Exception as e:
-            lh.write("\nError creating a data library for line %d, exception:\n%s\n" % (i, str(e)))
-            lh.write("Here is the line:\n")
-            lh.write("%s\n" % line)
-            continue
-        try:
-            if sample not in created_folder_names:
-                new_folder_dict = gi.libraries.create_folder(library_id, sample)[0]
-                folder_id = new_folder_dict['id']
-                lh.write('Created new data library folder named "%s".\n' % sample)
-                created_folder_names.append(sample)
-        except Exception as e:
-            lh.write("\nError creating a folder for line %d, exception:\n%s\n" % (i, str(e)))
-            lh.write("Here is the line:\n")
-            lh.write("%s\n" % line)
+        sample_lines.append((i, line, run, sample, data_lib_desc, data_lib_syn))
+
+# Each sample that finishes is recorded for the start_workflows.py
+# step, which starts its workflows right away if it is streaming.
+pipeline_state = pipeline_util.get_pipeline_state(config, log_dir, current_run_folder)
+pipeline_state.reset_stage(SCRIPT_NAME)
+pipeline_state.start_stage(SCRIPT_NAME)
+previous_stage = pipeline_util.get_previous_stage(SCRIPT_NAME)
+if args.stream:
+    # Upload the datasets of each sample as soon as the bcl2fastq step
+    # has validated them, and record the sample as finished as soon as
+    # its datasets are ok, while the other samples are still in earlier
+    # stages.
+    failed_samples = []
+    waiting_lines = list(sample_lines)
+    # The ids of the datasets of each sample that are not yet ok and the
+    # time their upload started, keyed by sample.
+    pending_samples = {}
+    # The folder of each pending dataset, found when its state is first polled.
+    dataset_folder_ids = {}
+    start = time.time()
+    interval = pipeline_poll_min_interval
+    while waiting_lines or pending_samples:
+        progress = False
+        if waiting_lines:
+            ready_samples = pipeline_state.get_finished_samples(previous_stage, [tup[3] for tup in waiting_lines])
+            if not ready_samples and time.time() - start > pipeline_max_wait:
+                lh.write('\nSamples %s were not validated within %d seconds.\n' % (', '.join(tup[3] for tup in waiting_lines), pipeline_max_wait))
+                ready_samples = dict((tup[3], pipeline_util.FAILED) for tup in waiting_lines)
+            if ready_samples:
+                progress = True
+                # Index the files that are now in the prep directory.
+                prep_fastq_files = sorted(f for f in os.listdir(prep_directory) if f.endswith('.fastq.gz'))
+                fastq_manifest = fastq_util.read_manifest(prep_directory)
+            for tup in list(waiting_lines):
+                sample = tup[3]
+                if sample not in ready_samples:
+                    continue
+                waiting_lines.remove(tup)
+                if ready_samples[sample] == pipeline_util.FAILED:
+                    lh.write('\nSkipping sample %s since the %s step failed for it.\n' % (sample, previous_stage))
+                    failed_samples.append(sample)
+                    pipeline_state.mark_sample(SCRIPT_NAME, sample, failed=True, error='The %s step failed' % previous_stage)
+                    continue
+                pipeline_state.start_sample(SCRIPT_NAME, sample)
+                uploaded_dataset_ids = send_sample_data(*tup)
+                if uploaded_dataset_ids is None:
+                    failed_samples.append(sample)
+                    pipeline_state.mark_sample(SCRIPT_NAME, sample, failed=True, error='Sending the data failed')
+                elif not uploaded_dataset_ids:
+                    pipeline_state.mark_sample(SCRIPT_NAME, sample)
+                else:
+                    pending_samples[sample] = (uploaded_dataset_ids, time.time())
+        if pending_samples:
+            states = data_library_util.get_library_dataset_states(gi,
+                                                                   library_id,
+                                                                   [dataset_id for ids, started in pending_samples.values() for dataset_id in ids],
+                                                                   dataset_folder_ids=dataset_folder_ids)
+            for sample, (uploaded_dataset_ids, started) in list(pending_samples.items()):
+                error_ids = [dataset_id for dataset_id in uploaded_dataset_ids if states[dataset_id] in data_library_util.ERROR_STATES]
+                pending_ids = [dataset_id for dataset_id in uploaded_dataset_ids if states[dataset_id] != 'ok']
+                error = None
+                if error_ids:
+                    error = 'Data library upload jobs failed for sample %s datasets: %s' % (sample, ', '.join(error_ids))
+                elif pending_ids and time.time() - started > upload_max_wait:
+                    error = 'Data library upload jobs did not finish within %d seconds for sample %s datasets: %s' % (upload_max_wait, sample, ', '.join(pending_ids))
+                elif pending_ids:
+                    continue
+                else:
+                    lh.write('All data library upload jobs finished for sample %s.\n' % sample)
+                progress = True
+                del pending_samples[sample]
+                if error is not None:
+                    lh.write('\n%s\n' % error)
+                    failed_samples.append(sample)
+                pipeline_state.mark_sample(SCRIPT_NAME, sample, failed=error is not None, error=error)
+        if not waiting_lines and not pending_samples:
+            break
+        if progress:
+            interval = pipeline_poll_min_interval
+        time.sleep(interval)
+        if not progress:
+            interval = min(interval * 2, pipeline_poll_max_interval)
+    if failed_samples:
+        msg = 'Sending data to Galaxy failed for samples: %s\n' % ', '.join(failed_samples)
+        pipeline_state.mark_stage(SCRIPT_NAME, failed=True, error=msg.strip())
+        lh.write('\n%s' % msg)
+        api_util.close_log_file(lh, SCRIPT_NAME)
+        # Exit without creating the script complete file so that this step
+        # is repeated for the run (workflows were started only for the
+        # samples that succeeded).
+        api_util.stop_err(msg)
+    pipeline_state.mark_stage(SCRIPT_NAME)
+else:
+    # Index the datasets produced by the bcl2fastq step once rather than
+    # for each line.  It created file names like this: 62401_S1_R1_001.fastq.gz
+    prep_fastq_files = sorted(f for f in os.listdir(prep_directory) if f.endswith('.fastq.gz'))
+    # The sizes and checksums of the files computed by the bcl2fastq step.
+    fastq_manifest = fastq_util.read_manifest(prep_directory)
+    uploaded_dataset_ids = []
+    # The ids of the datasets that are not yet ok keyed by sample.
+    sample_dataset_ids = {}
+    for tup in sample_lines:
+        pipeline_state.start_sample(SCRIPT_NAME, tup[3])
+        sample_uploaded_dataset_ids = send_sample_data(*tup)
+        if sample_uploaded_dataset_ids is None:
+            pipeline_state.mark_sample(SCRIPT_NAME, tup[3], failed=True, error='Sending the data failed')
             continue
-        try:
-            # Import all datasets contained within prep_directory for the current sample
-            # into the sample folder within the data library.  The bcl2fastq step created
-            # file names like this: 62401_S1_R1_001.fastq.gz
-            for f in os.listdir(prep_directory):
-                if f.startswith('%s-%s' % (run, sample)) and f.endswith('.fastq.gz'):
-                    fpath = os.path.join(prep_directory, f)
-                    # Import the dataset into the folder using fpath - don't set dbkey
-                    # since samples are not associated with a genome until mapping.
-                    lh.write('Uploading dataset to folder %s of library %s using path\n%s.\n' % (sample, run, fpath))
-                    populate_folder_dict = gi.libraries.upload_file_from_local_path(library_id,
-                                                                                    fpath,
-                                                                                    folder_id=folder_id,
-                                                                                    file_type='fastqsanger',
-                                                                                    dbkey='?')
-                    lh.write("\nResponse from uploading dataset:\n%s\n\n" % str(populate_folder_dict))
-                    if not uploading_datasets:
-                        uploading_datasets = True
-        except Exception as e:
-            lh.write("\nError importing datasets into folder for line %d, exception:\n%s\n" % (i, str(e)))
-            lh.write("Here is the line:\n")
-            lh.write("%s\n" % line)
-if uploading_datasets:
-    lh.write('\nSleeping for 30 minutes to make sure the data library upload jobs are finished...\n')
-    time.sleep(1800)
-    lh.write('Awake now...\n')
+        sample_dataset_ids[tup[3]] = sample_uploaded_dataset_ids
+        uploaded_dataset_ids.extend(sample_uploaded_dataset_ids)
+    if uploaded_dataset_ids:
+        lh.write('\nWaiting for the %d data library upload jobs to finish...\n' % len(uploaded_dataset_ids))
+        error_ids, pending_ids = data_library_util.wait_for_library_datasets(gi,
+                                                                             library_id,
+                                                                             uploaded_dataset_ids,
+                                                                             lh,
+                                                                             max_wait=upload_max_wait,
+                                                                             min_interval=upload_poll_min_interval,
+                                                                             max_interval=upload_poll_max_interval)
+        if error_ids or pending_ids:
+            if error_ids:
+                msg = 'Data library upload jobs failed for datasets: %s\n' % ', '.join(error_ids)
+            else:
+                msg = 'Data library upload jobs did not finish within %d seconds for datasets: %s\n' % (upload_max_wait, ', '.join(pending_ids))
+            lh.write('\n%s' % msg)
+            api_util.close_log_file(lh, SCRIPT_NAME)
+            for sample in sample_dataset_ids:
+                pipeline_state.mark_sample(SCRIPT_NAME, sample, failed=True, error=msg.strip())
+            pipeline_state.mark_stage(SCRIPT_NAME, failed=True, error=msg.strip())
+            # Exit without creating the script complete file so
+            # that workflows are not started for this run.
+            api_util.stop_err(msg)
+        lh.write('All data library upload jobs finished.\n')
+    for sample in sample_dataset_ids:
+        pipeline_state.mark_sample(SCRIPT_NAME, sample)
+    pipeline_state.mark_stage(SCRIPT_NAME)
 api_util.close_log_file(lh, SCRIPT_NAME)
 # Let everyone know we've finished.
 api_util.create_script_complete_file(log_dir, SCRIPT_NAME)
@@ -3,6 +3,12 @@
 # Exit immediately if a sub-command exits with a non-zero status.
 set -e
 
+# Run as "start_processing.sh pipeline" to run the bcl2fastq, send data to
+# Galaxy and start workflows steps at the same time so that each sample moves
+# on to the next step as soon as it is ready, recording the state of the run
+# so that it can be resumed (see run_pipeline.py and pipeline_status.py).
+MODE=$1
+
 cd `dirname $0`
 # Create the log directory if it doesn't exist.
 mkdir -p ../../log
@@ -19,6 +25,8 @@ SEND_DATA_TO_GALAXY_COMPLETE="../../log/send_data_to_galaxy.py.complete"
 START_WORKFLOWS_SCRIPT="./start_workflows.py"
 START_WORKFLOWS_COMPLETE="../../log/start_workflows.py.complete"
 
+RUN_PIPELINE_SCRIPT="./run_pipeline.py"
+
 if [ ! -f $COPY_RAW_DATA_COMPLETE ];
 then
     echo "########################"
@@ -29,6 +37,16 @@ then
     date
 fi
 
+if [ "$MODE" = "pipeline" ];
+then
+    echo "########################"
+    date
+    echo $RUN_PIPELINE_SCRIPT " starting..."
+    python $RUN_PIPELINE_SCRIPT
+    echo $RUN_PIPELINE_SCRIPT " finished..."
+    date
+fi
+
 if [ ! -f $BCL2FASTQ_COMPLETE ];
 then
     echo "########################"
@@ -2,12 +2,17 @@
 import sys
 sys.path.insert(0, '../../util')
 import api_util
-import data_library_util
+import config_util
 import history_util
+import lookup_cache_util
+import pipeline_util
+import rate_limit_util
 import workflow_util
 import argparse
 import os
-import time
+import Queue
+import StringIO
+import threading
 # If this Galaxy instance uses a virtual environment,
 # activate it so we can import Galaxy from bioblend.
 api_util.activate_virtual_env('PREP_VIRTUAL_ENV')
@@ -41,6 +46,11 @@ This script requires the following conditions to function as expected.
    (e.g., R1) that is contained within the names of the input dataset (e.g.,
    60642_R1.fq).
 
+With the "-s" command line parameter, this script runs at the same time as
+send_data_to_galaxy.py (see run_pipeline.py), starting the workflows for each
+sample as soon as its library datasets are ok.  Samples whose workflows were
+started by a previous execution are skipped.
+
 Example of use: start_workflow.py
 """
 
@@ -52,7 +62,9 @@ parser.add_argument("-b", "--blacklist_filter_library_name", dest="blacklist_fil
 parser.add_argument("-c", "--cegr_run_info_file", dest="cegr_run_info_file", default=None, help="File contain run information")
 parser.add_argument("-i", "--history_name_id", dest="history_name_id", default="001", help="Galaxy history name identifier")
 parser.add_argument("-l", "--log_file", dest="log_file", default=None, help="File for storing logging output")
+parser.add_argument("-n", "--num_workers", dest="num_workers", type=int, default=None, help="Number of samples for which workflows are prepared and started concurrently")
 parser.add_argument("-r", "--raw_data_directory", dest="raw_data_directory", default=None, help="Directory containing datasets produced by the sequencer")
+parser.add_argument("-s", "--stream", dest="stream", action="store_true", default=False, help="Start the workflows for each sample as soon as its data is in Galaxy")
 parser.add_argument("-u", "--galaxy_base_url", dest="galaxy_base_url", default=None, help="Galaxy base URL")
 parser.add_argument("-v", "--workflow_version", dest="workflow_version", default="001", help="Galaxy workflow version")
 parser.add_argument("-w", "--remote_workflow_config_dir_name", dest="remote_workflow_config_dir_name", default=None, help="Name of directory containing the workflow config XML files produced by PEGR")
@@ -64,7 +76,6 @@ cegr_run_info_file = api_util.get_value_or_default(args.cegr_run_info_file, 'RUN
 current_run_dir = api_util.get_current_run_directory(cegr_run_info_file)
 current_run_folder = os.path.basename(current_run_dir)
 galaxy_base_url = api_util.get_value_or_default(args.galaxy_base_url, 'GALAXY_BASE_URL')
-gi = galaxy.GalaxyInstance(url=galaxy_base_url, key=api_key)
 log_dir = api_util.get_value_or_default(None, 'ANALYSIS_PREP_LOG_FILE_DIR', is_path=True, create_dir=True)
 log_file = api_util.get_value_or_default(args.log_file, 'ANALYSIS_PREP_LOG_FILE', is_path=True)
 lh = api_util.open_log_file(log_file, SCRIPT_NAME)
@@ -74,11 +85,200 @@ workflow_config_directory = os.path.join(raw_data_directory, remote_workflow_con
 workflow_invocation_dbkeys = api_util.get_config_settings(type='workflow_invocation')
 workflow_names = api_util.get_config_settings(type='workflows')
 workflow_version = api_util.get_value_or_default(args.workflow_version, 'WORKFLOW_VERSION')
+config = config_util.get_config(api_util.CONFIG_FILE)
+# Paces requests that create or change things in Galaxy.
+rate_limiter = rate_limit_util.get_rate_limiter(config)
+ready_max_wait = config.get_int('GALAXY_READY_MAX_WAIT', default=600)
+num_workers = args.num_workers or config.get_int('WORKFLOW_LAUNCH_WORKERS', default=1)
+pipeline_max_wait = config.get_int('PIPELINE_MAX_WAIT', default=86400)
+pipeline_poll_min_interval = config.get_int('PIPELINE_POLL_MIN_INTERVAL', default=2)
+pipeline_poll_max_interval = config.get_int('PIPELINE_POLL_MAX_INTERVAL', default=60)
 
 NO_INVOCATION_DBKEYS = workflow_invocation_dbkeys['NO_INVOCATION']
 
+# Each worker thread uses its own Galaxy client.
+worker_data = threading.local()
+lh_lock = threading.Lock()
+# Galaxy items looked up for one sample are reused for the others.
+lookup_cache = lookup_cache_util.LookupCache()
+
+
+def get_galaxy_instance():
+    if not hasattr(worker_data, 'gi'):
+        worker_data.gi = galaxy.GalaxyInstance(url=galaxy_base_url, key=api_key)
+    return worker_data.gi
+
+
+def start_sample_workflows(i, run, sample, wf_config_files_str, lh):
+    """
+    Prepare and start the workflows for the sample on line i of the
+    cegr_run_info file.  Returns False if an error was encountered.
+    """
+    try:
+        gi = get_galaxy_instance()
+        wf_config_files = workflow_util.get_workflow_config_files(workflow_config_directory, wf_config_files_str)
+
+        # Get the data library for the run.
+        data_lib_id = lookup_cache.get_data_library(gi, run, lh)
+        if data_lib_id is None:
+            lh.write('Skipping invalid line %d, it contains run %s but no data library with that name exists.\n' % (i, run))
+            return True
+
+        # Get the blacklist filter data library.
+        blacklist_library_id = lookup_cache.get_data_library(gi, blacklist_filter_library_name, lh)
+
+        # Get the folder named the value of the sample.
+        folder_id = lookup_cache.get_folder(gi, data_lib_id, run, sample, lh)
+        if folder_id is None:
+            lh.write('Skipping invalid line %d, it contains sample %s but no folder with that name exists.\n' % (i, sample))
+            return True
+
+        # Get the workflow name.
+        workflow_name, num_datasets = workflow_util.select_workflow(gi, folder_id, workflow_names, sample, run, lh)
+        if workflow_name is None:
+            lh.write('Skipping sample %s since the data library folder contains %d datasets when it should contain only 1 or 2.\n' % (sample, num_datasets))
+            return True
+
+        # Get the datasets from the current sample folder.
+        lib_input_datasets = lookup_cache.get_sample_datasets(gi, data_lib_id, sample, run, lh, num_datasets=num_datasets)
+
+        # Prepare and execute a workflow for each wf_config_file.
+        for wf_config_file in wf_config_files:
+            dbkey, params = workflow_util.parse_workflow_config(wf_config_file, lh)
+            if dbkey is None and params is None:
+                lh.write('Skipping line %d since workflow config %s is either missing or invalid.\n' % (i, wf_config_file))
+            if dbkey in NO_INVOCATION_DBKEYS:
+                lh.write('Skipping line %d containing workflow config %s with dbkey %s because workflows are not to be executed for that dbkey.\n' % (i, wf_config_file, dbkey))
+                continue
+            lh.write('\nPreparing analysis pipeline for workflow config file %s.\n' % wf_config_file)
+            blacklist_filter_dataset_id = lookup_cache.get_blacklist_filter_dataset_id(gi, blacklist_library_id, dbkey, lh)
+            if blacklist_filter_dataset_id is None:
+                lh.write('Skipping line %d containing workflow config %s with dbkey %s since no blacklist filter dataset for that dbkey exists but one is required.\n' % (i, wf_config_file, dbkey))
+                continue
+
+            # Get the workflow.
+            workflow_id, workflow_dict = lookup_cache.get_workflow(gi, workflow_name, lh)
+            if workflow_id is None:
+                lh.write('Skipping invalid line %d, it contains workflow config %s with invalid workflow name %s.\n' % (i, wf_config_file, workflow_name))
+                continue
+
+            # Update the params if possible.
+            # TODO: this is extremely brittle and should be eliminated asap.
+            params = workflow_util.update_workflow_params(dbkey, workflow_dict, params, lh)
+
+            # Create a new history to contain the analysis
+            history_name, history_id = rate_limiter.call(history_util.create_history,
+                                                         gi,
+                                                         dbkey,
+                                                         workflow_name,
+                                                         run,
+                                                         sample,
+                                                         args.history_name_id,
+                                                         lh)
+            history_util.wait_for_history(gi, history_id, history_name, lh, max_wait=ready_max_wait)
+
+            history_input_datasets = {}
+            # Add the blacklist filter dataset to the new history.
+            history_input_datasets = rate_limiter.call(history_util.add_library_dataset_to_history,
+                                                       gi,
+                                                       dbkey,
+                                                       history_id,
+                                                       history_name,
+                                                       blacklist_filter_dataset_id,
+                                                       history_input_datasets,
+                                                       lh)
+
+            # Populate the history with the input datasets for the sample.
+            for input_dataset_id, input_dataset_name in lib_input_datasets.items():
+                history_input_datasets = rate_limiter.call(history_util.add_library_dataset_to_history,
+                                                           gi,
+                                                           dbkey,
+                                                           history_id,
+                                                           history_name,
+                                                           input_dataset_id,
+                                                           history_input_datasets,
+                                                           lh)
+            # The imported datasets must be ready before their dbkey can be set.
+            history_util.wait_for_datasets(gi,
+                                           history_id,
+                                           history_name,
+                                           [hda_dict['id'] for hda_dict in history_input_datasets.values()],
+                                           lh,
+                                           max_wait=ready_max_wait)
+            history_input_datasets = rate_limiter.call(history_util.update_dataset,
+                                                       gi,
+                                                       dbkey,
+                                                       history_id,
+                                                       history_name,
+                                                       history_input_datasets,
+                                                       lh)
+
+            # Map the history datasets to the input datasets for the workflow.
+            inputs = workflow_util.get_workflow_input_datasets(gi,
+                                                               history_name,
+                                                               history_input_datasets,
+                                                               workflow_name,
+                                                               dbkey,
+                                                               galaxy_base_url,
+                                                               api_key,
+                                                               lh,
+                                                               lookup_cache=lookup_cache)
+            lh.write("inputs:\n%s\n" % str(inputs))
+
+            # Start the workflow.
+            workflow_invocation_dict = rate_limiter.call(workflow_util.start_workflow,
+                                                         gi,
+                                                         workflow_id,
+                                                         workflow_name,
+                                                         inputs,
+                                                         params,
+                                                         history_id,
+                                                         lh)
+            # Let Galaxy begin scheduling this invocation before
+            # preparing the next one.
+            workflow_util.wait_for_invocation(gi,
+                                              workflow_id,
+                                              workflow_name,
+                                              workflow_invocation_dict,
+                                              lh,
+                                              max_wait=ready_max_wait)
+    except Exception, e:
+        lh.write('\nError encountered in script start_workflows.py.\n')
+        lh.write('%s\n' % str(e))
+        return False
+    return True
+
+
+def start_workflows_worker(sample_queue, results):
+    while True:
+        item = sample_queue.get()
+        if item is None:
+            # No more samples will be queued.
+            return
+        i, run, sample, wf_config_files_str = item
+        # Log to a per-sample section that is written to the shared log
+        # file once the sample is finished so that the output of samples
+        # being processed concurrently is not interleaved.
+        sample_lh = StringIO.StringIO()
+        try:
+            pipeline_state.start_sample(SCRIPT_NAME, sample)
+            result = start_sample_workflows(i, run, sample, wf_config_files_str, sample_lh)
+            results.append(result)
+            pipeline_state.mark_sample(SCRIPT_NAME, sample, failed=not result)
+        finally:
+            with lh_lock:
+                lh.write('\n###############################################################################\n')
+                lh.write('Sample %s of run %s (line %d)\n' % (sample, run, i))
+                lh.write('###############################################################################\n')
+                lh.write(sample_lh.getvalue())
+
+
+run = None
 run_dir_processed = False
 can_archive_cegr_run_info_file = True
+sample_queue = Queue.Queue()
+# The parsed lines of the cegr_run_info file.
+sample_lines = []
 
 with open(cegr_run_info_file, 'r') as fh:
     for i, line in enumerate(fh):
@@ -104,131 +304,65 @@ with open(cegr_run_info_file, 'r') as fh:
                 run, sample, indexes_str, wf_config_files_str, ext, data_lib_desc, data_lib_syn = tup
             else:
                 continue
-            indexes = indexes_str.split(',')
-            wf_config_files = workflow_util.get_workflow_config_files(workflow_config_directory, wf_config_files_str)
-
-            # Get the data library for the run.
-            data_lib_id = data_library_util.get_data_library(gi, run, lh)
-            if data_lib_id is None:
-                lh.write('Skipping invalid line %d, it contains run %s but no data library with that name exists.\n' % (i, run))
-                continue
-
-            # Get the blacklist filter data library.
-            blacklist_library_id = data_library_util.get_data_library(gi, blacklist_filter_library_name, lh)
-
-            # Get the folder named the value of the sample.
-            folder_id = data_library_util.get_folder(gi, data_lib_id, run, sample, lh)
-            if folder_id is None:
-                lh.write('Skipping invalid line %d, it contains sample %s but no folder with that name exists.\n' % (i, sample))
-                continue
-
-            # Get the workflow name.
-            workflow_name, num_datasets = workflow_util.select_workflow(gi, folder_id, workflow_names, sample, run, lh)
-            if workflow_name is None:
-                lh.write('Skipping sample %s since the data library folder contains %d datasets when it should contain only 1 or 2.\n' % (sample, num_datasets))
-                continue
-
-            # Get the datasets from the current sample folder.
-            lib_input_datasets = data_library_util.get_sample_datasets(gi, data_lib_id, sample, run, lh)
-
-            # Prepare and execute a workflow for each wf_config_file.
-            for wf_config_file in wf_config_files:
-                dbkey, params = workflow_util.parse_workflow_config(wf_config_file, lh)
-                if dbkey is None and params is None:
-                    lh.write('Skipping line %d since workflow config %s is either missing or invalid.\n' % (i, wf_config_file))
-                if dbkey in NO_INVOCATION_DBKEYS:
-                    lh.write('Skipping line %d containing workflow config %s with dbkey %s because workflows are not to be executed for that dbkey.\n' % (i, wf_config_file, dbkey))
-                    continue
-                lh.write('\nPreparing analysis pipeline for workflow config file %s.\n' % wf_config_file)
-                blacklist_filter_dataset_id = data_library_util.get_blacklist_filter_dataset_id(gi, blacklist_library_id, dbkey, lh)
-                if blacklist_filter_dataset_id is None:
-                    lh.write('Skipping line %d containing workflow config %s with dbkey %s since no blacklist filter dataset for that dbkey exists but one is required.\n' % (i, wf_config_file, dbkey))
-                    continue
-
-                # Get the workflow.
-                workflow_id, workflow_dict = workflow_util.get_workflow(gi, workflow_name, lh)
-                if workflow_id is None:
-                    lh.write('Skipping invalid line %d, it contains workflow config %s with invalid workflow name %s.\n' % (i, wf_config_file, workflow_name))
-                    continue
-
-                # Update the params if possible.
-                # TODO: this is extremely brittle and should be eliminated asap.
-                params = workflow_util.update_workflow_params(dbkey, workflow_dict, params, lh)
-                lh.write("Sleeping for 10 seconds...\n")
-                time.sleep(10)
-
-                # Create a new history to contain the analysis
-                history_name, history_id = history_util.create_history(gi,
-                                                                       dbkey,
-                                                                       workflow_name,
-                                                                       run,
-                                                                       sample,
-                                                                       args.history_name_id,
-                                                                       lh)
-                lh.write("Sleeping for 10 seconds...\n")
-                time.sleep(10)
-
-                history_input_datasets = {}
-                # Add the blacklist filter dataset to the new history.
-                history_input_datasets = history_util.add_library_dataset_to_history(gi,
-                                                                                     dbkey,
-                                                                                     history_id,
-                                                                                     history_name,
-                                                                                     blacklist_filter_dataset_id,
-                                                                                     history_input_datasets,
-                                                                                     lh)
-                lh.write("Sleeping for 10 seconds...\n")
-                time.sleep(10)
-
-                # Populate the history with the input datasets for the sample.
-                for input_dataset_id, input_dataset_name in lib_input_datasets.items():
-                    history_input_datasets = history_util.add_library_dataset_to_history(gi,
-                                                                                         dbkey,
-                                                                                         history_id,
-                                                                                         history_name,
-                                                                                         input_dataset_id,
-                                                                                         history_input_datasets,
-                                                                                         lh)
-                    lh.write("Sleeping for 10 seconds...\n")
-                    time.sleep(10)
-                history_input_datasets = history_util.update_dataset(gi,
-                                                                     dbkey,
-                                                                     history_id,
-                                                                     history_name,
-                                                                     history_input_datasets,
-                                                                     lh)
-
-                # Map the history datasets to the input datasets for the workflow.
-                inputs = workflow_util.get_workflow_input_datasets(gi,
-                                                                   history_name,
-                                                                   history_input_datasets,
-                                                                   workflow_name,
-                                                                   dbkey,
-                                                                   galaxy_base_url,
-                                                                   api_key,
-                                                                   lh)
-                lh.write("inputs:\n%s\n" % str(inputs))
-                lh.write("Sleeping for 10 seconds...\n")
-                time.sleep(10)
-
-                # Start the workflow.
-                workflow_util.start_workflow(gi,
-                                             workflow_id,
-                                             workflow_name,
-                                             inputs,
-                                             params,
-                                             history_id,
-                                             lh)
-                lh.write("Sleeping for 60 seconds...\n")
-                time.sleep(60)
+            sample_lines.append((i, run, sample, wf_config_files_str))
         except Exception, e:
             lh.write('\nError encountered in script start_workflows.py.\n')
             lh.write('%s\n' % str(e))
             can_archive_cegr_run_info_file = False
+
+# Record the state of this step and of each sample.
+pipeline_state = pipeline_util.get_pipeline_state(config, log_dir, current_run_folder)
+if not args.stream:
+    # Forget the samples finished by a previous execution.
+    pipeline_state.reset_stage(SCRIPT_NAME)
+pipeline_state.start_stage(SCRIPT_NAME)
+# Prepare and start the workflows for up to num_workers samples at a time.
+lh.write('Starting workflows for %d samples using %d workers.\n' % (len(sample_lines), num_workers))
+results = []
+workers = []
+for worker_index in range(max(num_workers, 1)):
+    worker = threading.Thread(target=start_workflows_worker, args=(sample_queue, results))
+    worker.start()
+    workers.append(worker)
+can_create_script_complete_file = True
+if args.stream:
+    # Queue each sample as soon as the send_data_to_galaxy.py step has
+    # finished with it, skipping those whose workflows were already started.
+    previous_stage = pipeline_util.get_previous_stage(SCRIPT_NAME)
+    waiting_lines = dict((tup[2], tup) for tup in sample_lines
+                         if pipeline_state.get_sample_state(SCRIPT_NAME, tup[2]) != pipeline_util.DONE)
+    if len(waiting_lines) < len(sample_lines):
+        lh.write('Skipping %d samples whose workflows were already started.\n' % (len(sample_lines) - len(waiting_lines)))
+    for sample, state in pipeline_state.wait_for_samples(previous_stage,
+                                                         waiting_lines.keys(),
+                                                         lh,
+                                                         max_wait=pipeline_max_wait,
+                                                         min_interval=pipeline_poll_min_interval,
+                                                         max_interval=pipeline_poll_max_interval):
+        if state == pipeline_util.FAILED:
+            with lh_lock:
+                lh.write('\nSkipping sample %s since the %s step failed for it.\n' % (sample, previous_stage))
+            pipeline_state.mark_sample(SCRIPT_NAME, sample, failed=True, error='The %s step failed' % previous_stage)
+            # Leave this step to be repeated once the data is in Galaxy.
+            can_create_script_complete_file = False
+            can_archive_cegr_run_info_file = False
+            continue
+        sample_queue.put(waiting_lines[sample])
+else:
+    for tup in sample_lines:
+        sample_queue.put(tup)
+for worker in workers:
+    sample_queue.put(None)
+for worker in workers:
+    worker.join()
+if not all(results):
+    can_archive_cegr_run_info_file = False
 api_util.close_log_file(lh, SCRIPT_NAME)
-if can_archive_cegr_run_info_file:
+if can_archive_cegr_run_info_file and run is not None:
     # This is the last step in the automated processing
     # pipeline, so archive the cegr_run_info.xml file.
     api_util.archive_file(cegr_run_info_file, run)
-# Let everyone know we've finished.
-api_util.create_script_complete_file(log_dir, SCRIPT_NAME)
+pipeline_state.mark_stage(SCRIPT_NAME, failed=not can_create_script_complete_file)
+if can_create_script_complete_file:
+    # Let everyone know we've finished.
+    api_util.create_script_complete_file(log_dir, SCRIPT_NAME)
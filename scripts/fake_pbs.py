@@ -0,0 +1,129 @@
+"""
+A stand-in for the PBS/Torque qsub, qstat and qdel commands that runs jobs
+as background processes on this host, so the pbs executor (see
+util/executor_util.py) can be tried without a cluster.  For example, set
+these in cegr_config.ini:
+
+EXECUTOR = pbs
+PBS_QSUB_COMMAND = python /path/to/scripts/fake_pbs.py qsub
+PBS_QSTAT_COMMAND = python /path/to/scripts/fake_pbs.py qstat
+PBS_QDEL_COMMAND = python /path/to/scripts/fake_pbs.py qdel
+
+Only the options used by the executor are supported.  The tasks of a job
+array (-t) are run at once with PBS_ARRAYID set.  Resource requests (-l) are
+accepted but ignored.  qstat always prints the job_state lines of qstat -f,
+and finished jobs stay in state C, as with Torque's keep_completed.  The
+process ids of each job are kept in the directory named by the FAKE_PBS_DIR
+environment variable (by default, fake_pbs in the temporary directory).
+"""
+import argparse
+import errno
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+STATE_DIR = os.environ.get('FAKE_PBS_DIR', os.path.join(tempfile.gettempdir(), 'fake_pbs'))
+
+
+def get_pids(job_id):
+    pids_file = os.path.join(STATE_DIR, '%s.pids' % job_id)
+    if not os.path.exists(pids_file):
+        return None
+    with open(pids_file) as fh:
+        return [int(pid) for pid in fh.read().split()]
+
+
+def is_running(pid):
+    try:
+        # The processes are not children of this process, so a finished task
+        # remains a zombie until the qsub process that started it exits.
+        with open('/proc/%d/stat' % pid) as fh:
+            return fh.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def qdel(args):
+    pids = get_pids(args.job_id)
+    if pids is None:
+        sys.stderr.write('qdel: Unknown Job Id %s\n' % args.job_id)
+        sys.exit(153)
+    for pid in pids:
+        if is_running(pid):
+            # Each task is the leader of its own process group.
+            os.killpg(pid, signal.SIGTERM)
+
+
+def qstat(args):
+    pids = get_pids(args.job_id)
+    if pids is None:
+        sys.stderr.write('qstat: Unknown Job Id %s\n' % args.job_id)
+        sys.exit(153)
+    # Finished jobs are kept in state C, as with Torque's keep_completed.
+    states = ['R' if is_running(pid) else 'C' for pid in pids]
+    if args.expand_arrays and args.job_id.endswith('[]'):
+        for index, state in enumerate(states):
+            print 'Job Id: %s\n    job_state = %s\n' % (args.job_id.replace('[]', '[%d]' % index), state)
+    else:
+        print 'Job Id: %s\n    job_state = %s\n' % (args.job_id, 'R' if 'R' in states else 'C')
+
+
+def qsub(args):
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    fd, pids_file = tempfile.mkstemp(dir=STATE_DIR, prefix='', suffix='.pids')
+    os.close(fd)
+    job_id = os.path.basename(pids_file)[:-len('.pids')]
+    indexes = [None]
+    if args.array:
+        # Any limit on the number of tasks running at once is ignored.
+        first, last = args.array.split('%')[0].split('-')
+        indexes = range(int(first), int(last) + 1)
+        job_id = '%s[]' % job_id
+    output = open(args.output or os.devnull, 'a')
+    pids = []
+    for index in indexes:
+        env = dict(os.environ)
+        env['PBS_JOBID'] = job_id
+        env['PBS_JOBNAME'] = args.name or os.path.basename(args.script)
+        if index is not None:
+            env['PBS_ARRAYID'] = str(index)
+        proc = subprocess.Popen(['bash', args.script], env=env, stdout=output, stderr=subprocess.STDOUT, preexec_fn=os.setpgrp)
+        pids.append(proc.pid)
+    output.close()
+    with open(pids_file, 'w') as fh:
+        fh.write('%s\n' % '\n'.join(str(pid) for pid in pids))
+    if args.array:
+        os.rename(pids_file, os.path.join(STATE_DIR, '%s.pids' % job_id))
+    print job_id
+
+
+parser = argparse.ArgumentParser(description='Run PBS jobs on this host')
+subparsers = parser.add_subparsers()
+qdel_parser = subparsers.add_parser('qdel')
+qdel_parser.add_argument('job_id')
+qdel_parser.set_defaults(func=qdel)
+qstat_parser = subparsers.add_parser('qstat')
+qstat_parser.add_argument("-f", dest="full", action="store_true", default=False)
+qstat_parser.add_argument("-t", dest="expand_arrays", action="store_true", default=False)
+qstat_parser.add_argument('job_id')
+qstat_parser.set_defaults(func=qstat)
+qsub_parser = subparsers.add_parser('qsub')
+qsub_parser.add_argument("-j", dest="join", default=None)
+qsub_parser.add_argument("-l", dest="resources", default=None)
+qsub_parser.add_argument("-N", dest="name", default=None)
+qsub_parser.add_argument("-o", dest="output", default=None)
+qsub_parser.add_argument("-q", dest="queue", default=None)
+qsub_parser.add_argument("-t", dest="array", default=None)
+qsub_parser.add_argument("-V", dest="export_env", action="store_true", default=False)
+qsub_parser.add_argument('script')
+qsub_parser.set_defaults(func=qsub)
+args = parser.parse_args()
+args.func(args)
@@ -3,47 +3,39 @@ Can be used from the command line to validate a directory of fastq files.
 For example:
 python validate_fastq.py -p /prep_dir/160630_NS500168_0158_AH5HGWBGXY -r 211
 
-The fastQValidator package is available here:
-http://genome.sph.umich.edu/w/images/2/20/FastQValidatorLibStatGen.0.1.1a.tgz
-Due to the way bcl2fastq compresses files (it does not include an end of file block),
-this enhancement was added manually to the ~/src/FastQValidator.cpp file: 
-https://github.com/statgen/fastQValidator/commit/0b7decb8b502cd8d9d6bf27dbd9e319ed8478b53.
-The package was then compiled normally.
+Files are validated by fastq_util, so no external validator is required.
+With the "-f" command line parameter, only the received file is validated
+and its validation results are printed as JSON, which is how bcl2fastq.py
+validates each file as a separate task of a job (see executor_util.py).
 """
 import sys
 sys.path.insert(0, '../util')
-import api_util
 import argparse
+import fastq_util
 import glob
+import json
 import os
-import subprocess
 
 parser = argparse.ArgumentParser(description='Validate fastq files')
-parser.add_argument("-f", "--fastq_validator_binary", dest="fastq_validator_binary", default=None, help="Path to fastQValidator")
+parser.add_argument("-f", "--fastq_file", dest="fastq_file", default=None, help="Fastq file whose validation results are printed as JSON")
 parser.add_argument("-p", "--prep_directory", dest="prep_directory", help="Full path to directory containing datasets produced by bcl2fastq")
 parser.add_argument("-r", "--run", dest="run", help="Run number")
 args = parser.parse_args()
 
+if args.fastq_file is not None:
+    try:
+        print json.dumps(fastq_util.validate_fastq(args.fastq_file), sort_keys=True)
+    except fastq_util.ValidatorError as e:
+        sys.stderr.write('%s\n' % str(e))
+        sys.exit(1)
+    sys.exit(0)
+
 ALL_VALID = True
-CONFIG_FILE = '../config/cegr_config.ini'
-CONFIG_SETTINGS = api_util.get_config_settings(CONFIG_FILE)
-FASTQ_VALIDATOR = CONFIG_SETTINGS['FASTQ_VALIDATOR_BINARY']
 MATCH_STR = '%s*.fastq.gz' % str(args.run)
 FILE_PATHS = os.path.join(args.prep_directory, MATCH_STR)
 FASTQ_FILES = glob.glob(FILE_PATHS)
 
 
-def execute_cmd(cmd):
-    proc = subprocess.Popen(args=cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-    rc = proc.wait()
-    return rc
-
-
-def is_valid_fastq(fastq_validator_binary, file_name):
-    cmd = '%s --noeof --file %s' % (fastq_validator_binary, file_name)
-    return execute_cmd(cmd)
-
-
 if len(FASTQ_FILES) == 0:
     print "\nThere are not fastq files in directory\n%s\nmatching string %s\n" % (args.prep_directory, MATCH_STR)
     sys.exit(1)
@@ -51,9 +43,14 @@ if len(FASTQ_FILES) == 0:
 for fastq_file in FASTQ_FILES:
     # bcl2fastq regularly generates empty files.
     if os.path.getsize(fastq_file) > 0:
-        rc = is_valid_fastq(FASTQ_VALIDATOR, fastq_file)
-        if rc != 0:
+        try:
+            result = fastq_util.validate_fastq(fastq_file)
+        except fastq_util.ValidatorError as e:
+            result = dict(valid=False, error='the file could not be validated: %s' % str(e))
+        if result['valid']:
+            print 'This file is valid, it contains %d reads and %d bases:\n%s\n' % (result['reads'], result['bases'], str(fastq_file))
+        else:
             ALL_VALID = False
-            print 'This file is invalid, response code is %d:\n%s\n' % (rc, str(fastq_file))
+            print 'This file is invalid, %s\n%s\n' % (result['error'], str(fastq_file))
 if ALL_VALID:
     print 'All files are valid!'
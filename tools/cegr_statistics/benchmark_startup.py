@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Measures the startup cost of each stats tool so that changes to the modules
+imported by stats_util can be evaluated.  Every measurement runs in a new
+Python process, just as Galaxy runs the stats tools, and the median wall time
+of --repeat runs is reported in milliseconds along with its cost over the
+bare interpreter startup.  Measured are the bare interpreter, importing
+stats_util, importing each of the heavy dependencies that stats_util imports
+only when a statistic needs them, and running each stats tool with --help
+(which imports everything the tool imports before doing any work).
+
+Example of use:
+python benchmark_startup.py --repeat 10
+"""
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+# Dependencies that stats_util imports only when they are needed.
+LAZY_DEPENDENCIES = ['bioblend.galaxy', 'http_util', 'numpy', 'uuid']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--python', dest='python', default=sys.executable, help='Python interpreter used by Galaxy to run the stats tools')
+parser.add_argument('--repeat', dest='repeat', type=int, default=5, help='Number of runs per measurement')
+args = parser.parse_args()
+
+TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_command(cmd):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(args.repeat):
+            start = time.time()
+            subprocess.call(cmd, cwd=TOOL_DIR, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000)
+    return get_median(times)
+
+
+measurements = [('python (no imports)', [args.python, '-c', 'pass']),
+                ('import stats_util', [args.python, '-c', 'import stats_util'])]
+for dependency in LAZY_DEPENDENCIES:
+    measurements.append(('import %s' % dependency, [args.python, '-c', 'import %s' % dependency]))
+for tool in sorted(glob.glob(os.path.join(TOOL_DIR, '*_output_stats*.py'))):
+    measurements.append((os.path.basename(tool), [args.python, tool, '--help']))
+
+baseline = None
+print '%-50s %10s %10s' % ('Measurement', 'ms', '+ms')
+for name, cmd in measurements:
+    ms = time_command(cmd)
+    if baseline is None:
+        baseline = ms
+    print '%-50s %10.1f %10.1f' % (name, ms, ms - baseline)
@@ -4,8 +4,6 @@ import stats_util
 
 STATS = ['dedupUniquelyMappedReadsSingle', 'mappedReadsSingle', 'totalReadsSingle', 'uniquelyMappedReadsSingle']
 
-stats_util.check_samtools()
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--config_file', dest='config_file', help='stats_config.ini')
 parser.add_argument('--dbkey', dest='dbkey', help='Input dbkey')
@@ -14,6 +12,7 @@ parser.add_argument('--history_name', dest='history_name', help='History name')
 parser.add_argument('--input', dest='input', help='Input dataset')
 parser.add_argument('--input_datatype', dest='input_datatype', help='Input dataset datatype')
 parser.add_argument('--input_id', dest='input_id', help='Encoded input dataset id')
+parser.add_argument('--input_index', dest='input_index', default=None, help='BAM index (.bai) of the input dataset')
 parser.add_argument('--output', dest='output', help='Output dataset')
 parser.add_argument('--stats_tool_id', dest='stats_tool_id', help='The caller of this script')
 parser.add_argument('--stderr', dest='stderr', help='Job stderr')
@@ -26,7 +25,7 @@ args = parser.parse_args()
 # Initialize the payload.
 payload = stats_util.get_base_json_dict(args.config_file, args.dbkey, args.history_id, args.history_name, args.stats_tool_id, args.stderr, args.tool_id, args.tool_parameters, args.user_email, args.workflow_step_id)
 # Generate the statistics and datasets.
-payload['statistics'] = [stats_util.get_statistics(args.input, STATS)]
+payload['statistics'] = [stats_util.get_statistics(args.input, STATS, index_file=args.input_index)]
 payload['datasets'] = [stats_util.get_datasets(args.config_file, args.input_id, args.input_datatype)]
 payload['history_url'] = stats_util.get_history_url(args.config_file, args.history_id)
 # Send the payload to PEGR.
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Sends the statistics payloads queued by the stats tools in the PEGR outbox
+(the PEGR_OUTBOX_DIR setting in stats_config.ini) to PEGR in batches of up to
+--batch_size payloads, one request per payload.  By default the outbox is
+flushed once, which is suitable for cron.  With --daemon the outbox is flushed
+every --interval seconds, backing off exponentially (with jitter) up to
+--max_interval seconds while PEGR is unavailable or the flush fails.
+
+Example of use:
+python flush_pegr_outbox.py --config_file stats_config.ini --daemon
+"""
+import argparse
+import random
+import sys
+import time
+import stats_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=100, help='Maximum number of payloads sent per batch')
+parser.add_argument('--config_file', dest='config_file', default='stats_config.ini', help='stats_config.ini')
+parser.add_argument('--daemon', dest='daemon', action='store_true', default=False, help='Keep flushing the outbox')
+parser.add_argument('--interval', dest='interval', type=int, default=60, help='Seconds between flushes in daemon mode')
+parser.add_argument('--max_interval', dest='max_interval', type=int, default=3600, help='Maximum seconds between flushes while PEGR is unavailable')
+args = parser.parse_args()
+
+failures = 0
+while True:
+    try:
+        results = stats_util.flush_pegr_outbox(args.config_file, batch_size=args.batch_size)
+        print '%s: sent %d, rejected %d, %d remaining.' % (time.strftime('%Y-%m-%d %H:%M:%S'), results['sent'], results['rejected'], results['remaining'])
+        error = results['error']
+        if error is not None:
+            error = 'PEGR is likely unavailable, response:\n%s' % error
+    except Exception as e:
+        # Keep the daemon running so that the flush is retried.
+        error = '%s: flushing the outbox failed: %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), str(e))
+    if error is None:
+        failures = 0
+        if results['remaining'] > 0:
+            # Send the next batch right away.
+            continue
+        if not args.daemon:
+            break
+        delay = args.interval
+    else:
+        print error
+        if not args.daemon:
+            sys.exit(1)
+        failures += 1
+        delay = min(args.interval * 2 ** failures, args.max_interval)
+    sys.stdout.flush()
+    time.sleep(random.uniform(0.5, 1.0) * delay)
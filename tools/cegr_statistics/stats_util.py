@@ -1,19 +1,27 @@
+"""
+Utility functions shared by the CEGR statistics tools.
+
+Each stats tool runs in a new Python process, and most tools need neither
+numpy nor bioblend, so only lightweight standard library modules are imported
+here.  Heavier dependencies are imported by the functions that use them.
+"""
+import config_util
+import fcntl
 import fileinput
 import json
-import numpy
 import os
-import shlex
+import re
 import string
-import subprocess
+import struct
 import sys
 import tempfile
+import time
 
-from ConfigParser import ConfigParser
-from six.moves.urllib.error import HTTPError, URLError
-from six.moves.urllib.request import Request, urlopen
-from six import string_types
-from bioblend import galaxy
-
+try:
+    # Avoids importing six just for this.
+    STRING_TYPES = basestring
+except NameError:
+    STRING_TYPES = str
 
 # Allows characters that are escaped to be un-escaped.
 MAPPED_CHARS = {'>': '__gt__',
@@ -29,15 +37,55 @@ MAPPED_CHARS = {'>': '__gt__',
                 '\r': '__cr__',
                 '\t': '__tc__',
                 '#': '__pd__'}
+# The BAM index pseudo-bin containing per-reference mapped/unmapped counts.
+BAM_INDEX_PSEUDO_BIN = 37450
 # Maximum value of a signed 32 bit integer (2**31 - 1).
 MAX_GENOME_SIZE = 2147483647
+# Subdirectories of the PEGR outbox containing payloads waiting to be sent
+# and payloads that PEGR rejected.
+PEGR_OUTBOX_QUEUED = 'queued'
+PEGR_OUTBOX_REJECTED = 'rejected'
+# The file in the PEGR outbox that is locked while the outbox is flushed.
+PEGR_OUTBOX_LOCK_FILE = 'flush.lock'
+# Default workflow id cache directory (in the system's temporary directory),
+# cache file (relative to the cache directory) and the number of seconds its
+# entries remain valid.  Workflows that do not exist in Galaxy are cached for
+# a shorter time since they may be imported at any time.
+WORKFLOW_ID_CACHE_DIR = 'cegr_statistics'
+WORKFLOW_ID_CACHE_FILE = 'workflow_id_cache.json'
+WORKFLOW_ID_CACHE_MISS_TTL = 600
+WORKFLOW_ID_CACHE_TTL = 86400
+# Size in bytes of the blocks read when counting lines.
+LINE_COUNT_BLOCK_SIZE = 1048576
+# Size in bytes of the chunks in which gff files are parsed.
+GFF_CHUNK_SIZE = 8388608
+# Matches the score (column 6) of each gff line.
+GFF_SCORE_RE = re.compile(r'^(?:[^\t\n]*\t){5}([^\t\n]*)\t(?:[^\t\n]*\t){2}', re.M)
+# Matches the score and the value of the first attribute starting with stddev
+# (column 9) of each gff line that has one.
+GFF_STDDEV_RE = re.compile(r'^(?:[^\t\n]*\t){5}([^\t\n]*)\t(?:[^\t\n]*\t){2}(?:[^\t\n;]*;)*?stddev[^\t\n;=]*=([^\t\n;=]*)', re.M)
+# Maps each BAM statistic to the payload key it populates along with the
+# samtools view filters that define it: the flags that must all be set (-f),
+# the flags that must all be unset (-F) and the minimum MAPQ (-q).
+BAM_STATS = {'dedupUniquelyMappedReads': ('dedupUniquelyMappedReads', 0x41, 0x404, 5),
+             'dedupUniquelyMappedReadsSingle': ('dedupUniquelyMappedReads', 0, 0x4, 5),
+             'mappedReads': ('mappedReads', 0x40, 0x4, 0),
+             'mappedReadsSingle': ('mappedReads', 0, 0x4, 0),
+             'totalReads': ('totalReads', 0x40, 0, 0),
+             'totalReadsSingle': ('totalReads', 0, 0, 0),
+             'uniquelyMappedReads': ('uniquelyMappedReads', 0x40, 0x4, 5),
+             'uniquelyMappedReadsSingle': ('uniquelyMappedReads', 0, 0x4, 5)}
+# BAM statistics that can be answered by the BAM index alone, mapped to the
+# index count that answers them.
+BAM_INDEX_STATS = {'mappedReadsSingle': 'mapped',
+                   'totalReadsSingle': 'total'}
 
 
 def check_response(pegr_url, payload, response):
     try:
         s = json.dumps(payload)
         response_code = response.get('response_code', None)
-        if response_code not in ['200']:
+        if response_code not in ['200', '202']:
             err_msg = 'Error sending statistics to PEGR!\n\nPEGR URL:\n%s\n\n' % str(pegr_url)
             err_msg += 'Payload:\n%s\n\nResponse:\n%s\n' % (s, str(response))
             if response_code in ['500']:
@@ -54,10 +102,26 @@ def check_response(pegr_url, payload, response):
         sys.stderr.write(err_msg)
 
 
-def check_samtools():
-    samtools_exec = which('samtools')
-    if not samtools_exec:
-        stop_err('Attempting to use functionality requiring samtools, but it cannot be located on Galaxy\'s PATH.')
+def flush_pegr_outbox(config_file, batch_size=100):
+    """
+    Send up to batch_size payloads from the PEGR outbox to PEGR, oldest
+    first.  Each payload is sent in its own request since the PEGR API
+    accepts a single payload per request.  Payloads are removed from the
+    outbox once PEGR accepts them, and moved to the rejected directory if
+    PEGR rejects them.  The flush stops at the first payload that could not
+    be delivered (PEGR is likely unavailable) so it can be retried later.
+    The outbox is locked while it is flushed, so a flush started while
+    another is in progress (e.g., by cron while the daemon is running)
+    waits for it to finish.  Returns a dictionary of the number of sent,
+    rejected and remaining payloads along with the error that stopped the
+    flush, if any.
+    """
+    outbox_dir = get_pegr_outbox_dir(config_file)
+    if outbox_dir is None:
+        stop_err('PEGR_OUTBOX_DIR is not set in %s.\n' % config_file)
+    with open(os.path.join(outbox_dir, PEGR_OUTBOX_LOCK_FILE), 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        return send_pegr_outbox(config_file, outbox_dir, batch_size=batch_size)
 
 
 def format_tool_parameters(parameters):
@@ -92,6 +156,75 @@ def get_adapter_dimer_count(file_path):
     return float(adapter_dimer_count)
 
 
+def get_bam_index_counts(index_file):
+    """
+    Read the number of mapped and total reads from the metadata pseudo-bin
+    of each reference in the BAM index (.bai) at index_file, in time that is
+    proportional to the size of the index rather than the BAM file.  Returns
+    None if the index cannot answer, so the caller can scan the BAM file.
+    """
+    if not index_file or not os.path.isfile(index_file):
+        return None
+    with open(index_file, 'rb') as fh:
+        data = fh.read()
+    if data[:4] != b'BAI\x01':
+        return None
+    mapped = 0
+    unmapped = 0
+    offset = 4
+    n_ref = struct.unpack_from('<i', data, offset)[0]
+    offset += 4
+    for i in range(n_ref):
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        found_pseudo_bin = False
+        for j in range(n_bin):
+            bin, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            if bin == BAM_INDEX_PSEUDO_BIN:
+                # The second pseudo-chunk holds the mapped and unmapped counts.
+                ref_mapped, ref_unmapped = struct.unpack_from('<QQ', data, offset + 16)
+                mapped += ref_mapped
+                unmapped += ref_unmapped
+                found_pseudo_bin = True
+            offset += n_chunk * 16
+        if n_bin > 0 and not found_pseudo_bin:
+            # Older indexes may not contain the pseudo-bin.
+            return None
+        n_intv = struct.unpack_from('<i', data, offset)[0]
+        offset += 4 + n_intv * 8
+    # Reads without coordinates are counted at the end of the index.
+    no_coor = 0
+    if len(data) >= offset + 8:
+        no_coor = struct.unpack_from('<Q', data, offset)[0]
+    return dict(mapped=mapped, total=mapped + unmapped + no_coor)
+
+
+def get_bam_read_counts(file_path, stats, index_file=None):
+    """
+    Generate the read counts for each of the received BAM statistics.  The
+    statistics that can be answered by the BAM index at index_file are read
+    from it, and the rest are generated using a single pass over the BAM file
+    at file_path.  Alignments are tallied by flag and MAPQ, and the samtools
+    view filters for each statistic are then applied to the (small) tally.
+    """
+    counts = {}
+    index_counts = None
+    if index_file is not None and any(k in BAM_INDEX_STATS for k in stats):
+        try:
+            index_counts = get_bam_index_counts(index_file)
+        except Exception as e:
+            sys.stderr.write('Unable to read BAM index %s, scanning the BAM file instead: %s\n' % (index_file, str(e)))
+    if index_counts is not None:
+        for k in stats:
+            if k in BAM_INDEX_STATS:
+                counts[BAM_STATS[k][0]] = index_counts[BAM_INDEX_STATS[k]]
+        stats = [k for k in stats if k not in BAM_INDEX_STATS]
+    if stats:
+        counts.update(scan_bam_read_counts(file_path, stats))
+    return dict((k, float('%.2f' % v)) for k, v in counts.items())
+
+
 def get_base_json_dict(config_file, dbkey, history_id, history_name, stats_tool_id, stderr, tool_id, tool_parameters, user_email, workflow_step_id):
     d = {}
     d['genome'] = dbkey
@@ -125,9 +258,10 @@ def get_chrom_lengths(chrom_len_file):
 
 def get_config_settings(config_file, section='defaults'):
     d = {}
-    config_parser = ConfigParser()
-    config_parser.read(config_file)
-    for key, value in config_parser.items(section):
+    # The configuration file is parsed only once per process
+    # (or when it changes) no matter how often this is called.
+    config = config_util.get_config(config_file)
+    for key, value in config.get_section(section).items():
         if section == 'defaults':
             d[string.upper(key)] = value
         else:
@@ -153,18 +287,29 @@ def get_history_url(config_file, historyId):
     return '%s/histories/view?id=%s' % (defaults['GALAXY_BASE_URL'],historyId)
 
 
-def get_deduplicated_uniquely_mapped_reads(file_path, single=False):
-    if single:
-        cmd = "samtools view -F 4 -q 5 -c %s" % file_path
-    else:
-        cmd = "samtools view -f 0x41 -F 0x404 -q 5 -c %s" % file_path
-    return get_reads(cmd)
+def get_http_client(config_file):
+    # The client is shared by all requests made by this process so
+    # that connections to PEGR and Galaxy are kept alive and reused.
+    import http_util
+    config = config_util.get_config(config_file)
+    return http_util.get_client(timeout=config.get_float('HTTP_TIMEOUT', default=60.0),
+                                retries=config.get_int('HTTP_RETRIES', default=3),
+                                gzip_min_size=config.get_int('HTTP_GZIP_MIN_SIZE', default=65536))
 
 
 def get_galaxy_instance(api_key, url):
+    from bioblend import galaxy
     return galaxy.GalaxyInstance(url=url, key=api_key)
 
 
+def get_galaxy_slots():
+    # Galaxy sets $GALAXY_SLOTS to the number of cores allocated to the job.
+    try:
+        return max(int(os.environ.get('GALAXY_SLOTS', 1)), 1)
+    except ValueError:
+        return 1
+
+
 def get_galaxy_url(config_file):
     defaults = get_config_settings(config_file, section='defaults')
     return make_url(defaults['GALAXY_API_KEY'], defaults['GALAXY_BASE_URL'])
@@ -191,34 +336,39 @@ def get_genome_size(chrom_lengths_dict):
     return genome_size
 
 
-def get_mapped_reads(file_path, single=False):
-    if single:
-        cmd = "samtools view -F 4 -c %s" % file_path
-    else:
-        cmd = "samtools view -f 0x40 -F 4 -c %s" % file_path
-    return get_reads(cmd)
-
-
-def get_number_of_lines(file_path):
-    i = 0
-    with open(file_path) as fh:
-        for i, l in enumerate(fh):
-            pass
-    fh.close()
-    if i == 0:
-        return i
-    return i + 1
+def get_number_of_lines(file_path, block_size=LINE_COUNT_BLOCK_SIZE):
+    """
+    Count the lines in file_path by counting the newlines in large binary
+    blocks.  A final line that does not end with a newline is also counted.
+    """
+    num_lines = 0
+    last_block = b''
+    with open(file_path, 'rb') as fh:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            num_lines += block.count(b'\n')
+            last_block = block
+    if last_block and not last_block.endswith(b'\n'):
+        num_lines += 1
+    return num_lines
 
 
 def get_peak_pair_wis(file_path):
     return get_number_of_lines(file_path)
 
 
-def get_peak_stats(file_path):
+def get_peak_stats(file_path, chunk_size=GFF_CHUNK_SIZE):
     """
     The received file_path must point to a gff file and
     we'll return peak stats discovered in the dataset.
+
+    The file is parsed in chunks of about chunk_size bytes using regular
+    expressions, and the score and stddev columns are collected directly into
+    float64 arrays, so no per-line Python objects are retained.
     """
+    import numpy
     peak_stats = dict(numberOfPeaks=0,
                       peakMean=0,
                       peakMeanStd=0,
@@ -226,41 +376,66 @@ def get_peak_stats(file_path):
                       peakMedianStd=0,
                       medianTagSingletons=0,
                       singletons=0)
-    stddevs = []
-    peak_singleton_scores = []
-    scores = []
-    singletons = 0
-    i = 0
+    score_chunks = []
+    stddev_chunks = []
+    stddev_score_chunks = []
+    num_lines = 0
     with open(file_path) as fh:
-        for i, line in enumerate(fh):
-            items = line.split('\t')
+        while True:
+            lines = fh.readlines(chunk_size)
+            if not lines:
+                break
+            num_lines += len(lines)
+            chunk = ''.join(lines)
             # Gff column 6 is score.
-            score = float(items[5])
-            scores.append(score)
-            # Gff column 9 is a semicolon-separated list.
-            attributes = items[8].split(';')
-            for attribute in attributes:
-                if attribute.startswith('stddev'):
-                    val = float(attribute.split('=')[1])
-                    stddevs.append(val)
-                    if val == 0.0:
-                        # We have a peakSingleton.
-                        singletons += 1
-                        peak_singleton_scores.append(score)
-                    break
-    fh.close()
-    if i > 0:
+            scores = GFF_SCORE_RE.findall(chunk)
+            if len(scores) != len(lines):
+                raise Exception('Invalid gff file %s, each line must contain at least 9 columns.' % file_path)
+            score_chunks.append(numpy.array(scores, dtype=numpy.float64))
+            # Gff column 9 is a semicolon-separated list, and we use
+            # the first attribute that starts with stddev on each line.
+            stddev_items = GFF_STDDEV_RE.findall(chunk)
+            stddev_score_chunks.append(numpy.array([item[0] for item in stddev_items], dtype=numpy.float64))
+            stddev_chunks.append(numpy.array([item[1] for item in stddev_items], dtype=numpy.float64))
+    if num_lines > 1:
+        scores = numpy.concatenate(score_chunks)
+        stddevs = numpy.concatenate(stddev_chunks)
+        # Peaks with a stddev of 0 are singletons.
+        peak_singleton_scores = numpy.concatenate(stddev_score_chunks)[stddevs == 0.0]
         # The number of lines in the file is the number of peaks.
-        peak_stats['numberOfPeaks'] = i + 1
+        peak_stats['numberOfPeaks'] = num_lines
         peak_stats['peakMean'] = numpy.mean(scores)
         peak_stats['peakMeanStd'] = numpy.mean(stddevs)
         peak_stats['peakMedian'] = numpy.median(scores)
         peak_stats['peakMedianStd'] = numpy.median(stddevs)
         peak_stats['medianTagSingletons'] = numpy.median(peak_singleton_scores)
-        peak_stats['singletons'] = singletons
+        peak_stats['singletons'] = len(peak_singleton_scores)
     return peak_stats
 
 
+def get_pegr_outbox_dir(config_file):
+    """
+    Return the PEGR outbox directory (creating it if necessary), or None if
+    payloads are to be sent directly to PEGR.  The directory must be an
+    absolute path so that payloads are never queued in the tool directory.
+    """
+    outbox_dir = config_util.get_config(config_file).get('PEGR_OUTBOX_DIR')
+    if not outbox_dir:
+        return None
+    if not os.path.isabs(outbox_dir):
+        stop_err('PEGR_OUTBOX_DIR in %s must be an absolute path: %s\n' % (config_file, outbox_dir))
+    for sub_dir in [PEGR_OUTBOX_QUEUED, PEGR_OUTBOX_REJECTED]:
+        path = os.path.join(outbox_dir, sub_dir)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Another stats job may have created it.
+                if not os.path.isdir(path):
+                    raise
+    return outbox_dir
+
+
 def get_pegr_url(config_file):
     defaults = get_config_settings(config_file)
     return make_url(defaults['PEGR_API_KEY'], defaults['PEGR_URL'])
@@ -302,14 +477,6 @@ def get_read_from_fastqc_file(file_path):
     return read
 
 
-def get_reads(cmd):
-    try:
-        reads = '%.2f' % float(subprocess.check_output(shlex.split(cmd)))
-        return float(reads)
-    except Exception as e:
-        stop_err('Error getting reads: %s' % str(e))
-
-
 def get_run_from_history_name(history_name, exit_on_error=False):
     # Example: paired_001-199-10749.001
     try:
@@ -337,39 +504,27 @@ def get_statistics(file_path, stats, **kwd):
     # ['dedupUniquelyMappedReads', 'mappedReads', 'totalReads', 'uniquelyMappedReads']
     s = {}
     try:
+        # All BAM read counts are generated together in a single pass.
+        bam_stats = [k for k in stats if k in BAM_STATS]
+        if bam_stats:
+            s.update(get_bam_read_counts(file_path, bam_stats, index_file=kwd.get('index_file', None)))
         for k in stats:
             if k == 'adapterDimerCount':
                 # We're dealing with the FastQC report file,
                 # so populate the statistics with the read.
                 s['read'] = get_read_from_fastqc_file(file_path)
                 s[k] = get_adapter_dimer_count(file_path)
-            elif k == 'dedupUniquelyMappedReads':
-                s[k] = get_deduplicated_uniquely_mapped_reads(file_path)
-            elif k == 'dedupUniquelyMappedReadsSingle':
-                s['dedupUniquelyMappedReads'] = get_deduplicated_uniquely_mapped_reads(file_path, single=True)
             elif k == 'genomeCoverage':
                 chrom_lengths_file = kwd.get('chrom_lengths_file', None)
                 if chrom_lengths_file is None:
                     stop_err('Required chrom_lengths_file parameter not received!')
                 s[k] = get_genome_coverage(file_path, chrom_lengths_file)
-            elif k == 'mappedReads':
-                s[k] = get_mapped_reads(file_path)
-            elif k == 'mappedReadsSingle':
-                s['mappedReads'] = get_mapped_reads(file_path, single=True)
             elif k == 'peakPairWis':
                 s[k] = get_peak_pair_wis(file_path)
             elif k == 'peakStats':
                 return get_peak_stats(file_path)
             elif k == 'peHistogram':
                 return get_pe_histogram_stats(file_path)
-            elif k == 'totalReads':
-                s[k] = get_total_reads(file_path)
-            elif k == 'totalReadsSingle':
-                s['totalReads'] = get_total_reads(file_path, single=True)
-            elif k == 'uniquelyMappedReads':
-                s[k] = get_uniquely_mapped_reads(file_path)
-            elif k == 'uniquelyMappedReadsSingle':
-                s['uniquelyMappedReads'] = get_uniquely_mapped_reads(file_path, single=True)
     except Exception as e:
         stop_err(str(e))
     return s
@@ -387,33 +542,48 @@ def get_tool_category(config_file, tool_id):
     return category_map.get(lc_tool_id, 'Unknown')
 
 
-def get_total_reads(file_path, single=False):
-    if single:
-        cmd = "samtools view -c %s" % file_path
-    else:
-        cmd = "samtools view -f 0x40 -c %s" % file_path
-    return get_reads(cmd)
-
-
-def get_uniquely_mapped_reads(file_path, single=False):
-    if single:
-        cmd = "samtools view -F 4 -q 5 -c %s" % file_path
-    else:
-        cmd = "samtools view -f 0x40 -F 4 -q 5 -c %s" % file_path
-    return get_reads(cmd)
-
-
 def get_workflow_id(config_file, history_name):
+    """
+    Return the id of the workflow named in history_name.  Workflow ids are
+    read from the workflow id cache, so Galaxy is queried only when the cache
+    has no valid entry for the workflow.  Workflows that do not exist in
+    Galaxy are also cached (with an id of None), so that stats jobs for them
+    do not each query Galaxy.
+    """
     workflow_name = get_workflow_name_from_history_name(history_name)
     if workflow_name == 'unknown':
         return 'unknown'
-    defaults = get_config_settings(config_file)
-    gi = get_galaxy_instance(defaults['GALAXY_API_KEY'], defaults['GALAXY_BASE_URL'])
-    workflow_info_dicts = gi.workflows.get_workflows(name=workflow_name)
-    if len(workflow_info_dicts) == 0:
+    cache_file, ttl, miss_ttl = get_workflow_id_cache_settings(config_file)
+    cache = read_workflow_id_cache(cache_file)
+    entry = cache.get(workflow_name, None)
+    if entry is None or time.time() - entry['time'] >= (miss_ttl if entry['id'] is None else ttl):
+        cache = update_workflow_id_cache(config_file, cache_file, workflow_names=[workflow_name])
+        entry = cache.get(workflow_name, None)
+    if entry is None or entry['id'] is None:
         return 'unknown'
-    wf_info_dict = workflow_info_dicts[0]
-    return wf_info_dict['id']
+    return entry['id']
+
+
+def get_workflow_id_cache_settings(config_file):
+    """
+    Return the workflow id cache file (creating its directory if necessary)
+    and the number of seconds that cached ids and cached misses remain valid.
+    """
+    config = config_util.get_config(config_file)
+    cache_dir = config.get('WORKFLOW_ID_CACHE_DIR', default=None)
+    if not cache_dir:
+        cache_dir = os.path.join(tempfile.gettempdir(), WORKFLOW_ID_CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another stats job may have created it.
+            if not os.path.isdir(cache_dir):
+                raise
+    cache_file = os.path.join(cache_dir, config.get('WORKFLOW_ID_CACHE_FILE', default=WORKFLOW_ID_CACHE_FILE))
+    ttl = config.get_int('WORKFLOW_ID_CACHE_TTL', default=WORKFLOW_ID_CACHE_TTL)
+    miss_ttl = config.get_int('WORKFLOW_ID_CACHE_MISS_TTL', default=WORKFLOW_ID_CACHE_MISS_TTL)
+    return cache_file, ttl, miss_ttl
 
 
 def get_workflow_name_from_history_name(history_name, exit_on_error=False):
@@ -437,7 +607,7 @@ def listify(item, do_strip=False):
         return []
     elif isinstance(item, list):
         return item
-    elif isinstance(item, string_types) and item.count(','):
+    elif isinstance(item, STRING_TYPES) and item.count(','):
         if do_strip:
             return [token.strip() for token in item.split(',')]
         else:
@@ -460,10 +630,38 @@ def make_url(api_key, url, args=None):
     return url + argsep + '&'.join(['='.join(t) for t in args])
 
 
-def post(api_key, url, data):
+def post(api_key, url, data, http_client=None):
+    import http_util
+    if http_client is None:
+        http_client = http_util.get_client()
     url = make_url(api_key, url)
-    response = Request(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-    return json.loads(urlopen(response).read())
+    response = http_client.post(url, json.dumps(data), headers={'Content-Type': 'application/json'})
+    return json.loads(response)
+
+
+def queue_submission(outbox_dir, data):
+    """
+    Durably queue the payload data in the PEGR outbox.  File names start with
+    the time in microseconds so that payloads are sent in the order queued.
+    """
+    import uuid
+    file_name = '%016d-%s.json' % (int(time.time() * 1000000), uuid.uuid4().hex)
+    file_path = os.path.join(outbox_dir, PEGR_OUTBOX_QUEUED, file_name)
+    envelope = dict(attempts=0, payload=data, queued=time.time())
+    write_json_atomically(file_path, envelope)
+    return dict(response_code='202', message='Queued for submission to PEGR in %s' % file_path)
+
+
+def read_workflow_id_cache(cache_file):
+    """
+    Return the workflow id cache, a dictionary mapping workflow names to their
+    id and the time the id was retrieved from Galaxy.
+    """
+    try:
+        with open(cache_file) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
 
 
 def restore_text(text, character_map=MAPPED_CHARS):
@@ -475,6 +673,91 @@ def restore_text(text, character_map=MAPPED_CHARS):
     return text
 
 
+def scan_bam_read_counts(file_path, stats):
+    """
+    Generate the read counts for each of the received BAM statistics using a
+    single pass over the BAM file at file_path.  Only the flag and MAPQ of
+    each alignment are read, so alignments are never formatted as SAM text.
+    """
+    import pysam
+    filters = [BAM_STATS[k] for k in stats]
+    counts = dict((f[0], 0) for f in filters)
+    # Alignment counts keyed by flag and MAPQ.
+    tally = {}
+    try:
+        # Use the cores allocated to the job for BGZF decompression.
+        with pysam.AlignmentFile(file_path, 'rb', check_sq=False, threads=get_galaxy_slots()) as bam:
+            for alignment in bam.fetch(until_eof=True):
+                key = (alignment.flag, alignment.mapping_quality)
+                tally[key] = tally.get(key, 0) + 1
+        for (flag, mapq), count in tally.items():
+            for key, required, excluded, q in filters:
+                if flag & required == required and not flag & excluded and mapq >= q:
+                    counts[key] += count
+    except Exception as e:
+        stop_err('Error getting reads: %s' % str(e))
+    return counts
+
+
+def send_pegr_outbox(config_file, outbox_dir, batch_size=100):
+    """
+    Send up to batch_size payloads from the PEGR outbox, which
+    must be locked (see flush_pegr_outbox).
+    """
+    queued_dir = os.path.join(outbox_dir, PEGR_OUTBOX_QUEUED)
+    file_names = sorted(f for f in os.listdir(queued_dir) if f.endswith('.json'))
+    results = dict(sent=0, rejected=0, remaining=len(file_names), error=None)
+    for file_name in file_names[:batch_size]:
+        file_path = os.path.join(queued_dir, file_name)
+        with open(file_path) as fh:
+            envelope = json.load(fh)
+        response = send_to_pegr(config_file, envelope['payload'])
+        response_code = response.get('response_code', None)
+        if response_code == '200':
+            os.remove(file_path)
+            results['sent'] += 1
+        elif response_code == '500':
+            # The payload may not have included all items required
+            # by PEGR, so sending it again will not help.
+            envelope['response'] = response
+            write_json_atomically(os.path.join(outbox_dir, PEGR_OUTBOX_REJECTED, file_name), envelope)
+            os.remove(file_path)
+            results['rejected'] += 1
+        else:
+            envelope['attempts'] = envelope.get('attempts', 0) + 1
+            envelope['response'] = response
+            write_json_atomically(file_path, envelope)
+            results['error'] = str(response)
+            break
+        results['remaining'] -= 1
+    return results
+
+
+def send_to_pegr(config_file, data):
+    """
+    Sends an API POST request and acts as a generic formatter for the JSON response.
+    'data' will become the JSON payload read by Galaxy.
+    """
+    import http_util
+    defaults = get_config_settings(config_file)
+    try:
+        return post(defaults['PEGR_API_KEY'], defaults['PEGR_URL'], data, http_client=get_http_client(config_file))
+    except http_util.HTTPResponseError as e:
+        body = e.read()
+        try:
+            return json.loads(body)
+        except ValueError:
+            # E.g., an error page from a proxy in front of PEGR.
+            return dict(response_code=str(e.status), message=body)
+    except http_util.HTTPConnectionError as e:
+        return dict(response_code=None, message=str(e))
+    except Exception as e:
+        try:
+            return dict(response_code=None, message=e.read())
+        except:
+            return dict(response_code=None, message=str(e))
+
+
 def stop_err(msg):
     sys.stderr.write(msg)
     sys.exit()
@@ -492,26 +775,54 @@ def store_results(file_path, pegr_url, payload, response):
 
 def submit(config_file, data):
     """
-    Sends an API POST request and acts as a generic formatter for the JSON response.
-    'data' will become the JSON payload read by Galaxy.
+    Send the payload data to PEGR, or queue it in the PEGR outbox if one is
+    configured so that the stats job does not depend on PEGR being available.
+    """
+    outbox_dir = get_pegr_outbox_dir(config_file)
+    if outbox_dir is not None:
+        return queue_submission(outbox_dir, data)
+    return send_to_pegr(config_file, data)
+
+
+def update_workflow_id_cache(config_file, cache_file, workflow_names=None):
+    """
+    Retrieve the ids of all workflows with a single Galaxy API request and
+    replace the workflow id cache with them, caching an id of None for each
+    of the received workflow names that does not exist in Galaxy.  The cache
+    file is replaced atomically, so concurrent stats jobs always read a
+    complete cache.
     """
     defaults = get_config_settings(config_file)
+    gi = get_galaxy_instance(defaults['GALAXY_API_KEY'], defaults['GALAXY_BASE_URL'])
+    now = time.time()
+    cache = {}
+    for wf_info_dict in gi.workflows.get_workflows():
+        # Keep the first workflow with a given name, as get_workflows(name=...) would.
+        if wf_info_dict['name'] not in cache:
+            cache[wf_info_dict['name']] = dict(id=wf_info_dict['id'], time=now)
+    for workflow_name in workflow_names or []:
+        if workflow_name not in cache:
+            cache[workflow_name] = dict(id=None, time=now)
     try:
-        return post(defaults['PEGR_API_KEY'], defaults['PEGR_URL'], data)
-    except HTTPError as e:
-        return json.loads(e.read())
-    except URLError as e:
-        return dict(response_code=None, message=str(e))
-    except Exception as e:
-        try:
-            return dict(response_code=None, message=e.read())
-        except:
-            return dict(response_code=None, message=str(e))
+        write_json_atomically(cache_file, cache)
+    except (IOError, OSError) as e:
+        sys.stderr.write('Unable to update workflow id cache %s: %s\n' % (cache_file, str(e)))
+    return cache
 
 
-def which(file):
-    # http://stackoverflow.com/questions/5226958/which-equivalent-function-in-python
-    for path in os.environ["PATH"].split(":"):
-        if os.path.exists(path + "/" + file):
-            return path + "/" + file
-    return None
+def write_json_atomically(file_path, data):
+    """
+    Write data as JSON to file_path so that readers see either the previous
+    file or the complete new file, and the new file survives a crash.
+    """
+    tmp_file_path = get_tmp_filename(dir=os.path.dirname(file_path), suffix='.tmp')
+    try:
+        with open(tmp_file_path, 'w') as fh:
+            json.dump(data, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp_file_path, 0o644)
+        os.rename(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
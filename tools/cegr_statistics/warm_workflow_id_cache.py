@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Warms the workflow id cache used by the statistics tools so that stats jobs
+do not need to query Galaxy for workflow ids.  All workflow ids are retrieved
+with a single Galaxy API request, and the names of any received exported
+workflow (.ga) files are checked against them.
+
+Example of use:
+python warm_workflow_id_cache.py --config_file stats_config.ini ../../exported_workflows/production/*.ga
+"""
+import argparse
+import json
+import stats_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_file', dest='config_file', default='stats_config.ini', help='stats_config.ini')
+parser.add_argument('exported_workflows', nargs='*', help='Exported workflow (.ga) files')
+args = parser.parse_args()
+
+cache_file, ttl, miss_ttl = stats_util.get_workflow_id_cache_settings(args.config_file)
+cache = stats_util.update_workflow_id_cache(args.config_file, cache_file)
+print 'Cached the ids of %d workflows in %s.' % (len(cache), cache_file)
+for exported_workflow in args.exported_workflows:
+    with open(exported_workflow) as fh:
+        workflow_name = json.load(fh)['name']
+    if workflow_name in cache:
+        print 'Workflow %s has id %s.' % (workflow_name, cache[workflow_name]['id'])
+    else:
+        print 'Workflow %s from %s does not exist in Galaxy.' % (workflow_name, exported_workflow)
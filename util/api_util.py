@@ -8,21 +8,31 @@ If command line parameters are not used for the following defaults, then the
 default values must be set appropriately for the environment within which this
 pipeline is run.
 """
+import collections
 import datetime
+import gzip
+import hashlib
 import json
+import multiprocessing
 import os
 import pipes
 import shutil
 import string
 import subprocess
 import sys
-import tempfile
-from ConfigParser import ConfigParser
-from six.moves.urllib.request import urlopen
+import threading
+import config_util
+import executor_util
+import fastq_util
+import http_util
+import time
+from contextlib import closing
 from time import gmtime, strftime
 
 BUFF_SIZE = 1048576
 CONFIG_FILE = '../../config/cegr_config.ini'
+# Number of lines of standard error kept for reporting a failed command.
+STDERR_TAIL_LINES = 100
 TODAY_STR = datetime.datetime.today().strftime('%Y-%m-%d')
 ANALYSIS_PREP_LOG_FILE_NAME = '%s_analysis_prep.log' % TODAY_STR
 GENOME_SPECIES_MAP = {'bosTau7': 'cow',
@@ -119,14 +129,6 @@ def check_run_info(line, items, lh, check, index):
         return True, (run, sample, indexes_str, wf_config_files, ext, data_lib_desc, data_lib_syn)
 
 
-def cleanup_before_exit(tmp_dir):
-    """
-    Remove temporary files and directories.
-    """
-    if tmp_dir and os.path.exists(tmp_dir):
-        shutil.rmtree(tmp_dir)
-
-
 def close_log_file(lh, script_name):
     lh.write('\n\n')
     lh.write('###############################################################################\n')
@@ -136,14 +138,20 @@ def close_log_file(lh, script_name):
     lh.close()
 
 
-def copy_local_directory_of_files(src_path, dest_path, lh):
+def copy_local_directory_of_files(src_path, dest_path, lh, executor=None, resources=None):
+    """
+    Copy the directory, using the executor (see executor_util) requesting
+    the resources if one is received, otherwise on this host.
+    """
     lh.write('Copying directory\n%s\nto path\n%s\n\n' % (src_path, dest_path))
     cmd = "cp -R -f -v %s %s" % (src_path, dest_path)
+    if executor is not None:
+        return execute_job_cmd(executor, cmd, 'copy', lh, resources=resources)
     rc = execute_cmd(cmd, lh)
     return rc
 
 
-def copy_raw_data_if_necessary(src_path, dest_path, lh):
+def copy_raw_data_if_necessary(src_path, dest_path, lh, executor=None, resources=None):
     # For runs starting at run 209 and all earlier runs, we
     # will copy the raw data from the old long-term storage
     # location to the new long-term storage location.
@@ -157,13 +165,19 @@ def copy_raw_data_if_necessary(src_path, dest_path, lh):
                 # The directory must have been previously copied.
                 copy_necessary = False
         if copy_necessary:
-            rc = copy_local_directory_of_files(src_path, dest_path, lh)
+            rc = copy_local_directory_of_files(src_path, dest_path, lh, executor=executor, resources=resources)
             return rc
     return 0
 
 
-def copy_remote_directory_of_files(host, remote_path, local_path, lh):
+def copy_remote_directory_of_files(host, remote_path, local_path, lh, executor=None, resources=None):
+    """
+    Copy the remote directory, using the executor (see executor_util)
+    requesting the resources if one is received, otherwise on this host.
+    """
     cmd = "rsync -avh %s:%s %s" % (host, remote_path, local_path)
+    if executor is not None:
+        return execute_job_cmd(executor, cmd, 'rsync', lh, resources=resources)
     rc = execute_cmd(cmd, lh)
     return rc
 
@@ -186,18 +200,68 @@ def create_script_complete_file(dir, name):
     fh.close()
 
 
-def execute_cmd(cmd, lh):
+def execute_cmd(cmd, lh, usage=None):
+    """
+    Execute the command, writing its standard output and error to the log as
+    they are produced, and the last lines of its standard error again if it
+    fails.  The wall time, CPU time and peak resident set size of the command
+    are logged and, if usage is a dictionary, stored in it.  Returns the exit
+    code of the command.
+    """
     lh.write("\nExecuting the following command:\n%s\n" % cmd)
-    tmp_dir, tmp_serr_file = get_temp_dir_and_filename()
-    tmp_dir, tmp_sout_file = get_temp_dir_and_filename(tmp_dir=tmp_dir)
-    serrfh = open(tmp_serr_file, 'wb')
-    soutfh = open(tmp_sout_file, 'wb')
-    proc = subprocess.Popen(args=cmd, stderr=serrfh, stdout=soutfh, shell=True)
-    rc = proc.wait()
-    serrfh.close()
-    soutfh.close()
-    log_results(cmd, rc, tmp_serr_file, tmp_sout_file, lh)
-    cleanup_before_exit(tmp_dir)
+    lh_lock = threading.Lock()
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    start = time.time()
+    proc = subprocess.Popen(args=cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
+    # Read both pipes at once so the command never blocks writing to either.
+    readers = [threading.Thread(target=log_stream, args=(proc.stdout, lh, lh_lock, None)),
+               threading.Thread(target=log_stream, args=(proc.stderr, lh, lh_lock, stderr_tail))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    cmd_usage = executor_util.wait_for_process(proc)
+    for reader in readers:
+        reader.join()
+    cmd_usage['wall_time'] = time.time() - start
+    rc = proc.returncode
+    if rc != 0:
+        lh.write('\nThe command\n%s\nreturned exit code %d with the following error:\n' % (cmd, rc))
+        for line in stderr_tail:
+            lh.write(line)
+    lh.write('The command took %.1f seconds and %.1f seconds of CPU time with a peak resident set size of %d bytes.\n\n' %
+             (cmd_usage['wall_time'], cmd_usage['cpu_time'], cmd_usage['peak_rss']))
+    if usage is not None:
+        usage.update(cmd_usage)
+    return rc
+
+
+def execute_job(executor, cmds, name, lh, resources=None, max_running=None):
+    """
+    Run the commands as a job using the executor (see executor_util), and
+    log the output of each.  Returns the finished job, which the caller must
+    clean up, or None if the job could not be run.
+    """
+    try:
+        job = executor.run(cmds, name, lh, resources=resources, max_running=max_running)
+    except OSError, e:
+        lh.write('Error running job %s: %s\n' % (name, str(e)))
+        return None
+    for task in job.tasks:
+        lh.write('\nExecuted the following command:\n%s\n' % task.cmd)
+        log_results(task.cmd, task.rc, task.stderr_file, task.stdout_file, lh)
+    return job
+
+
+def execute_job_cmd(executor, cmd, name, lh, resources=None):
+    """
+    Run the command as a job using the executor, logging its
+    output, and return its exit code.
+    """
+    job = execute_job(executor, [cmd], name, lh, resources=resources)
+    if job is None:
+        return 1
+    rc = job.tasks[0].rc
+    executor.cleanup(job)
     return rc
 
 
@@ -307,7 +371,7 @@ def generate_sample_sheet(cegr_run_info_file, sample_sheet_path, lh):
 
 def get(url):
     try:
-        return json.loads(urlopen(url).read())
+        return json.loads(get_http_client().get(url))
     except ValueError as e:
         stop_err(str(e))
 
@@ -317,9 +381,10 @@ def get_config_settings(config_file=None, type='defaults'):
     if config_file is None:
         config_file = CONFIG_FILE
     d = {}
-    config_parser = ConfigParser()
-    config_parser.read(config_file)
-    for key, value in config_parser.items(type):
+    # The configuration file is parsed only once per process
+    # (or when it changes) no matter how often this is called.
+    config = config_util.get_config(config_file)
+    for key, value in config.get_section(type).items():
         if type == 'defaults':
             d[string.upper(key)] = value
             log_file_dir = d.get('ANALYSIS_PREP_LOG_FILE_DIR', os.getcwd())
@@ -360,11 +425,67 @@ def get_current_time():
     return strftime('%a, %d %b %Y %H:%M:%S', gmtime())
 
 
+def get_fastq_validation_result(task):
+    """
+    Return the validation results (see fastq_util.validate_fastq) printed by
+    the validate_fastq.py task, or an invalid result containing the reason
+    if the file could not be validated.
+    """
+    if task.rc == 0:
+        try:
+            with open(task.stdout_file) as fh:
+                return json.load(fh)
+        except (IOError, ValueError), e:
+            return dict(valid=False, error='The file could not be validated: %s' % str(e))
+    error = 'exit code %d' % task.rc
+    if os.path.exists(task.stderr_file):
+        with open(task.stderr_file) as fh:
+            lines = [line.strip() for line in fh if line.strip()]
+        if lines:
+            error = lines[-1]
+    return dict(valid=False, error='The file could not be validated: %s' % error)
+
+
 def get_galaxy_url(config_file):
     defaults = get_config_settings(config_file, section='defaults')
     return make_url(defaults['GALAXY_API_KEY'], defaults['GALAXY_BASE_URL'])
 
 
+def get_http_client():
+    # The client is shared by all requests made by this process so
+    # that connections to Galaxy are kept alive and reused.
+    config = config_util.get_config(CONFIG_FILE)
+    return http_util.get_client(timeout=config.get_float('HTTP_TIMEOUT', default=60.0),
+                                retries=config.get_int('HTTP_RETRIES', default=3),
+                                gzip_min_size=config.get_int('HTTP_GZIP_MIN_SIZE', default=65536))
+
+
+def get_file_size_and_md5sum(file_path, uncompress=False, checksum=False):
+    """
+    Return the size of the file (uncompressed if uncompress is True) and,
+    if checksum is True, the md5sum of the same bytes (otherwise None).
+    """
+    if not uncompress and not checksum:
+        return os.path.getsize(file_path), None
+    md5 = hashlib.md5()
+    size = 0
+    if uncompress:
+        fh = gzip.open(file_path, 'rb')
+    else:
+        fh = open(file_path, 'rb')
+    with closing(fh):
+        while True:
+            chunk = fh.read(BUFF_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if checksum:
+                md5.update(chunk)
+    if checksum:
+        return size, md5.hexdigest()
+    return size, None
+
+
 def get_run_from_sample_sheet(sample_sheet):
     run = None
     with open(sample_sheet) as fh:
@@ -385,43 +506,6 @@ def get_run_from_sample_sheet(sample_sheet):
     return run
 
 
-def get_stderr_exception(tmp_err, tmp_stderr):
-    tmp_stderr.close()
-    """
-    Return a stderr string of reasonable size.
-    """
-    tmp_stderr = open(tmp_err, 'rb')
-    stderr_str = ''
-    buffsize = BUFF_SIZE
-    try:
-        while True:
-            stderr_str += tmp_stderr.read(buffsize)
-            if not stderr_str or len(stderr_str) % buffsize != 0:
-                break
-    except OverflowError:
-        pass
-    tmp_stderr.close()
-    return stderr_str
-
-
-def get_temp_dir(prefix='tmp-cegr-', dir=None):
-    """
-    Return a temporary directory.
-    """
-    return tempfile.mkdtemp(prefix=prefix, dir=dir)
-
-
-def get_temp_dir_and_filename(tmp_dir=None):
-    """
-    Return a temporary file name.
-    """
-    if tmp_dir is None:
-        tmp_dir = get_temp_dir()
-    fd, filename = tempfile.mkstemp(dir=tmp_dir)
-    os.close(fd)
-    return tmp_dir, filename
-
-
 def get_value_or_default(value, default, is_path=False, create_dir=False):
     if value is None:
         defaults = get_config_settings(type='defaults')
@@ -435,12 +519,6 @@ def get_value_or_default(value, default, is_path=False, create_dir=False):
     return value
 
 
-def is_valid_fastq(fastq_validator_binary, file_name, lh):
-    lh.write('Validating file: %s\n' % file_name)
-    cmd = '%s --noeof --file %s' % (fastq_validator_binary, file_name)
-    return execute_cmd(cmd, lh)
-
-
 def listify(item, do_strip=True):
     """
     Make a single item a single item list, or return a list if passed a
@@ -461,16 +539,32 @@ def listify(item, do_strip=True):
 
 def log_results(cmd, rc, tmp_serr_file, tmp_sout_file, lh):
     if tmp_sout_file is not None:
-        for line in open(tmp_sout_file):
-            lh.write('%s\n' % line)
+        with open(tmp_sout_file) as fh:
+            shutil.copyfileobj(fh, lh, BUFF_SIZE)
     if rc != 0:
         lh.write('\nThe command\n%s\nreturned exit code %d with the following error:\n' % (cmd, rc))
         if tmp_serr_file is not None:
-            for line in open(tmp_serr_file):
-                lh.write('%s\n' % line)
+            with open(tmp_serr_file) as fh:
+                shutil.copyfileobj(fh, lh, BUFF_SIZE)
     lh.write('\n\n')
 
 
+def log_stream(fh, lh, lh_lock, tail=None):
+    """
+    Write each line read from fh to the log as it is read, also
+    keeping it in tail (a bounded deque) if one is received.
+    """
+    for line in iter(fh.readline, b''):
+        if not line.endswith('\n'):
+            line += '\n'
+        with lh_lock:
+            lh.write(line)
+            lh.flush()
+        if tail is not None:
+            tail.append(line)
+    fh.close()
+
+
 def make_url(api_key, url, args=None):
     """
     Adds the API Key to the URL if it's not already there.
@@ -507,3 +601,65 @@ def remove_remote_file(host, path, lh):
 def stop_err(msg):
     sys.stderr.write(msg)
     sys.exit(1)
+
+
+def validate_fastq_files(executor, file_names, lh, resources=None, max_running=None, on_result=None):
+    """
+    Validate the fastq files as a job using the executor (see executor_util),
+    with one task requesting the resources for each file, at most max_running
+    (by default, the number of cores when run on this host) at once.  The
+    results of each file are logged as soon as it has been validated and are
+    passed with the file name to on_result if received.  Returns a
+    dictionary mapping each file name to its validation results (see
+    fastq_util.validate_fastq).  A file that could not be validated (e.g.,
+    because its task failed) is reported as invalid.
+    """
+    if max_running is None and isinstance(executor, executor_util.LocalExecutor):
+        max_running = multiprocessing.cpu_count()
+    # The tasks run scripts/validate_fastq.py for each file.
+    scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+    cmds = ['%s validate_fastq.py --fastq_file %s' % (pipes.quote(sys.executable), pipes.quote(os.path.abspath(file_name)))
+            for file_name in file_names]
+    lh.write('Validating %d fastq files.\n' % len(file_names))
+    results = {}
+
+    def record_result(file_name, result):
+        if result['valid']:
+            lh.write('Validated file %s containing %d reads and %d bases.\n' % (file_name, result['reads'], result['bases']))
+        else:
+            lh.write('Invalid file %s: %s\n' % (file_name, result['error']))
+        results[file_name] = result
+        if on_result is not None:
+            on_result(file_name, result)
+
+    job = None
+    try:
+        job = executor.submit(cmds, 'validate_fastq', lh, resources=resources, max_running=max_running, cwd=scripts_dir)
+        for task in executor.finished_tasks(job, lh):
+            record_result(file_names[task.index], get_fastq_validation_result(task))
+    except OSError, e:
+        lh.write('Error validating fastq files: %s\n' % str(e))
+        for file_name in file_names:
+            if file_name not in results:
+                record_result(file_name, dict(valid=False, error='The file could not be validated: %s' % str(e)))
+    finally:
+        if job is not None:
+            executor.cleanup(job)
+    return results
+
+
+def wait_until(is_ready, max_wait=600, min_interval=1, max_interval=30):
+    """
+    Call is_ready, doubling the interval between calls from min_interval up
+    to max_interval, until it returns True or max_wait seconds have passed.
+    Returns the final value returned by is_ready.
+    """
+    start = time.time()
+    interval = min_interval
+    while not is_ready():
+        remaining = max_wait - (time.time() - start)
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+    return True
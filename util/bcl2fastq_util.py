@@ -0,0 +1,202 @@
+"""
+Chooses the numbers of threads bcl2fastq uses for loading, demultiplexing,
+processing and writing from the cores and memory available to it and the
+number of samples in the run, and records the wall time, CPU time and peak
+memory of each execution of bcl2fastq so that the effect of the settings can
+be seen.
+
+A run can also be demultiplexed by a separate bcl2fastq process for each lane,
+each writing to its own directory.  The fastq files produced for each lane are
+then concatenated, which needs no recompression since a file consisting of
+several gzip members is itself a valid gzip file.
+"""
+import datetime
+import glob
+import multiprocessing
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+
+# Number of bytes copied at a time when concatenating files.
+COPY_BUFFER_SIZE = 8388608
+# The end of the names bcl2fastq gives the fastq files, following the sample name.
+FASTQ_FILE_NAME_SUFFIX = re.compile(r'_S\d+(_L\d{3})?_[RI]\d_\d{3}\.fastq\.gz$')
+# The directory in the run's prep directory containing a directory for each lane.
+LANES_DIRECTORY_NAME = 'lanes'
+# Approximate memory in bytes used by each bcl2fastq processing thread.
+MEMORY_PER_PROCESSING_THREAD = 1073741824
+# Environment variables set by batch schedulers to the number of cores given to the job.
+SCHEDULER_CORES_VARIABLES = ['PBS_NUM_PPN', 'SLURM_CPUS_ON_NODE']
+# The history of bcl2fastq executions, kept in ANALYSIS_PREP_LOG_FILE_DIR.
+RESOURCE_USAGE_FILE_NAME = 'bcl2fastq_resource_usage.tsv'
+RESOURCE_USAGE_COLUMNS = ['date',
+                          'run',
+                          'cores',
+                          'memory_size',
+                          'samples',
+                          'lane_workers',
+                          'loading_threads',
+                          'demultiplexing_threads',
+                          'processing_threads',
+                          'writing_threads',
+                          'return_code',
+                          'wall_time',
+                          'cpu_time',
+                          'peak_rss']
+# The config settings that override each of the chosen thread counts.
+THREAD_SETTINGS = [('loading_threads', 'BCL2FASTQ_LOADING_THREADS'),
+                   ('demultiplexing_threads', 'BCL2FASTQ_DEMULTIPLEXING_THREADS'),
+                   ('processing_threads', 'BCL2FASTQ_PROCESSING_THREADS'),
+                   ('writing_threads', 'BCL2FASTQ_WRITING_THREADS')]
+
+
+def get_lane_directory(prep_directory, lane):
+    return os.path.join(get_lanes_directory(prep_directory), 'L%03d' % lane)
+
+
+def get_lanes(raw_data_directory):
+    """
+    Return the lane numbers of the flow cell from the run folder's RunInfo.xml.
+    """
+    tree = ET.parse(os.path.join(raw_data_directory, 'RunInfo.xml'))
+    layout = tree.find('.//FlowcellLayout')
+    if layout is None or layout.get('LaneCount', None) is None:
+        raise ValueError('The lane count is missing from RunInfo.xml in %s.' % raw_data_directory)
+    return list(range(1, int(layout.get('LaneCount')) + 1))
+
+
+def get_lanes_directory(prep_directory):
+    return os.path.join(prep_directory, LANES_DIRECTORY_NAME)
+
+
+def get_memory_size():
+    """
+    Return the physical memory of the machine in bytes, or None if it
+    cannot be determined.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def get_number_of_cores():
+    """
+    Return the number of cores this process may use, which is less than
+    the number the machine has if it is running as a batch job.
+    """
+    for name in SCHEDULER_CORES_VARIABLES:
+        try:
+            return int(os.environ[name])
+        except (KeyError, ValueError):
+            pass
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def get_number_of_samples(sample_sheet):
+    """
+    Return the number of samples in the [Data] section of the sample sheet,
+    which starts with a title line.
+    """
+    num_samples = 0
+    in_data = False
+    title_line_read = False
+    with open(sample_sheet, 'r') as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                in_data = line.lower() == '[data]'
+                title_line_read = False
+            elif in_data:
+                if title_line_read:
+                    num_samples += 1
+                else:
+                    title_line_read = True
+    return num_samples
+
+
+def get_sample_from_fastq_file(run, file_path):
+    """
+    Return the sample of a fastq file produced by bcl2fastq, whose
+    name is like 62401-1_S1_R1_001.fastq.gz for sample 1 of run 62401,
+    or None if the file name does not have that form.
+    """
+    file_name = os.path.basename(file_path)
+    prefix = '%s-' % str(run)
+    match = FASTQ_FILE_NAME_SUFFIX.search(file_name)
+    if match is None or not file_name.startswith(prefix):
+        return None
+    return file_name[len(prefix):match.start()]
+
+
+def get_thread_counts(num_cores, memory_size, num_samples, config):
+    """
+    Return a dictionary containing the numbers of threads to use for loading,
+    demultiplexing, processing and writing.  These follow the bcl2fastq
+    defaults (4 loading and writing threads, demultiplexing threads for 20% of
+    the cores and processing threads for all of them), except that the number
+    of processing threads is limited by memory and the number of writing
+    threads must not be higher than the number of samples.  Any of them can
+    be set with the BCL2FASTQ_*_THREADS config settings.
+    """
+    processing_threads = num_cores
+    if memory_size is not None:
+        processing_threads = min(processing_threads, memory_size // MEMORY_PER_PROCESSING_THREAD)
+    thread_counts = dict(loading_threads=min(4, num_cores),
+                         demultiplexing_threads=num_cores // 5,
+                         processing_threads=processing_threads,
+                         writing_threads=min(4, num_cores, num_samples))
+    for name, setting in THREAD_SETTINGS:
+        value = config.get_int(setting, default=None)
+        if value is not None:
+            thread_counts[name] = value
+        thread_counts[name] = max(1, int(thread_counts[name]))
+    return thread_counts
+
+
+def merge_lane_fastq_files(lane_directories, output_directory):
+    """
+    Concatenate the fastq files with the same name in each of the lane
+    directories, in the order received, into a file with that name in
+    output_directory.  Each file is written under a temporary name and
+    renamed once complete.  Returns the list of merged files.
+    """
+    file_names = set()
+    for lane_directory in lane_directories:
+        for file_path in glob.glob(os.path.join(lane_directory, '*.fastq.gz')):
+            file_names.add(os.path.basename(file_path))
+    merged_files = []
+    for file_name in sorted(file_names):
+        output_path = os.path.join(output_directory, file_name)
+        tmp_path = '%s.tmp' % output_path
+        with open(tmp_path, 'wb') as out_fh:
+            for lane_directory in lane_directories:
+                lane_file_path = os.path.join(lane_directory, file_name)
+                if os.path.exists(lane_file_path):
+                    with open(lane_file_path, 'rb') as in_fh:
+                        shutil.copyfileobj(in_fh, out_fh, COPY_BUFFER_SIZE)
+        os.rename(tmp_path, output_path)
+        merged_files.append(output_path)
+    return merged_files
+
+
+def record_resource_usage(log_dir, values):
+    """
+    Append a line with the received values (keyed by RESOURCE_USAGE_COLUMNS)
+    to the resource usage history in log_dir, and return it.
+    """
+    values = dict(values)
+    values.setdefault('date', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    line = '\t'.join(str(values.get(column, '')) for column in RESOURCE_USAGE_COLUMNS)
+    file_path = os.path.join(log_dir, RESOURCE_USAGE_FILE_NAME)
+    write_header = not os.path.exists(file_path)
+    with open(file_path, 'a') as fh:
+        if write_header:
+            fh.write('%s\n' % '\t'.join(RESOURCE_USAGE_COLUMNS))
+        fh.write('%s\n' % line)
+    return line
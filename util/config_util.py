@@ -0,0 +1,100 @@
+"""
+Provides configuration file settings that are parsed at most once per process.
+A configuration file is parsed again only if its modification time changes,
+and each section is cached the first time it is requested.
+
+The CEGR statistics tools include an identical copy of this module since they
+are installed into Galaxy independently of this pipeline.
+"""
+import os
+import threading
+
+from ConfigParser import ConfigParser
+
+# Config objects keyed by the absolute path to the configuration file.
+CONFIGS = {}
+CONFIGS_LOCK = threading.Lock()
+
+
+class Config(object):
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.config_parser = None
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.sections = {}
+
+    def get(self, key, section='defaults', default=None):
+        if not self.has_section(section):
+            return default
+        return self.get_section(section).get(key.lower(), default)
+
+    def get_bool(self, key, section='defaults', default=False):
+        value = self.get(key, section=section)
+        if value is None:
+            return default
+        return value.strip().lower() in ['true', 'yes', 'on', '1']
+
+    def get_float(self, key, section='defaults', default=None):
+        value = self.get(key, section=section)
+        if value is None or not value.strip():
+            return default
+        return float(value)
+
+    def get_int(self, key, section='defaults', default=None):
+        value = self.get(key, section=section)
+        if value is None or not value.strip():
+            return default
+        return int(value)
+
+    def get_list(self, key, section='defaults', default=None):
+        value = self.get(key, section=section)
+        if value is None:
+            return default or []
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    def get_section(self, section):
+        """
+        Return a dictionary of the (lower case) keys and values in section.
+        The returned dictionary is a copy, so callers may modify it.
+        """
+        with self.lock:
+            self.refresh()
+            if section not in self.sections:
+                self.sections[section] = dict(self.config_parser.items(section))
+            return dict(self.sections[section])
+
+    def has_section(self, section):
+        with self.lock:
+            self.refresh()
+            return self.config_parser.has_section(section)
+
+    def refresh(self):
+        """
+        Parse the configuration file if it has not yet been parsed or if it
+        has been modified since it was last parsed.
+        """
+        try:
+            mtime = os.path.getmtime(self.config_file)
+        except OSError:
+            mtime = None
+        if self.config_parser is None or mtime != self.mtime:
+            config_parser = ConfigParser()
+            config_parser.read(self.config_file)
+            self.config_parser = config_parser
+            self.mtime = mtime
+            self.sections = {}
+
+
+def get_config(config_file):
+    """
+    Return the shared Config object for config_file.
+    """
+    path = os.path.abspath(config_file)
+    with CONFIGS_LOCK:
+        config = CONFIGS.get(path, None)
+        if config is None:
+            config = Config(path)
+            CONFIGS[path] = config
+    return config
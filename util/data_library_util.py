@@ -1,12 +1,17 @@
+import os
+import time
 
+import api_util
 
-def get_blacklist_filter_dataset_id(gi, data_lib_id, dbkey, lh):
+# Library dataset states that will not change to ok without intervention.
+ERROR_STATES = ['discarded', 'error', 'failed_metadata']
+
+
+def find_blacklist_filter_dataset_id(lib_item_dicts, dbkey, lh):
     """
-    Use the Galaxy API to get the blacklist filter dataset for the dbkey.
-    We're assuming it is in the root folder.
+    Find the blacklist filter dataset for the dbkey in the received
+    data library contents.  We're assuming it is in the root folder.
     """
-    lh.write('Searching for blacklist filter dataset for dbkey %s.\n' % dbkey)
-    lib_item_dicts = gi.libraries.show_library(data_lib_id, contents=True)
     for lib_item_dict in lib_item_dicts:
         if lib_item_dict['type'] == 'file':
             dataset_name = lib_item_dict['name'].lstrip('/').lower()
@@ -23,6 +28,29 @@ def get_blacklist_filter_dataset_id(gi, data_lib_id, dbkey, lh):
     return None
 
 
+def find_sample_datasets(lib_content_dicts, sample):
+    """
+    Find the datasets for the sample in the received data library contents.
+    """
+    lib_input_datasets = {}
+    for lib_content_dict in lib_content_dicts:
+        if lib_content_dict['type'] == 'file':
+            item_name = lib_content_dict['name'].lstrip('/')
+            if item_name.startswith(sample):
+                lib_input_datasets[lib_content_dict['id']] = lib_content_dict['name']
+    return lib_input_datasets
+
+
+def get_blacklist_filter_dataset_id(gi, data_lib_id, dbkey, lh):
+    """
+    Use the Galaxy API to get the blacklist filter dataset for the dbkey.
+    We're assuming it is in the root folder.
+    """
+    lh.write('Searching for blacklist filter dataset for dbkey %s.\n' % dbkey)
+    lib_item_dicts = gi.libraries.show_library(data_lib_id, contents=True)
+    return find_blacklist_filter_dataset_id(lib_item_dicts, dbkey, lh)
+
+
 def get_data_library(gi, name, lh):
     """
     Use the Galaxy API to get the data library named the value name.
@@ -51,15 +79,156 @@ def get_folder(gi, data_lib_id, data_lib_name, name, lh):
     return None
 
 
+def get_library_index(gi, data_lib_id):
+    """
+    Use the Galaxy API to get the contents of a data library with a single
+    request.  Returns a dictionary mapping each top level folder name to its
+    id and a dictionary mapping each (folder name, dataset name) tuple to the
+    id of the dataset within that folder.
+    """
+    folder_ids = {}
+    dataset_ids = {}
+    for lib_item_dict in gi.libraries.show_library(data_lib_id, contents=True):
+        path_items = lib_item_dict['name'].strip('/').split('/')
+        if lib_item_dict['type'] == 'folder' and len(path_items) == 1:
+            folder_ids.setdefault(path_items[0], lib_item_dict['id'])
+        elif lib_item_dict['type'] == 'file' and len(path_items) == 2:
+            dataset_ids.setdefault(tuple(path_items), lib_item_dict['id'])
+    return folder_ids, dataset_ids
+
+
+def get_library_dataset_states(gi, library_id, dataset_ids, dataset_folder_ids=None):
+    """
+    Use the Galaxy API to return a dictionary mapping each of the library
+    datasets to its state.  Rather than requesting each dataset, the contents
+    of each folder containing the datasets are requested once, which lists
+    the state of each of its datasets.  Only the datasets whose upload jobs
+    have finished (or that are not listed) are requested individually to
+    confirm their state.  The folder of each dataset is found by requesting
+    the contents of the library, and is added to dataset_folder_ids if it is
+    received so that later calls need not request the library contents.
+    """
+    if dataset_folder_ids is None:
+        dataset_folder_ids = {}
+    if [dataset_id for dataset_id in dataset_ids if dataset_id not in dataset_folder_ids]:
+        folder_ids = {}
+        dataset_paths = {}
+        for lib_item_dict in gi.libraries.show_library(library_id, contents=True):
+            if lib_item_dict['type'] == 'folder':
+                folder_ids[lib_item_dict['name']] = lib_item_dict['id']
+            elif lib_item_dict['type'] == 'file':
+                dataset_paths[lib_item_dict['id']] = lib_item_dict['name']
+        for dataset_id in dataset_ids:
+            folder_id = folder_ids.get(os.path.dirname(dataset_paths.get(dataset_id, '')), None)
+            if folder_id is not None:
+                dataset_folder_ids[dataset_id] = folder_id
+    listed_states = {}
+    for folder_id in set(dataset_folder_ids.get(dataset_id, None) for dataset_id in dataset_ids):
+        if folder_id is None:
+            continue
+        folder_dict = gi.folders.show_folder(folder_id, contents=True)
+        for item_dict in folder_dict.get('folder_contents', []):
+            if item_dict.get('type', None) == 'file':
+                listed_states[item_dict['id']] = item_dict.get('state', None)
+    states = {}
+    for dataset_id in dataset_ids:
+        state = listed_states.get(dataset_id, None)
+        if state is None or state == 'ok' or state in ERROR_STATES:
+            state = gi.libraries.show_dataset(library_id, dataset_id).get('state', None)
+        states[dataset_id] = state
+    return states
+
+
 def get_sample_datasets(gi, data_lib_id, sample, run, lh):
     # Get the datasets from the current folder.
     lh.write('Searching for the number of datasets for sample %s of run %s.\n' % (sample, run))
-    lib_input_datasets = {}
     lib_content_dicts = gi.libraries.show_library(data_lib_id, contents=True)
-    for lib_content_dict in lib_content_dicts:
-        if lib_content_dict['type'] == 'file':
-            item_name = lib_content_dict['name'].lstrip('/')
-            if item_name.startswith(sample):
-                lib_input_datasets[lib_content_dict['id']] = lib_content_dict['name']
+    lib_input_datasets = find_sample_datasets(lib_content_dicts, sample)
     lh.write('Found %d datasets for sample %s of run %s.\n' % (len(lib_input_datasets), sample, run))
     return lib_input_datasets
+
+
+def reconcile_library_dataset(gi, data_lib_id, dataset_id, file_path, lh, verify_checksum=False, manifest_entry=None):
+    """
+    Compare an existing library dataset with the local gzip compressed file
+    it was uploaded from.  Returns the state of the library dataset if it
+    matches the file or is still being uploaded.  Otherwise the library
+    dataset is deleted so that the file will be uploaded again, and None is
+    returned.  Galaxy may have stored the dataset uncompressed, in which case
+    it is compared with the uncompressed file.  Checksums are compared only
+    if verify_checksum is True and the dataset's file can be read from here.
+    The uncompressed size and checksum of the local file are taken from its
+    fastq manifest entry (see fastq_util) when one is received.
+    """
+    dataset_dict = gi.libraries.show_dataset(data_lib_id, dataset_id)
+    state = dataset_dict.get('state', None)
+    reason = None
+    if state in ERROR_STATES:
+        reason = 'is in state %s' % state
+    elif state == 'ok':
+        galaxy_file_path = dataset_dict.get('file_name', None)
+        if not (galaxy_file_path and os.path.isfile(galaxy_file_path)):
+            galaxy_file_path = None
+        uncompress = not dataset_dict.get('file_ext', '').endswith('.gz')
+        checksum = verify_checksum and galaxy_file_path is not None
+        if manifest_entry is not None and manifest_entry.get('checksum_type', None) == 'md5' and not (checksum and uncompress):
+            # The manifest checksum is that of the compressed file.
+            if uncompress:
+                file_size = manifest_entry['uncompressed_size']
+            else:
+                file_size = manifest_entry['size']
+            md5sum = manifest_entry['checksum']
+        else:
+            file_size, md5sum = api_util.get_file_size_and_md5sum(file_path, uncompress=uncompress, checksum=checksum)
+        if dataset_dict.get('file_size', None) != file_size:
+            reason = 'has size %s instead of %d' % (str(dataset_dict.get('file_size', None)), file_size)
+        elif checksum and api_util.get_file_size_and_md5sum(galaxy_file_path, checksum=True)[1] != md5sum:
+            reason = 'has a different checksum'
+    if reason is None:
+        lh.write('Library dataset %s for %s is in state %s, so it will not be uploaded again.\n' % (dataset_id, file_path, state))
+        return state
+    lh.write('Deleting library dataset %s for %s since it %s.\n' % (dataset_id, file_path, reason))
+    gi.libraries.delete_library_dataset(data_lib_id, dataset_id)
+    return None
+
+
+def wait_for_library_datasets(gi, library_id, dataset_ids, lh, max_wait=3600, min_interval=2, max_interval=60):
+    """
+    Use the Galaxy API to poll the states of the received library datasets
+    until all of them are ok, one of them is in an error state or max_wait
+    seconds have passed.  Each round polls only the datasets that are not yet
+    ok, requesting the contents of their folders rather than each dataset
+    (see get_library_dataset_states).  The interval between rounds starts at min_interval and doubles (up to
+    max_interval) after each round in which no dataset became ok, and is reset
+    to min_interval after a round in which one did.  Returns a tuple
+    containing a list of the ids of the datasets in an error state and a list
+    of the ids of the datasets that are still not ok.
+    """
+    start = time.time()
+    interval = min_interval
+    pending_ids = list(dataset_ids)
+    dataset_folder_ids = {}
+    while True:
+        still_pending_ids = []
+        error_ids = []
+        states = get_library_dataset_states(gi, library_id, pending_ids, dataset_folder_ids=dataset_folder_ids)
+        for dataset_id in pending_ids:
+            state = states[dataset_id]
+            if state == 'ok':
+                continue
+            if state in ERROR_STATES:
+                lh.write('Library dataset %s is in state %s.\n' % (dataset_id, state))
+                error_ids.append(dataset_id)
+            still_pending_ids.append(dataset_id)
+        if error_ids or not still_pending_ids:
+            return error_ids, still_pending_ids
+        elapsed = time.time() - start
+        if elapsed >= max_wait:
+            return [], still_pending_ids
+        if len(still_pending_ids) < len(pending_ids):
+            interval = min_interval
+        lh.write('%d of %d library datasets are ok after %d seconds, checking again in %d seconds.\n' % (len(dataset_ids) - len(still_pending_ids), len(dataset_ids), elapsed, interval))
+        time.sleep(min(interval, max_wait - elapsed))
+        if len(still_pending_ids) == len(pending_ids):
+            interval = min(interval * 2, max_interval)
+        pending_ids = still_pending_ids
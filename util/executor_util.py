@@ -0,0 +1,393 @@
+"""
+Runs commands either on this host or as jobs submitted to a PBS/Torque
+cluster (like the pbs runner in config/galaxy/production/job_conf.xml), so
+that CPU-heavy pre-processing can run on compute nodes instead of the head
+node.  Each command is written to a task script in a job directory, which
+must be on a file system shared with the compute nodes when jobs are
+submitted to the cluster.  A task script redirects the output of its command
+to files and writes its exit code to a file, so both executors wait for
+commands in the same way.  Several commands submitted together are run as a
+job array.
+
+scripts/fake_pbs.py provides qsub, qstat and qdel commands that run jobs on
+this host, so the PBS executor can be tried without a cluster.
+"""
+import errno
+import os
+import pipes
+import re
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+# The exit code of a task that ended without recording one (e.g.,
+# because it was killed for exceeding its walltime or was cancelled).
+MISSING_EXIT_CODE = -1
+# Torque limits job names to 15 characters.
+PBS_MAX_JOB_NAME_LENGTH = 15
+# The number of times in a row qstat may fail for a reason other than the job
+# being unknown (e.g., a pbs_server timeout) before waiting for it is abandoned.
+PBS_MAX_QSTAT_FAILURES = 30
+# The exit code of Torque's qstat for a job the server does not know (e.g.,
+# because it finished and was purged).
+PBS_UNKNOWN_JOB_EXIT_CODE = 153
+# Multipliers for the units of memory in PBS resource lists.
+PBS_MEMORY_UNITS = dict(b=1, kb=1024, mb=1024 ** 2, gb=1024 ** 3, tb=1024 ** 4)
+
+
+class Task(object):
+    """
+    A single command, run by its own script in the job directory.
+    """
+
+    def __init__(self, job_dir, index, cmd):
+        self.cmd = cmd
+        self.index = index
+        self.script = os.path.join(job_dir, 'task_%d.sh' % index)
+        self.stdout_file = os.path.join(job_dir, 'task_%d.out' % index)
+        self.stderr_file = os.path.join(job_dir, 'task_%d.err' % index)
+        self.rc_file = os.path.join(job_dir, 'task_%d.rc' % index)
+        self.rc = None
+        # The time the task was started and its resource usage (see
+        # wait_for_process), which are known only for tasks run on this host.
+        self.start = None
+        self.usage = None
+
+    def read_rc(self):
+        """
+        Return the exit code of the command, or None if it has not finished.
+        """
+        if self.rc is None and os.path.exists(self.rc_file):
+            with open(self.rc_file) as fh:
+                self.rc = int(fh.read().strip())
+        return self.rc
+
+    def write_script(self, cwd):
+        tmp_rc_file = '%s.tmp' % self.rc_file
+        with open(self.script, 'w') as fh:
+            fh.write('#!/bin/bash\n')
+            fh.write('cd %s\n' % pipes.quote(cwd))
+            fh.write('(%s) > %s 2> %s\n' % (self.cmd, pipes.quote(self.stdout_file), pipes.quote(self.stderr_file)))
+            # Write the exit code under a temporary name so
+            # that it is never seen partially written.
+            fh.write('echo $? > %s && mv %s %s\n' % (pipes.quote(tmp_rc_file), pipes.quote(tmp_rc_file), pipes.quote(self.rc_file)))
+
+
+class Job(object):
+    """
+    The tasks submitted together, which a cluster runs as a job array.
+    """
+
+    def __init__(self, name, job_dir, tasks):
+        self.name = name
+        self.job_dir = job_dir
+        self.tasks = tasks
+        # The scheduler's job id.
+        self.id = None
+        # The maximum number of tasks to run at once (None for no limit).
+        self.max_running = None
+        # The tasks not yet started and the processes of those
+        # running when the tasks are run on this host.
+        self.pending = []
+        self.procs = {}
+        # The number of times in a row that checking the state of the job failed.
+        self.status_failures = 0
+
+
+class Executor(object):
+
+    def __init__(self, job_dir, poll_interval=10):
+        self.job_dir = job_dir
+        self.poll_interval = poll_interval
+
+    def cancel(self, job):
+        raise NotImplementedError()
+
+    def cleanup(self, job):
+        """
+        Remove the job directory.
+        """
+        if os.path.exists(job.job_dir):
+            shutil.rmtree(job.job_dir)
+
+    def create_job(self, cmds, name, cwd=None):
+        if not os.path.isdir(self.job_dir):
+            os.makedirs(self.job_dir)
+        job_dir = tempfile.mkdtemp(prefix='%s.' % name, dir=self.job_dir)
+        tasks = []
+        for index, cmd in enumerate(cmds):
+            task = Task(job_dir, index, cmd)
+            task.write_script(cwd or os.getcwd())
+            tasks.append(task)
+        return Job(name, job_dir, tasks)
+
+    def is_finished(self, job, lh):
+        raise NotImplementedError()
+
+    def finished_tasks(self, job, lh, max_wait=None):
+        """
+        Generate each task of the job as soon as it finishes, until every task
+        has finished or max_wait seconds have passed, in which case the job is
+        cancelled.  Tasks that ended without recording an exit code are
+        generated with MISSING_EXIT_CODE once the job has finished.
+        """
+        start = time.time()
+        remaining = list(job.tasks)
+        while True:
+            is_finished = self.is_finished(job, lh)
+            for task in list(remaining):
+                if task.read_rc() is not None:
+                    remaining.remove(task)
+                    yield task
+            if is_finished:
+                break
+            if max_wait is not None and time.time() - start > max_wait:
+                lh.write('Cancelling job %s since it did not finish within %d seconds.\n' % (job.name, max_wait))
+                self.cancel(job)
+                break
+            time.sleep(self.poll_interval)
+        lh.write('Job %s finished in %.1f seconds.\n' % (job.name, time.time() - start))
+        for task in remaining:
+            if task.read_rc() is None:
+                task.rc = MISSING_EXIT_CODE
+            yield task
+
+    def run(self, cmds, name, lh, resources=None, max_running=None, max_wait=None, cwd=None):
+        """
+        Run the commands as a job and wait for all of them to finish, returning
+        the job.  The output and exit code of each command are available from
+        the job's tasks until the job is cleaned up.
+        """
+        job = self.submit(cmds, name, lh, resources=resources, max_running=max_running, cwd=cwd)
+        self.wait(job, lh, max_wait=max_wait)
+        return job
+
+    def submit(self, cmds, name, lh, resources=None, max_running=None, cwd=None):
+        """
+        Submit the commands (a string or a list of strings) as a job
+        requesting the resources (a PBS resource list like
+        walltime=48:00:00,ncpus=4,mem=8gb) for each command, running
+        at most max_running of them at once in the directory cwd (by
+        default, the current directory).
+        """
+        raise NotImplementedError()
+
+    def wait(self, job, lh, max_wait=None):
+        """
+        Wait until every task of the job has finished or max_wait seconds
+        have passed, in which case the job is cancelled.  Returns the exit
+        codes of the tasks.
+        """
+        for task in self.finished_tasks(job, lh, max_wait=max_wait):
+            pass
+        return [task.rc for task in job.tasks]
+
+
+class LocalExecutor(Executor):
+    """
+    Runs the tasks of each job as processes on this host, at most max_jobs
+    (by default, all of them) or the job's max_running at once.
+    """
+
+    def __init__(self, job_dir, max_jobs=None, poll_interval=1):
+        super(LocalExecutor, self).__init__(job_dir, poll_interval=poll_interval)
+        self.max_jobs = max_jobs
+
+    def cancel(self, job):
+        job.pending = []
+        for proc in job.procs.values():
+            if proc.poll() is None:
+                # Kill the command along with the script running it.
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+        job.procs = {}
+
+    def is_finished(self, job, lh):
+        for index, proc in list(job.procs.items()):
+            usage = wait_for_process(proc, options=os.WNOHANG)
+            if usage is not None:
+                task = job.tasks[index]
+                usage['wall_time'] = time.time() - task.start
+                task.usage = usage
+                del job.procs[index]
+        self.start_pending(job)
+        return not job.pending and not job.procs
+
+    def start_pending(self, job):
+        max_running = min([limit for limit in [self.max_jobs, job.max_running, len(job.tasks)] if limit] or [1])
+        while job.pending and len(job.procs) < max_running:
+            task = job.pending.pop(0)
+            task.start = time.time()
+            # Each task is the leader of its own process group so it can be cancelled.
+            job.procs[task.index] = subprocess.Popen(['bash', task.script], preexec_fn=os.setpgrp)
+
+    def submit(self, cmds, name, lh, resources=None, max_running=None, cwd=None):
+        if isinstance(cmds, basestring):
+            cmds = [cmds]
+        job = self.create_job(cmds, name, cwd=cwd)
+        job.max_running = max_running
+        # There is nothing to request on this host, so resources are ignored.
+        lh.write('Running %d commands as job %s on this host.\n' % (len(job.tasks), name))
+        job.pending = list(job.tasks)
+        self.start_pending(job)
+        return job
+
+
+class PBSExecutor(Executor):
+    """
+    Submits each job to a PBS/Torque cluster using qsub, as a job array if it
+    has more than one task, and polls qstat until the job is complete (in
+    state C, which Torque keeps jobs in for keep_completed seconds) or gone.
+    """
+
+    def __init__(self, job_dir, qsub='qsub', qstat='qstat', qdel='qdel', queue=None, poll_interval=10):
+        super(PBSExecutor, self).__init__(job_dir, poll_interval=poll_interval)
+        self.qsub = shlex.split(qsub)
+        self.qstat = shlex.split(qstat)
+        self.qdel = shlex.split(qdel)
+        self.queue = queue
+
+    def cancel(self, job):
+        if job.id is not None:
+            subprocess.call(self.qdel + [job.id])
+
+    def get_job_states(self, job):
+        """
+        Return the states (e.g., Q, R or C) of the job and of each task of a
+        job array reported by qstat, or None if the server does not know the
+        job.  Raises OSError if qstat fails for any other reason.
+        """
+        proc = subprocess.Popen(self.qstat + ['-f', '-t', job.id], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode == PBS_UNKNOWN_JOB_EXIT_CODE or 'Unknown Job Id' in stderr:
+            return None
+        if proc.returncode != 0:
+            raise OSError('qstat failed with exit code %d: %s' % (proc.returncode, stderr.strip()))
+        states = re.findall(r'^\s*job_state\s*=\s*(\w+)', stdout, re.M)
+        if not states:
+            raise OSError('qstat did not report the state of job %s.' % job.id)
+        return states
+
+    def is_finished(self, job, lh):
+        if all(task.read_rc() is not None for task in job.tasks):
+            return True
+        try:
+            states = self.get_job_states(job)
+        except OSError, e:
+            # The server may be busy, so try again at the next poll.
+            job.status_failures += 1
+            if job.status_failures >= PBS_MAX_QSTAT_FAILURES:
+                raise OSError('Checking the state of job %s failed %d times in a row: %s' % (job.name, job.status_failures, str(e)))
+            lh.write('Checking the state of job %s failed, trying again: %s\n' % (job.name, str(e)))
+            return False
+        job.status_failures = 0
+        # Tasks that still have not recorded an exit code
+        # once the job is complete or gone were killed.
+        return states is None or all(state == 'C' for state in states)
+
+    def submit(self, cmds, name, lh, resources=None, max_running=None, cwd=None):
+        if isinstance(cmds, basestring):
+            cmds = [cmds]
+        job = self.create_job(cmds, name, cwd=cwd)
+        job.max_running = max_running
+        cmd = self.qsub + ['-N', re.sub(r'[^\w.-]', '_', name)[:PBS_MAX_JOB_NAME_LENGTH],
+                           # Export the environment so that commands found on
+                           # the $PATH here (e.g., via modules) are found there.
+                           '-V',
+                           '-j', 'oe',
+                           '-o', os.path.join(job.job_dir, 'pbs.log')]
+        if self.queue:
+            cmd += ['-q', self.queue]
+        if resources:
+            cmd += ['-l', resources]
+        if len(job.tasks) == 1:
+            script = job.tasks[0].script
+        else:
+            # Each task of the job array runs the script for its index.
+            script = os.path.join(job.job_dir, 'array.sh')
+            with open(script, 'w') as fh:
+                fh.write('#!/bin/bash\n')
+                fh.write('exec bash %s/task_${PBS_ARRAYID}.sh\n' % pipes.quote(job.job_dir))
+            array = '0-%d' % (len(job.tasks) - 1)
+            if max_running:
+                # Torque's limit on the number of array tasks running at once.
+                array += '%%%d' % max_running
+            cmd += ['-t', array]
+        cmd.append(script)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise OSError('Submitting job %s failed with exit code %d: %s' % (name, proc.returncode, stderr.strip()))
+        job.id = stdout.strip()
+        lh.write('Submitted %d commands as job %s with id %s.\n' % (len(job.tasks), name, job.id))
+        return job
+
+
+def get_executor(config, job_dir):
+    """
+    Return the executor selected by the EXECUTOR setting in config (local or
+    pbs), which creates its job directories in job_dir.
+    """
+    name = (config.get('EXECUTOR', default=None) or 'local').strip().lower()
+    if name == 'local':
+        return LocalExecutor(job_dir, max_jobs=config.get_int('LOCAL_EXECUTOR_MAX_JOBS', default=None))
+    if name == 'pbs':
+        return PBSExecutor(job_dir,
+                           qsub=config.get('PBS_QSUB_COMMAND', default=None) or 'qsub',
+                           qstat=config.get('PBS_QSTAT_COMMAND', default=None) or 'qstat',
+                           qdel=config.get('PBS_QDEL_COMMAND', default=None) or 'qdel',
+                           queue=config.get('PBS_QUEUE', default=None) or None,
+                           poll_interval=config.get_int('EXECUTOR_POLL_INTERVAL', default=10))
+    raise ValueError('Invalid EXECUTOR setting %s, it must be local or pbs.' % name)
+
+
+def parse_resource_list(resources):
+    """
+    Return a dictionary of the items in a PBS resource list like
+    walltime=48:00:00,ncpus=4,mem=8gb, with ncpus converted to an
+    integer and mem converted to bytes.
+    """
+    resource_dict = {}
+    for item in (resources or '').split(','):
+        if '=' not in item:
+            continue
+        key, value = [token.strip() for token in item.split('=', 1)]
+        if key == 'ncpus':
+            value = int(value)
+        elif key == 'mem':
+            match = re.match(r'^(\d+)\s*([kmgt]?b)?$', value.lower())
+            if match is None:
+                raise ValueError('Invalid mem %s in resource list %s.' % (value, resources))
+            value = int(match.group(1)) * PBS_MEMORY_UNITS[match.group(2) or 'b']
+        resource_dict[key] = value
+    return resource_dict
+
+
+def wait_for_process(proc, options=0):
+    """
+    Wait for the subprocess.Popen process using wait4, which does not block
+    if options is os.WNOHANG, and set its returncode.  Returns None if the
+    process is still running, otherwise a dictionary containing the CPU time
+    in seconds and the peak resident set size in bytes of the process and
+    the descendants it waited for.  Linux reports ru_maxrss in kilobytes.
+    """
+    if proc.returncode is not None:
+        # The process was already waited for, so its usage is unknown.
+        return dict(cpu_time=None, peak_rss=None)
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, options)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return dict(cpu_time=rusage.ru_utime + rusage.ru_stime, peak_rss=rusage.ru_maxrss * 1024)
@@ -0,0 +1,302 @@
+"""
+Validates fastq files produced by bcl2fastq without requiring any external
+validator.  A file (optionally gzip compressed, with any number of members
+and with or without an empty end of file member) is streamed in large
+batches of records, so memory use does not depend on the size of the file.
+Each batch is checked using operations on the whole batch rather than on
+each record.  Since this is the only time the pipeline reads the files, the
+checksum of the file, its uncompressed size and the number of reads and bases
+and read length histogram are computed along the way.  These are stored in a
+manifest in the directory containing the files so that later steps need not
+read the files again.
+
+Duplicate read ids are found by piping the ids through sort and uniq, which
+keep at most a fixed amount of data in memory and spill the rest to disk.
+"""
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import tempfile
+
+# Number of bytes of uncompressed data read at a time.
+BATCH_SIZE = 8388608
+# Characters allowed in sequences and in (phred+33) quality strings.
+BASE_CHARS = b'ACGTNacgtn.'
+QUALITY_CHARS = bytes(bytearray(range(ord('!'), ord('~') + 1)))
+# Name of the manifest file in the directory containing the fastq files.
+MANIFEST_FILE_NAME = 'fastq_manifest.json'
+# Memory used by sort when finding duplicate read ids.
+SORT_BUFFER_SIZE = '64M'
+
+
+class ValidatorError(Exception):
+    """
+    Raised when a file cannot be validated for a reason that has nothing to
+    do with its contents (e.g., the duplicate read id pipeline failed).
+    """
+
+
+class HashingFile(object):
+    """
+    Wraps a file opened for reading, computing the checksum of its contents
+    as they are read.  The gzip module may seek backward to re-read data or
+    seek to the end of the file, so each byte is hashed only once and in
+    order no matter how the file is read.
+    """
+
+    def __init__(self, fh, checksum_type='md5'):
+        self.fh = fh
+        self.hash = hashlib.new(checksum_type)
+        # The number of bytes at the beginning of the file that have been hashed.
+        self.hashed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def hash_to(self, offset):
+        pos = self.fh.tell()
+        self.fh.seek(self.hashed)
+        while self.hashed < offset:
+            data = self.fh.read(min(BATCH_SIZE, offset - self.hashed))
+            if not data:
+                break
+            self.hash.update(data)
+            self.hashed += len(data)
+        self.fh.seek(pos)
+
+    def hexdigest(self):
+        # Include any data that was skipped.
+        self.hash_to(os.fstat(self.fh.fileno()).st_size)
+        return self.hash.hexdigest()
+
+    def read(self, size=-1):
+        pos = self.fh.tell()
+        if pos > self.hashed:
+            self.hash_to(pos)
+        data = self.fh.read(size)
+        if pos + len(data) > self.hashed:
+            self.hash.update(data[self.hashed - pos:])
+            self.hashed = pos + len(data)
+        return data
+
+
+def find_duplicate_ids(proc):
+    """
+    Return the read ids that the duplicate id pipeline found more than once.
+    """
+    proc.stdin.close()
+    duplicate_ids = proc.stdout.read().split()
+    proc.stdout.close()
+    proc.wait()
+    if proc.returncode != 0:
+        raise ValidatorError('Checking for duplicate read ids failed with exit code %d.' % proc.returncode)
+    return duplicate_ids
+
+
+def get_invalid_record(headers, seqs, pluses, quals):
+    """
+    Return the index within the batch of the first invalid record
+    and the reason it is invalid.
+    """
+    for i in range(len(headers)):
+        if not headers[i].startswith(b'@'):
+            return i, 'the header line does not start with @'
+        if not pluses[i].startswith(b'+'):
+            return i, 'the third line does not start with +'
+        if len(seqs[i]) != len(quals[i]):
+            return i, 'the sequence has %d bases but the quality string has %d characters' % (len(seqs[i]), len(quals[i]))
+        if seqs[i].translate(None, BASE_CHARS):
+            return i, 'the sequence contains characters other than %s' % BASE_CHARS.decode()
+        if quals[i].translate(None, QUALITY_CHARS):
+            return i, 'the quality string contains characters outside of the range ! to ~'
+    return None, None
+
+
+def get_manifest_entry(manifest, file_path):
+    """
+    Return the manifest entry for the file if the file was valid and
+    has not changed since the entry was created, otherwise None.
+    """
+    entry = manifest.get(os.path.basename(file_path), None)
+    if entry is None or not entry.get('valid', False):
+        return None
+    stat = os.stat(file_path)
+    if entry.get('size', None) != stat.st_size or entry.get('mtime', None) != int(stat.st_mtime):
+        return None
+    return entry
+
+
+def open_fastq(hashing_fh, file_path):
+    if file_path.endswith('.gz'):
+        return gzip.GzipFile(filename=file_path, mode='rb', fileobj=hashing_fh)
+    return hashing_fh
+
+
+def read_manifest(directory):
+    """
+    Return the manifest in the directory, or an empty manifest if there is none.
+    """
+    manifest_file = os.path.join(directory, MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file) as fh:
+        return json.load(fh)
+
+
+def send_read_ids(proc, headers):
+    """
+    Send the header lines to the duplicate id pipeline.
+    """
+    try:
+        proc.stdin.write(b'\n'.join(headers) + b'\n')
+    except IOError as e:
+        # E.g., sort ran out of temporary space and exited.
+        raise ValidatorError('Checking for duplicate read ids failed: %s' % str(e))
+
+
+def start_duplicate_id_pipeline(tmp_dir=None):
+    """
+    Start the pipeline that receives fastq header lines and reports the read
+    ids that occur more than once.  The read id is the header up to the first
+    space (bcl2fastq adds a comment containing the read number and index).
+    """
+    if tmp_dir is None:
+        tmp_dir = tempfile.gettempdir()
+    cmd = "cut -d ' ' -f 1 | LC_ALL=C sort -S %s -T %s | LC_ALL=C uniq -d" % (SORT_BUFFER_SIZE, tmp_dir)
+    return subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def stop_duplicate_id_pipeline(proc):
+    """
+    Stop the duplicate id pipeline without waiting for its results.
+    """
+    try:
+        proc.stdin.close()
+    except IOError:
+        # The pipeline has already exited.
+        pass
+    proc.kill()
+    proc.wait()
+
+
+def validate_fastq(file_path, check_duplicate_ids=True, tmp_dir=None, checksum_type='md5'):
+    """
+    Validate the fastq file, returning a dictionary containing whether it is
+    valid, the reason it is not (or None), the size and modification time of
+    the file, its checksum and uncompressed size, the numbers of reads and
+    bases and a dictionary mapping each read length to the number of reads
+    with that length.  The checksum, uncompressed size and read statistics
+    are only complete for valid files.  Each record must consist of a header
+    line starting with @, a sequence, a line starting with + and a quality
+    string with the same length as the sequence containing only phred+33
+    characters, and no read id may occur more than once.  Raises
+    ValidatorError if the file cannot be validated.
+    """
+    stat = os.stat(file_path)
+    result = dict(valid=True,
+                  error=None,
+                  size=stat.st_size,
+                  mtime=int(stat.st_mtime),
+                  checksum=None,
+                  checksum_type=checksum_type,
+                  uncompressed_size=0,
+                  reads=0,
+                  bases=0,
+                  length_histogram={})
+    length_counts = {}
+    proc = None
+    if check_duplicate_ids:
+        proc = start_duplicate_id_pipeline(tmp_dir=tmp_dir)
+    remainder = b''
+    hashing_fh = HashingFile(open(file_path, 'rb'), checksum_type=checksum_type)
+    fh = open_fastq(hashing_fh, file_path)
+    # Whether the file was read to the end or to its first invalid record.
+    completed = False
+    try:
+        while True:
+            data = fh.read(BATCH_SIZE)
+            result['uncompressed_size'] += len(data)
+            lines = (remainder + data).split(b'\n')
+            if data:
+                # Keep the lines of the last incomplete record for the next batch.
+                num_lines = (len(lines) - 1) // 4 * 4
+                remainder = b'\n'.join(lines[num_lines:])
+                lines = lines[:num_lines]
+            else:
+                if lines[-1] == b'':
+                    # The file ends with a newline.
+                    lines.pop()
+                if len(lines) % 4 != 0:
+                    result['valid'] = False
+                    result['error'] = 'Record %d is incomplete, the file ends after %d of its 4 lines.' % (result['reads'] + 1, len(lines) % 4)
+                    break
+            if lines:
+                headers = lines[0::4]
+                seqs = lines[1::4]
+                pluses = lines[2::4]
+                quals = lines[3::4]
+                # Each of these checks processes the whole batch at once, and
+                # each record is checked individually only if a check fails.
+                if b'\n'.join([b''] + headers).count(b'\n@') != len(headers) or \
+                        b'\n'.join([b''] + pluses).count(b'\n+') != len(pluses) or \
+                        list(map(len, seqs)) != list(map(len, quals)) or \
+                        b''.join(seqs).translate(None, BASE_CHARS) or \
+                        b''.join(quals).translate(None, QUALITY_CHARS):
+                    i, reason = get_invalid_record(headers, seqs, pluses, quals)
+                    result['valid'] = False
+                    result['error'] = 'Record %d is invalid, %s.' % (result['reads'] + i + 1, reason)
+                    break
+                lengths = sorted(map(len, seqs))
+                for length, group in itertools.groupby(lengths):
+                    length_counts[length] = length_counts.get(length, 0) + len(list(group))
+                result['reads'] += len(headers)
+                result['bases'] += sum(lengths)
+                if proc is not None:
+                    send_read_ids(proc, headers)
+            if not data:
+                break
+        completed = True
+    except ValidatorError:
+        raise
+    except Exception as e:
+        # The gzip and zlib modules raise a variety of exceptions (e.g.,
+        # IOError, EOFError, zlib.error, struct.error and even TypeError)
+        # for truncated or corrupt files.
+        result['valid'] = False
+        result['error'] = 'The file could not be read: %s' % str(e)
+        completed = True
+    finally:
+        if completed and result['valid']:
+            result['checksum'] = hashing_fh.hexdigest()
+        fh.close()
+        hashing_fh.close()
+        if proc is not None and not (completed and result['valid']):
+            stop_duplicate_id_pipeline(proc)
+    if proc is not None and result['valid']:
+        duplicate_ids = find_duplicate_ids(proc)
+        if duplicate_ids:
+            result['valid'] = False
+            result['error'] = 'The file contains %d duplicate read ids, including %s.' % (len(duplicate_ids), duplicate_ids[0].decode())
+    # JSON object keys must be strings.
+    result['length_histogram'] = dict((str(length), count) for length, count in sorted(length_counts.items()))
+    return result
+
+
+def write_manifest(directory, results):
+    """
+    Add the validation results, keyed by file name, to the manifest in the
+    directory.  The manifest is replaced atomically so that it is never seen
+    partially written.
+    """
+    manifest = read_manifest(directory)
+    for file_path, result in results.items():
+        manifest[os.path.basename(file_path)] = result
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix='.%s.' % MANIFEST_FILE_NAME)
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(manifest, fh, indent=4, sort_keys=True)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp_file, os.path.join(directory, MANIFEST_FILE_NAME))
@@ -1,3 +1,7 @@
+import api_util
+
+# History dataset states that will not change to ok without intervention.
+ERROR_STATES = ['discarded', 'error', 'failed_metadata']
 
 
 def add_library_dataset_to_history(gi, dbkey, history_id, history_name, dataset_id, history_input_datasets, lh):
@@ -44,3 +48,40 @@ def update_dataset(gi, dbkey, history_id, history_name, history_input_datasets,
             new_hda_name = new_hda_dict['name']
             history_input_datasets[new_hda_name] = new_hda_dict
     return history_input_datasets
+
+
+def wait_for_datasets(gi, history_id, history_name, dataset_ids, lh, max_wait=600):
+    """
+    Wait for the history datasets to be ok, raising an exception if one of
+    them is in an error state or they are not all ok within max_wait seconds.
+    """
+    pending_ids = list(dataset_ids)
+
+    def is_ready():
+        for dataset_id in list(pending_ids):
+            state = gi.histories.show_dataset(history_id, dataset_id)['state']
+            if state in ERROR_STATES:
+                raise Exception('Dataset %s in history %s is in state %s.' % (dataset_id, history_name, state))
+            if state == 'ok':
+                pending_ids.remove(dataset_id)
+        return len(pending_ids) == 0
+
+    lh.write('Waiting for %d datasets in history %s to be ready.\n' % (len(pending_ids), history_name))
+    if not api_util.wait_until(is_ready, max_wait=max_wait):
+        raise Exception('Datasets %s in history %s were not ready after %d seconds.' % (', '.join(pending_ids), history_name, max_wait))
+
+
+def wait_for_history(gi, history_id, history_name, lh, max_wait=600):
+    """
+    Wait for a newly created history to be available, raising an
+    exception if it is not available within max_wait seconds.
+    """
+    def is_ready():
+        try:
+            return gi.histories.show_history(history_id)['id'] == history_id
+        except Exception:
+            return False
+
+    if not api_util.wait_until(is_ready, max_wait=max_wait):
+        raise Exception('History %s was not available after %d seconds.' % (history_name, max_wait))
+    lh.write('History %s is available.\n' % history_name)
@@ -0,0 +1,169 @@
+"""
+Provides an HTTP client that keeps connections to each host alive for reuse,
+applies a timeout to every request, retries failed requests a bounded number
+of times with exponential backoff and jitter, and gzip compresses large
+request bodies.  Requests using methods that are not idempotent (e.g., POST)
+are only retried if the connection could not be opened, since the server may
+have acted on a request that failed after it was sent.
+
+The CEGR statistics tools include an identical copy of this module since they
+are installed into Galaxy independently of this pipeline.
+"""
+import gzip
+import io
+import random
+import socket
+import threading
+import time
+
+from six.moves import http_client
+from six.moves.urllib.parse import urlsplit
+
+# Responses with these status codes are retried since the
+# server was unable to handle the request at the time.
+RETRY_STATUSES = [502, 503, 504]
+# Requests using these methods can be sent again without side effects.
+IDEMPOTENT_METHODS = ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT']
+
+# The clients shared by this process keyed by their settings.
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+class HTTPConnectionError(IOError):
+    """
+    Raised when a request could not be completed after all retries.
+    """
+
+
+class HTTPResponseError(Exception):
+    """
+    Raised when the server responds with an error status.  Like urllib's
+    HTTPError, the response body is available using read().
+    """
+
+    def __init__(self, url, status, reason, body):
+        Exception.__init__(self, 'HTTP Error %d: %s' % (status, reason))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class HTTPClient(object):
+
+    def __init__(self, timeout=60, retries=3, backoff=1.0, max_backoff=30.0, gzip_min_size=65536):
+        # A gzip_min_size of 0 disables compressing request bodies.
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.gzip_min_size = gzip_min_size
+        # Idle connections keyed by (scheme, netloc).
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            for connections in self.connections.values():
+                for connection in connections:
+                    connection.close()
+            self.connections = {}
+
+    def get_connection(self, scheme, netloc):
+        with self.lock:
+            connections = self.connections.get((scheme, netloc), [])
+            if connections:
+                return connections.pop()
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http_client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release_connection(self, scheme, netloc, connection):
+        with self.lock:
+            self.connections.setdefault((scheme, netloc), []).append(connection)
+
+    def sleep(self, attempt):
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        time.sleep(random.uniform(0, delay))
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, data, headers=None):
+        return self.request('POST', url, data=data, headers=headers)
+
+    def request(self, method, url, data=None, headers=None):
+        """
+        Send the request and return the (decompressed) response body.
+        """
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        request_headers = {'Accept-Encoding': 'gzip'}
+        request_headers.update(headers or {})
+        if data is not None:
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            if self.gzip_min_size and len(data) >= self.gzip_min_size:
+                data = compress(data)
+                request_headers['Content-Encoding'] = 'gzip'
+        for attempt in range(self.retries + 1):
+            connection = self.get_connection(parts.scheme, parts.netloc)
+            # Whether the server may have received the request.
+            sent = False
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                sent = True
+                connection.request(method, path, data, request_headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (socket.error, http_client.HTTPException) as e:
+                # The connection may have been closed by the server
+                # while idle, so never reuse it.
+                connection.close()
+                if attempt == self.retries or (sent and method not in IDEMPOTENT_METHODS):
+                    raise HTTPConnectionError('%s %s failed after %d attempts: %s' % (method, parts.netloc, attempt + 1, str(e)))
+                self.sleep(attempt)
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self.release_connection(parts.scheme, parts.netloc, connection)
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                body = decompress(body)
+            if response.status in RETRY_STATUSES and attempt < self.retries and method in IDEMPOTENT_METHODS:
+                self.sleep(attempt)
+                continue
+            if response.status >= 400:
+                raise HTTPResponseError(url, response.status, response.reason, body)
+            return body
+
+
+def compress(data):
+    buf = io.BytesIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb')
+    gz.write(data)
+    gz.close()
+    return buf.getvalue()
+
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def get_client(**kwd):
+    """
+    Return the HTTP client shared by this process that was created with the
+    received keyword arguments, creating it the first time they are received.
+    """
+    key = tuple(sorted(kwd.items()))
+    with CLIENTS_LOCK:
+        if key not in CLIENTS:
+            CLIENTS[key] = HTTPClient(**kwd)
+        return CLIENTS[key]
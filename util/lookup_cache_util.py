@@ -0,0 +1,88 @@
+"""
+Provides a cache of the Galaxy data libraries, library folders and contents,
+and workflows looked up while processing a run.  Each is requested from
+Galaxy the first time it is needed, and later lookups (e.g., for the other
+samples in the run) are answered from memory.  A cache should only be used
+for a single run.  Since the samples of a run may be added to its data library
+while its workflows are being started (see run_pipeline.py), the folders and
+contents of a data library are requested again when a sample's folder or
+datasets are missing from them.
+"""
+import copy
+import threading
+
+import data_library_util
+import workflow_util
+
+
+class LookupCache(object):
+
+    def __init__(self):
+        self.data_libraries = {}
+        self.folders = {}
+        self.library_contents = {}
+        self.workflows = {}
+        # Lookups may be made by concurrent workers, so only one
+        # of them fetches any particular item.  Items that were
+        # not found are looked up again the next time.
+        self.lock = threading.Lock()
+
+    def get_blacklist_filter_dataset_id(self, gi, data_lib_id, dbkey, lh):
+        lh.write('Searching for blacklist filter dataset for dbkey %s.\n' % dbkey)
+        lib_item_dicts = self.get_library_contents(gi, data_lib_id)
+        return data_library_util.find_blacklist_filter_dataset_id(lib_item_dicts, dbkey, lh)
+
+    def get_data_library(self, gi, name, lh):
+        with self.lock:
+            if self.data_libraries.get(name, None) is None:
+                self.data_libraries[name] = data_library_util.get_data_library(gi, name, lh)
+            return self.data_libraries[name]
+
+    def get_folder(self, gi, data_lib_id, data_lib_name, name, lh):
+        lh.write('Searching for folder named %s from data library %s.\n' % (name, data_lib_name))
+        with self.lock:
+            if name not in self.folders.get(data_lib_id, {}):
+                folder_ids = {}
+                for folder_dict in gi.libraries.get_folders(data_lib_id, folder_id=None, name=None):
+                    # Keep the first folder with each name.
+                    folder_ids.setdefault(folder_dict['name'].lstrip('/'), folder_dict['id'])
+                self.folders[data_lib_id] = folder_ids
+            folder_id = self.folders[data_lib_id].get(name, None)
+        if folder_id is not None:
+            lh.write('Found folder named %s from data library %s.\n' % (name, data_lib_name))
+        return folder_id
+
+    def get_library_contents(self, gi, data_lib_id, refresh=False):
+        with self.lock:
+            if refresh or data_lib_id not in self.library_contents:
+                self.library_contents[data_lib_id] = gi.libraries.show_library(data_lib_id, contents=True)
+            return self.library_contents[data_lib_id]
+
+    def get_sample_datasets(self, gi, data_lib_id, sample, run, lh, num_datasets=None):
+        """
+        Return the datasets for the sample, requesting the library contents
+        again if fewer than num_datasets (the number of datasets in the
+        sample's folder, if known) are found.
+        """
+        lh.write('Searching for the number of datasets for sample %s of run %s.\n' % (sample, run))
+        lib_content_dicts = self.get_library_contents(gi, data_lib_id)
+        lib_input_datasets = data_library_util.find_sample_datasets(lib_content_dicts, sample)
+        if num_datasets is not None and len(lib_input_datasets) < num_datasets:
+            lib_content_dicts = self.get_library_contents(gi, data_lib_id, refresh=True)
+            lib_input_datasets = data_library_util.find_sample_datasets(lib_content_dicts, sample)
+        lh.write('Found %d datasets for sample %s of run %s.\n' % (len(lib_input_datasets), sample, run))
+        return lib_input_datasets
+
+    def get_workflow(self, gi, name, lh, galaxy_base_url=None, api_key=None, for_inputs=False):
+        key = (name, for_inputs)
+        with self.lock:
+            if self.workflows.get(key, (None, None))[0] is None:
+                self.workflows[key] = workflow_util.get_workflow(gi,
+                                                                 name,
+                                                                 lh,
+                                                                 galaxy_base_url=galaxy_base_url,
+                                                                 api_key=api_key,
+                                                                 for_inputs=for_inputs)
+            workflow_id, workflow_dict = self.workflows[key]
+        # Callers may change the returned workflow.
+        return workflow_id, copy.deepcopy(workflow_dict)
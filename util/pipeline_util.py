@@ -0,0 +1,304 @@
+"""
+Keeps the state of each run in the pre-processing pipeline, of each of its
+steps (stages) and of each sample in each stage in a local SQLite database.
+Each state is one of pending, running, done or failed, and is kept with the
+times it was last started and finished and the number of times it has been
+started.  A stage is named for the script that performs it.
+
+The database lets the scripts run at the same time as a pipeline in which
+each sample moves on to the next stage as soon as it has finished the previous
+one instead of when every sample in the run has (see run_pipeline.py).  Each
+script records each sample that it starts and finishes, and records when it
+is finished with the whole run so that the next stage does not wait for
+samples that will never be finished.  It also lets run_pipeline.py resume a
+run after a crash without repeating the stages and samples that were done.
+
+Each operation opens its own connection, so a PipelineState can be used by
+several threads and the database by several processes.
+"""
+import contextlib
+import os
+import sqlite3
+import time
+
+DONE = 'done'
+FAILED = 'failed'
+PENDING = 'pending'
+RUNNING = 'running'
+# The name of the database file in ANALYSIS_PREP_LOG_FILE_DIR
+# used unless the PIPELINE_STATE_DB setting is set.
+DB_FILE_NAME = 'pipeline_state.db'
+# Seconds to wait for another process to finish writing to the database.
+DB_TIMEOUT = 60
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS runs (run TEXT NOT NULL,
+                                            state TEXT NOT NULL,
+                                            attempts INTEGER NOT NULL DEFAULT 0,
+                                            started TEXT,
+                                            finished TEXT,
+                                            error TEXT,
+                                            PRIMARY KEY (run))''',
+          '''CREATE TABLE IF NOT EXISTS stages (run TEXT NOT NULL,
+                                              stage TEXT NOT NULL,
+                                              state TEXT NOT NULL,
+                                              attempts INTEGER NOT NULL DEFAULT 0,
+                                              started TEXT,
+                                              finished TEXT,
+                                              error TEXT,
+                                              PRIMARY KEY (run, stage))''',
+          '''CREATE TABLE IF NOT EXISTS samples (run TEXT NOT NULL,
+                                               stage TEXT NOT NULL,
+                                               sample TEXT NOT NULL,
+                                               state TEXT NOT NULL,
+                                               attempts INTEGER NOT NULL DEFAULT 0,
+                                               started TEXT,
+                                               finished TEXT,
+                                               error TEXT,
+                                               PRIMARY KEY (run, stage, sample))''']
+# The stages in the order in which samples pass through them.
+STAGES = ['bcl2fastq.py', 'send_data_to_galaxy.py', 'start_workflows.py']
+
+
+class PipelineState(object):
+    """
+    The state of a run, keyed by the name of its run directory,
+    and of its stages and samples.
+    """
+
+    def __init__(self, db_file, run):
+        self.db_file = db_file
+        self.run = str(run)
+        with self.connect() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.execute('INSERT OR IGNORE INTO runs (run, state) VALUES (?, ?)', (self.run, PENDING))
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Open a connection to the database, committing any changes (or
+        rolling them back if an exception is raised) and closing it when
+        finished.
+        """
+        conn = connect(self.db_file)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def finish_run(self, failed=False, error=None):
+        self.set_state('runs', dict(run=self.run), FAILED if failed else DONE, error=error)
+
+    def get_finished_samples(self, stage, samples):
+        """
+        Return a dictionary mapping each of the samples that has finished
+        the stage to its state (DONE or FAILED).  Once the stage has finished
+        for the whole run, the samples that were not finished have the state
+        of the stage.
+        """
+        stage_state = self.get_stage_state(stage)
+        if stage_state not in [DONE, FAILED]:
+            stage_state = None
+        with self.connect() as conn:
+            rows = conn.execute('SELECT sample, state FROM samples WHERE run = ? AND stage = ?', (self.run, stage)).fetchall()
+        sample_states = dict((row['sample'], row['state']) for row in rows)
+        finished_samples = {}
+        for sample in samples:
+            state = sample_states.get(str(sample), None)
+            if state not in [DONE, FAILED]:
+                state = stage_state
+            if state is not None:
+                finished_samples[sample] = state
+        return finished_samples
+
+    def get_sample_state(self, stage, sample):
+        return self.get_state('samples', dict(run=self.run, stage=stage, sample=str(sample)))
+
+    def get_samples(self):
+        """
+        Return the rows for the samples of the run in the order of the stages.
+        """
+        with self.connect() as conn:
+            rows = conn.execute('SELECT * FROM samples WHERE run = ? ORDER BY sample', (self.run,)).fetchall()
+        return sorted(rows, key=lambda row: get_stage_index(row['stage']))
+
+    def get_stage_state(self, stage):
+        return self.get_state('stages', dict(run=self.run, stage=stage))
+
+    def get_stages(self):
+        """
+        Return the rows for the stages of the run in the order of the stages.
+        """
+        with self.connect() as conn:
+            rows = conn.execute('SELECT * FROM stages WHERE run = ?', (self.run,)).fetchall()
+        return sorted(rows, key=lambda row: get_stage_index(row['stage']))
+
+    def get_state(self, table, keys):
+        """
+        Return the state of the row of the table with the received
+        key values, or None if there is no such row.
+        """
+        names = sorted(keys)
+        with self.connect() as conn:
+            row = conn.execute('SELECT state FROM %s WHERE %s' % (table, ' AND '.join('%s = ?' % name for name in names)),
+                               [keys[name] for name in names]).fetchone()
+        if row is None:
+            return None
+        return row['state']
+
+    def mark_sample(self, stage, sample, failed=False, error=None):
+        self.set_state('samples', dict(run=self.run, stage=stage, sample=str(sample)), FAILED if failed else DONE, error=error)
+
+    def mark_stage(self, stage, failed=False, error=None):
+        """
+        Record that the stage has finished for the whole run.  If failed is
+        True, samples that have not finished are considered to have failed,
+        otherwise they are considered to have nothing to do in the stage.
+        """
+        self.set_state('stages', dict(run=self.run, stage=stage), FAILED if failed else DONE, error=error)
+
+    def recover(self, error='Interrupted'):
+        """
+        Mark the run and any of its stages and samples that are still
+        running, which must have been interrupted, as failed.  Returns
+        the number of stages and samples that were marked.
+        """
+        finished = get_current_time()
+        num_recovered = 0
+        with self.connect() as conn:
+            for table in ['runs', 'stages', 'samples']:
+                cursor = conn.execute('UPDATE %s SET state = ?, finished = ?, error = ? WHERE run = ? AND state = ?' % table,
+                                      (FAILED, finished, error, self.run, RUNNING))
+                if table != 'runs':
+                    num_recovered += cursor.rowcount
+        return num_recovered
+
+    def reset_stage(self, stage):
+        """
+        Set the stage and its samples back to pending so that samples
+        finished by a previous execution are not mistaken for samples
+        that are ready.  The numbers of attempts are kept.
+        """
+        self.set_state('stages', dict(run=self.run, stage=stage), PENDING)
+        with self.connect() as conn:
+            conn.execute('UPDATE samples SET state = ?, finished = NULL, error = NULL WHERE run = ? AND stage = ?', (PENDING, self.run, stage))
+
+    def set_state(self, table, keys, state, error=None, started=None):
+        """
+        Set the state of the row of the table with the received key values,
+        creating it if necessary.  Starting (RUNNING) increments the number
+        of attempts and sets the start time (to started if received,
+        otherwise now), finishing (DONE or FAILED) sets the finish time and
+        PENDING clears it.
+        """
+        names = sorted(keys)
+        values = [keys[name] for name in names]
+        now = get_current_time()
+        if state == RUNNING:
+            update = 'state = ?, attempts = attempts + 1, started = ?, finished = NULL, error = NULL'
+            update_values = [state, started or now]
+        elif state == PENDING:
+            update = 'state = ?, finished = NULL, error = NULL'
+            update_values = [state]
+        else:
+            update = 'state = ?, finished = ?, error = ?'
+            update_values = [state, now, error]
+        with self.connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO %s (%s, state) VALUES (%s, ?)' % (table, ', '.join(names), ', '.join('?' for name in names)),
+                         values + [PENDING])
+            conn.execute('UPDATE %s SET %s WHERE %s' % (table, update, ' AND '.join('%s = ?' % name for name in names)),
+                         update_values + values)
+
+    def start_run(self):
+        self.set_state('runs', dict(run=self.run), RUNNING)
+
+    def start_sample(self, stage, sample):
+        self.set_state('samples', dict(run=self.run, stage=stage, sample=str(sample)), RUNNING)
+
+    def start_stage(self, stage, started=None):
+        self.set_state('stages', dict(run=self.run, stage=stage), RUNNING, started=started)
+
+    def wait_for_samples(self, stage, samples, lh, max_wait=86400, min_interval=1, max_interval=30):
+        """
+        Generate a tuple containing each of the samples and its state (DONE
+        or FAILED) as soon as it finishes the stage.  Once the stage has
+        finished for the whole run, the remaining samples are generated with
+        the state of the stage.  Samples that have not finished after
+        max_wait seconds are generated as FAILED.  The interval between polls
+        starts at min_interval and doubles (up to max_interval) after each
+        poll that found no finished samples.
+        """
+        start = time.time()
+        interval = min_interval
+        remaining = list(samples)
+        while remaining:
+            finished_samples = self.get_finished_samples(stage, remaining)
+            for sample in list(remaining):
+                if sample in finished_samples:
+                    remaining.remove(sample)
+                    yield sample, finished_samples[sample]
+            if not remaining:
+                break
+            if time.time() - start > max_wait:
+                lh.write('Samples %s did not finish stage %s within %d seconds.\n' % (', '.join(str(sample) for sample in remaining), stage, max_wait))
+                for sample in remaining:
+                    yield sample, FAILED
+                break
+            if finished_samples:
+                interval = min_interval
+            time.sleep(interval)
+            if not finished_samples:
+                interval = min(interval * 2, max_interval)
+
+
+def connect(db_file):
+    conn = sqlite3.connect(db_file, timeout=DB_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def get_current_time():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_db_file(config, log_dir):
+    return config.get('PIPELINE_STATE_DB', default=None) or os.path.join(log_dir, DB_FILE_NAME)
+
+
+def get_pipeline_state(config, log_dir, run):
+    """
+    Return the PipelineState for the run (the name of its run
+    directory) using the database named in the config.
+    """
+    return PipelineState(get_db_file(config, log_dir), run)
+
+
+def get_previous_stage(stage):
+    index = STAGES.index(stage)
+    if index == 0:
+        return None
+    return STAGES[index - 1]
+
+
+def get_runs(db_file):
+    """
+    Return the rows for all of the runs in the database,
+    the most recently started first.
+    """
+    if not os.path.exists(db_file):
+        return []
+    conn = connect(db_file)
+    try:
+        return conn.execute('SELECT * FROM runs ORDER BY started DESC, run').fetchall()
+    finally:
+        conn.close()
+
+
+def get_stage_index(stage):
+    """
+    Return the position of the stage for sorting, with stages that are
+    not in STAGES (i.e., copy_raw_data.py) first.
+    """
+    if stage in STAGES:
+        return STAGES.index(stage) + 1
+    return 0
@@ -0,0 +1,61 @@
+"""
+Provides a rate limiter that spaces out requests to Galaxy based on how long
+Galaxy takes to respond.  While responses are fast the interval between
+requests shrinks toward a minimum, and when a response takes longer than the
+target latency the interval grows toward a maximum so that a busy Galaxy is
+given time to catch up.
+"""
+import threading
+import time
+
+
+class RateLimiter(object):
+
+    def __init__(self, min_interval=0.0, max_interval=30.0, target_latency=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_latency = target_latency
+        self.interval = min_interval
+        # The time at which the next request may be sent.
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def call(self, func, *args, **kwd):
+        """
+        Wait until a request may be sent, call func and adjust the interval
+        using the time it took to return.
+        """
+        self.wait()
+        start = time.time()
+        try:
+            return func(*args, **kwd)
+        finally:
+            self.record(time.time() - start)
+
+    def record(self, latency):
+        with self.lock:
+            if latency > self.target_latency:
+                # Back off quickly when Galaxy is slow...
+                self.interval = min(max(self.interval * 2, latency), self.max_interval)
+            else:
+                # ...and recover gradually when it is fast again.
+                self.interval = max(self.interval / 2, self.min_interval)
+            self.next_time = max(self.next_time, time.time() + self.interval)
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            # Reserve the slot so that concurrent callers are spaced out.
+            self.next_time = max(self.next_time, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_rate_limiter(config):
+    """
+    Return a RateLimiter using the GALAXY_REQUEST_* settings in config.
+    """
+    return RateLimiter(min_interval=config.get_float('GALAXY_REQUEST_MIN_INTERVAL', default=0.0),
+                       max_interval=config.get_float('GALAXY_REQUEST_MAX_INTERVAL', default=30.0),
+                       target_latency=config.get_float('GALAXY_REQUEST_TARGET_LATENCY', default=2.0))
@@ -29,9 +29,12 @@ def get_workflow_config_files(workflow_config_directory, wf_config_files_str):
     return [os.path.join(workflow_config_directory, wf_config_file) for wf_config_file in wf_config_files]
 
 
-def get_workflow_input_datasets(gi, history_name, history_input_datasets, workflow_name, dbkey, galaxy_base_url, api_key, lh):
+def get_workflow_input_datasets(gi, history_name, history_input_datasets, workflow_name, dbkey, galaxy_base_url, api_key, lh, lookup_cache=None):
     # Map the history datasets to the input datasets for the workflow.
-    workflow_id, workflow_dict = get_workflow(gi, workflow_name, lh, galaxy_base_url=galaxy_base_url, api_key=api_key, for_inputs=True)
+    if lookup_cache is None:
+        workflow_id, workflow_dict = get_workflow(gi, workflow_name, lh, galaxy_base_url=galaxy_base_url, api_key=api_key, for_inputs=True)
+    else:
+        workflow_id, workflow_dict = lookup_cache.get_workflow(gi, workflow_name, lh, galaxy_base_url=galaxy_base_url, api_key=api_key, for_inputs=True)
     workflow_inputs = {}
     lh.write('\nMapping datasets from history %s to input datasets in workflow %s.\n' % (history_name, workflow_name))
     steps_dict = workflow_dict.get('steps', None)
@@ -126,6 +129,7 @@ def start_workflow(gi, workflow_id, workflow_name, inputs, params, history_id, l
                                                             history_id=history_id)
     lh.write('Response from executing workflow %s:\n' % workflow_name)
     lh.write('%s\n' % str(workflow_invocation_dict))
+    return workflow_invocation_dict
 
 
 def update_workflow_params(dbkey, workflow_dict, original_parameters, lh):
@@ -209,3 +213,26 @@ def update_workflow_params(dbkey, workflow_dict, original_parameters, lh):
                     lh.write('Cannot update species setting for dbkey %s in step_id %s because the tool is missing the species parameter.\n' % (dbkey, step_id))
     original_parameters.update(parameter_updates)
     return original_parameters
+
+
+def wait_for_invocation(gi, workflow_id, workflow_name, workflow_invocation_dict, lh, max_wait=600):
+    """
+    Wait for Galaxy to begin scheduling a workflow invocation, raising an
+    exception if the invocation fails or is still new after max_wait seconds.
+    """
+    invocation_id = workflow_invocation_dict.get('id', None)
+    if invocation_id is None:
+        # Older Galaxy releases do not return an invocation.
+        return
+    states = []
+
+    def is_ready():
+        state = gi.workflows.show_invocation(workflow_id, invocation_id)['state']
+        states.append(state)
+        if state in ['cancelled', 'failed']:
+            raise Exception('Invocation %s of workflow %s is in state %s.' % (invocation_id, workflow_name, state))
+        return state != 'new'
+
+    if not api_util.wait_until(is_ready, max_wait=max_wait):
+        raise Exception('Invocation %s of workflow %s was not scheduled after %d seconds.' % (invocation_id, workflow_name, max_wait))
+    lh.write('Invocation %s of workflow %s is in state %s.\n' % (invocation_id, workflow_name, states[-1]))